@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+                    ASYNCHRONOUS GEOMETRY MODIFICATION LOOKUPS
+
+
+------------------------------------------------------------------------------
+"""
+
+"""
+Asynchronous version of 'sequence_modifications' and 'nb_geometry_modification' (see 'typology_modif_encoding_copy.py').
+
+The recursive flow of 'geometry_modification' waits on PostgreSQL for every 'osm_versions' call, one after the other:
+a way with n nodes costs 2*n sequential round-trips per version pair. Here, the versions of all the referenced members
+of a version pair (and all the version pairs of a feature) are queried concurrently through an asyncpg connection pool,
+so the latency of a way becomes about two round-trips (its versions, then all its nodes), whatever its number of nodes.
+Many features are processed at the same time, with a bounded number of features in flight and of open connections.
+
+The results are exactly the ones of 'nb_geometry_modification': the node comparison and the resolution of the
+referenced members ('geometry_references_resolver') are shared with 'typology_modif_encoding_copy.py',
+and the members are still checked in order (first error or first modification found wins).
+For relations, the members are fetched concurrently but compared one after the other, so that a member
+which would not have been reached sequentially is never recursed into.
+
+Example:
+    results = async_nb_geometry_modification(osm_ids, osm_types,
+                                             {'database': "uusimaa", 'user': "postgres", 'password': "postgres",
+                                              'host': "localhost", 'port': 5432},
+                                             nb_connections=16, max_concurrency=256)
+
+N.B.: requires the 'asyncpg' library (pip install asyncpg).
+"""
+
+
+
+### Libraries import
+
+import asyncio
+from tqdm import tqdm   # for displaying a progress bar on loops
+
+import pandas as pd
+
+try:
+    import asyncpg    # asynchronous PostgreSQL driver (optional: only needed by this module)
+except ImportError:
+    asyncpg = None
+
+from typology_modif_encoding_copy import geometry_modification, geometry_references_resolver, members_types, RelationCycleError
+
+
+
+
+### Code
+
+
+def quote_identifier(name):
+    """
+    quotes a table name for a SQL query (asyncpg has no equivalent of 'psycopg2.sql.Identifier')
+
+    Parameters
+    ----------
+    name : string
+        TABLE NAME.
+
+    Returns
+    -------
+    string
+        QUOTED TABLE NAME.
+
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+
+async def init_connection(connection):
+    """
+    initialises a new connection of the pool: 'hstore' values are returned as text,
+    as psycopg2 does (asyncpg has no built-in codec for the 'hstore' extension type)
+
+    Parameters
+    ----------
+    connection : asyncpg Connection
+        NEW CONNECTION.
+
+    Returns
+    -------
+    None.
+
+    """
+    schema = await connection.fetchval("""SELECT n.nspname FROM pg_type AS t JOIN pg_namespace AS n ON n.oid = t.typnamespace
+WHERE t.typname = 'hstore';""")
+    if schema is not None:
+        await connection.set_type_codec('hstore', encoder=str, decoder=str, schema=schema, format='text')
+
+
+
+class AsyncVersionsLookup:
+    """
+    'osm_versions' and the geometry modification functions, with asynchronous queries through a connection pool
+    """
+    def __init__(self, pool, columns, pgsql_tablename='history', node_index=None):
+        self.pool = pool
+        self.columns = columns # columns of the history table (for features without any version)
+        self.table = quote_identifier(pgsql_tablename)
+        self.node_index = node_index # optional NodeCoordinateIndex (see 'node_index.py'): no query for the nodes of the ways
+        self.queries = 0
+
+    @classmethod
+    async def create(cls, pool, pgsql_tablename='history', node_index=None):
+        # reads the columns of the history table once
+        async with pool.acquire() as connection:
+            statement = await connection.prepare("SELECT * FROM " + quote_identifier(pgsql_tablename) + " LIMIT 0;")
+            columns = [attribute.name for attribute in statement.get_attributes()]
+        return cls(pool, columns, pgsql_tablename, node_index)
+
+    async def osm_versions(self, osm_id, osm_type=None):
+        # same queries and same DataFrame as 'query_versions'
+        if osm_type is None:
+            query = "SELECT * FROM " + self.table + " WHERE osm_type IN ('node', 'way', 'relation') AND osm_id = $1 ORDER BY version, id;"
+            arguments = (int(osm_id),)
+        else:
+            query = "SELECT * FROM " + self.table + " WHERE osm_type = $1 AND osm_id = $2 ORDER BY version, id;"
+            arguments = (osm_type, int(osm_id))
+        async with self.pool.acquire() as connection:
+            records = await connection.fetch(query, *arguments)
+        self.queries += 1
+        return pd.DataFrame([tuple(record) for record in records], columns=self.columns)
+
+    async def many_versions(self, osm_ids, osm_types):
+        # versions of several features, queried concurrently (each distinct feature once), in the input order
+        keys = list(zip(osm_types, osm_ids))
+        unique_keys = list(dict.fromkeys(keys))
+        results = await asyncio.gather(*[self.osm_versions(osm_id, osm_type) for osm_type, osm_id in unique_keys])
+        versions = dict(zip(unique_keys, results))
+        return [versions[key] for key in keys]
+
+    async def geometry_modification(self, t1, t2, osm_type, path=frozenset()):
+        """
+        [RECURSIVE FUNCTION]
+        asynchronous 'geometry_modification': returns 1 if there has been a geometry modification, None if not,
+        or 2 if there has been an error in the process (raises RelationCycleError for cyclic relations)
+
+        Parameters
+        ----------
+        t1 : pandas Series
+            PREVIOUS VERSION.
+        t2 : pandas Series
+            CURRENT VERSION.
+        osm_type : string
+            FEATURE TYPE.
+        path : frozenset
+            RELATION VERSION PAIRS (PRIMARY KEYS) BEING COMPARED BY THE CALLERS.
+
+        Returns
+        -------
+        int
+            see main description.
+
+        """
+        if osm_type == 'node':
+            return geometry_modification(t1, t2, 'node')
+
+        # Same checks as 'geometry_modification' before looking at the referenced members
+        t1_members_refs = t1['members_refs']
+        t2_members_refs = t2['members_refs']
+        if t2_members_refs == None:
+            return None
+        if t1_members_refs == None:
+            return 2
+        n, m = len(t1_members_refs), len(t2_members_refs)
+        if n != m:
+            return 1
+
+        t1_timestamp = t1['timestamp']
+        t2_timestamp = t2['timestamp']
+
+        if osm_type == 'way':
+            if self.node_index is not None:
+                # no timestamp: error, as without the node index
+                if pd.isnull(t1_timestamp) or pd.isnull(t2_timestamp):
+                    return 2
+                return self.node_index.way_modification(t1_members_refs, int(t1_timestamp.timestamp()),
+                                                        t2_members_refs, int(t2_timestamp.timestamp()))
+            t1_types, t2_types = ['node'] * n, ['node'] * n
+        else: # if osm_type == 'relation':
+            t1_types, t2_types = members_types(t1), members_types(t2)
+            # (the coroutines of the pairs run concurrently: the pairs being compared are passed down, not shared)
+            relation_pair = (t1['id'], t2['id'])
+            if relation_pair in path:
+                raise RelationCycleError("relation " + str(t1['osm_id']) + " leads back to itself through its members")
+            path = path | {relation_pair}
+
+        # All the referenced members of both versions queried at once...
+        versions = await self.many_versions(t1_members_refs + t2_members_refs, t1_types + t2_types)
+
+        # ...then compared in order, as in 'geometry_modification'
+        for i in range(n):
+            t1_i_member_versions, t2_i_member_versions = versions[i], versions[n + i]
+
+            # If the referenced member doesn't exist in our database: EDGE EFFECT error
+            if t1_i_member_versions.shape[0] == 0 or t2_i_member_versions.shape[0] == 0:
+                return 2
+
+            t1_i_member = geometry_references_resolver(t1_i_member_versions, t1_timestamp)
+            t2_i_member = geometry_references_resolver(t2_i_member_versions, t2_timestamp)
+            if t1_i_member.shape[0] == 0 or t2_i_member.shape[0] == 0:
+                return 2
+
+            if osm_type == 'way':
+                if geometry_modification(t1_i_member, t2_i_member, 'node') != None:
+                    return 1
+            else:
+                if t1_i_member['osm_type'] != t2_i_member['osm_type']:
+                    return 1
+                if await self.geometry_modification(t1_i_member, t2_i_member, t1_i_member['osm_type'], path) != None:
+                    return 1
+        return None
+
+    async def sequence_modifications(self, osm_id, osm_type=None):
+        # asynchronous 'sequence_modifications': all the version pairs of the feature are compared concurrently
+        versions = await self.osm_versions(osm_id, osm_type)
+        n, m = versions.shape
+        if n < 1:
+            return [2]
+        feature_type = versions['osm_type'][0]
+        codes = await asyncio.gather(*[self.pair_modification(versions.iloc[i], versions.iloc[i+1], feature_type)
+                                       for i in range(n-1)])
+        return [code for code in codes if code != None]
+
+    async def pair_modification(self, t1, t2, feature_type):
+        # 'geometry_modification' of a version pair of a feature, cyclic relations being an error (as in 'sequence_modifications')
+        try:
+            return await self.geometry_modification(t1, t2, feature_type)
+        except RelationCycleError:
+            return 2
+
+    async def nb_geometry_modification(self, osm_id, osm_type=None):
+        # asynchronous 'nb_geometry_modification'
+        seq = await self.sequence_modifications(osm_id, osm_type)
+        if 2 in seq:
+            return None
+        return len(seq)
+
+
+
+async def async_nb_geometry_modification_run(osm_ids, osm_types, connection_parameters, pgsql_tablename='history',
+                                             nb_connections=16, max_concurrency=256, node_index=None, progress=True):
+    """
+    coroutine of 'async_nb_geometry_modification' (to be awaited from an already running event loop)
+
+    Returns
+    -------
+    list
+        NUMBER OF GEOMETRY MODIFICATIONS PER FEATURE (int or None), IN THE INPUT ORDER.
+
+    """
+    if asyncpg is None:
+        raise ImportError("the asynchronous mode requires the 'asyncpg' library (pip install asyncpg)")
+
+    osm_ids = [int(osm_id) for osm_id in osm_ids]
+    osm_types = list(osm_types) if osm_types is not None else [None] * len(osm_ids)
+
+    async with asyncpg.create_pool(min_size=1, max_size=nb_connections, init=init_connection, **connection_parameters) as pool:
+        lookup = await AsyncVersionsLookup.create(pool, pgsql_tablename, node_index)
+
+        # At most 'max_concurrency' features in flight (their own member queries share the 'nb_connections' connections)
+        semaphore = asyncio.Semaphore(max_concurrency)
+        progress_bar = tqdm(total=len(osm_ids), disable=not progress)
+
+        async def feature(osm_id, osm_type):
+            async with semaphore:
+                result = await lookup.nb_geometry_modification(osm_id, osm_type)
+            progress_bar.update(1)
+            return result
+
+        # Features scheduled by windows, so that the number of pending coroutines stays bounded too
+        results = []
+        for i in range(0, len(osm_ids), 16 * max_concurrency):
+            results.extend(await asyncio.gather(*[feature(osm_id, osm_type) for osm_id, osm_type
+                                                  in zip(osm_ids[i:i + 16 * max_concurrency], osm_types[i:i + 16 * max_concurrency])]))
+        progress_bar.close()
+
+    return results
+
+
+
+def async_nb_geometry_modification(osm_ids, osm_types, connection_parameters, pgsql_tablename='history',
+                                   nb_connections=16, max_concurrency=256, node_index=None, progress=True):
+    """
+    asynchronous version of 'compute_nb_geometry_modification' (see 'typology_modif_encoding_copy.py'):
+    returns the number of geometry modifications of each input feature (None in case of error)
+
+    Parameters
+    ----------
+    osm_ids : int list
+        OSM FEATURE IDS.
+    osm_types : string list
+        OSM FEATURE TYPES (None: LOOKUP BY ID ONLY).
+    connection_parameters : dict
+        asyncpg.connect KEYWORD ARGUMENTS (database, user, password, host, port).
+    pgsql_tablename : string
+        HISTORY TABLE NAME.
+    nb_connections : int
+        SIZE OF THE CONNECTION POOL (MAXIMUM NUMBER OF QUERIES RUNNING AT THE SAME TIME).
+    max_concurrency : int
+        MAXIMUM NUMBER OF FEATURES PROCESSED AT THE SAME TIME.
+    node_index : NodeCoordinateIndex, optional
+        PREBUILT NODE INDEX (SEE 'node_index.py'): THE NODES OF THE WAYS ARE THEN RESOLVED FROM IT.
+    progress : boolean
+        DISPLAY A PROGRESS BAR.
+
+    Returns
+    -------
+    list
+        NUMBER OF GEOMETRY MODIFICATIONS PER FEATURE (int or None), IN THE INPUT ORDER.
+
+    """
+    return asyncio.run(async_nb_geometry_modification_run(osm_ids, osm_types, connection_parameters, pgsql_tablename,
+                                                          nb_connections, max_concurrency, node_index, progress))
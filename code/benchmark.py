@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+                    BENCHMARK HARNESS
+
+
+------------------------------------------------------------------------------
+"""
+
+"""
+Times the main steps of the project on a synthetic OSM history of configurable size (see 'synthetic_history.py'),
+against a local PostgreSQL database, so that regressions and improvements can be tracked:
+
+    generate               -> synthetic .osh, .osh.pbf and changeset files
+    history_importer       -> 'history_importer' (XML, bulk mode), into the 'history_xml' table
+    history_pbf_importer   -> 'history_pbf_importer' (PBF), into the 'history' table
+    changeset_importer     -> 'changeset_importer', into the 'changesets' table
+    get_data               -> 'get_data' of 'source_fetching.py' (and 'get_data_fast': fast-scan mode)
+    geometry_batch         -> 'get_geometry_modification(batch=True)' (and 'geometry_sql': in-database engine,
+                              'geometry_loop': original feature-by-feature loop, slow, not run by default)
+    geometry_magnitudes    -> 'compute_modification_magnitudes' of all the version pairs of the buildings (see 'geometry_magnitude.py')
+
+Every stage runs in a fresh process, so that its peak memory (peak RSS) is measured on its own,
+and is reported with its duration and throughput (rows/s). The results can be saved as JSON and compared
+with a previous run ('--baseline').
+
+/!\ The benchmark replaces the 'history', 'history_xml', 'changesets' and 'nls_buildings_multipolygons' tables
+    of its database: use a dedicated database (created if needed, 'osm_benchmark' by default)  /!\
+
+Example:
+    python benchmark.py --nodes 100000 --ways 20000 --relations 1000 --output results.json
+    python benchmark.py --nodes 100000 --ways 20000 --relations 1000 --baseline results.json
+"""
+
+
+
+### Librairies import
+
+import os
+import sys
+import json
+import time
+import datetime
+import argparse    # for reading the benchmark parameters from the command line
+import resource    # for the peak memory (RSS) of each stage
+import traceback    # for reporting the errors of the stage processes
+import multiprocessing
+
+import psycopg2     # PostgreSQL driver for Python support
+from psycopg2 import sql    # for generating dynamically SQL queries (for choosing dynamically a table name)
+
+from metrics import metrics    # breakdown of each stage (parse, encode, db_execute, commit, osm_versions_query... see 'metrics.py')
+
+
+
+
+### Code
+
+
+STAGES = ['generate', 'history_importer', 'history_pbf_importer', 'changeset_importer', 'get_data', 'get_data_fast',
+          'geometry_batch', 'geometry_sql', 'geometry_loop', 'geometry_magnitudes']
+DEFAULT_STAGES = [stage for stage in STAGES if stage != 'geometry_loop']
+
+
+
+def create_benchmark_database(connection_parameters):
+    """
+    creates the benchmark database if it does not exist yet, with the 'hstore' extension
+
+    Parameters
+    ----------
+    connection_parameters : dict
+        psycopg2.connect KEYWORD ARGUMENTS OF THE BENCHMARK DATABASE.
+
+    Returns
+    -------
+    None.
+
+    """
+    maintenance_parameters = dict(connection_parameters, database='postgres')
+    conn = psycopg2.connect(**maintenance_parameters)
+    conn.autocommit = True # 'CREATE DATABASE' cannot run inside a transaction
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = %s;", (connection_parameters['database'],))
+    if cur.fetchone() is None:
+        cur.execute(sql.SQL("CREATE DATABASE {};").format(sql.Identifier(connection_parameters['database'])))
+    conn.close()
+
+    conn = psycopg2.connect(**connection_parameters)
+    cur = conn.cursor()
+    cur.execute("CREATE EXTENSION IF NOT EXISTS hstore;")
+    conn.commit()
+    conn.close()
+
+
+
+def filenames(config):
+    # synthetic files of the benchmark
+    directory = config['directory']
+    return {'xml': os.path.join(directory, 'synthetic.osh'),
+            'pbf': os.path.join(directory, 'synthetic.osh.pbf'),
+            'changesets': os.path.join(directory, 'synthetic-changesets.osm.bz2'),
+            'geometry': os.path.join(directory, 'synthetic_nb_geometry_modification.csv')}
+
+
+
+def reset_table(cur, pgsql_tablename):
+    # drops a table of a previous run, with its import checkpoints (see 'history_to_pgsql_enhanced.py')
+    cur.execute(sql.SQL("DROP TABLE IF EXISTS {};").format(sql.Identifier(pgsql_tablename)))
+    cur.execute("SELECT to_regclass('public.history_import_checkpoints') IS NOT NULL;")
+    if cur.fetchone()[0]:
+        cur.execute("DELETE FROM history_import_checkpoints WHERE tablename = %s;", (pgsql_tablename,))
+
+
+
+def count_rows(cur, pgsql_tablename):
+    cur.execute(sql.SQL("SELECT count(*) FROM {};").format(sql.Identifier(pgsql_tablename)))
+    return cur.fetchone()[0]
+
+
+
+def prepare_buildings_table(cur):
+    # 'nls_buildings_multipolygons' equivalent for the synthetic data: all its ways and relations are buildings
+    cur.execute("DROP TABLE IF EXISTS nls_buildings_multipolygons;")
+    cur.execute("""CREATE TABLE nls_buildings_multipolygons AS
+SELECT DISTINCT NULL::text AS osm_id, CAST(osm_id AS text) AS osm_way_id FROM history WHERE osm_type = 'way'
+UNION ALL
+SELECT DISTINCT CAST(osm_id AS text), NULL::text FROM history WHERE osm_type = 'relation';""")
+
+
+
+def run_stage(stage, config):
+    """
+    [WORKER PROCESS] runs one stage of the benchmark, and measures it
+
+    Parameters
+    ----------
+    stage : string
+        STAGE NAME (SEE 'STAGES').
+    config : dict
+        BENCHMARK PARAMETERS (SEE 'MAIN').
+
+    Returns
+    -------
+    dict
+        rows, seconds, rss_before_mb (PEAK RSS BEFORE THE STAGE, I.E. IMPORTS),
+        peak_rss_mb (LARGEST PEAK RSS OF THE STAGE PROCESS AND OF ITS OWN WORKERS, IF ANY),
+        metrics (BREAKDOWN OF THE STAGE RECORDED BY THE SCRIPTS, SEE 'metrics.py').
+
+    """
+    files = filenames(config)
+    conn = psycopg2.connect(**config['connection_parameters'])
+    cur = conn.cursor()
+
+    # Modules imported (and their module-level connection set) before the timer starts
+    if stage == 'generate':
+        from synthetic_history import generate_history
+    elif stage in ('history_importer', 'history_pbf_importer'):
+        import history_to_pgsql_enhanced as module
+        reset_table(cur, 'history_xml' if stage == 'history_importer' else 'history')
+    elif stage == 'changeset_importer':
+        import chgset_to_pgsql as module
+        reset_table(cur, 'changesets')
+    elif stage in ('get_data', 'get_data_fast'):
+        from source_fetching import get_data
+    else:
+        import typology_modif_encoding_copy as module
+        prepare_buildings_table(cur)
+        cur.execute("""SELECT CAST(osm_way_id AS bigint), 'way' FROM nls_buildings_multipolygons WHERE osm_way_id IS NOT NULL
+UNION ALL SELECT CAST(osm_id AS bigint), 'relation' FROM nls_buildings_multipolygons WHERE osm_id IS NOT NULL;""")
+        buildings = cur.fetchall()
+    if stage not in ('generate', 'get_data', 'get_data_fast'):
+        module.conn, module.cur = conn, cur
+    conn.commit()
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kB on Linux
+    metrics.reset()
+    start = time.perf_counter()
+
+    if stage == 'generate':
+        counts = generate_history([files['xml'], files['pbf']], files['changesets'], config['nodes'], config['ways'], config['relations'],
+                                  config['versions'], config['geometry_share'], config['seed'])
+        rows = counts['node'] + counts['way'] + counts['relation']
+    elif stage == 'history_importer':
+        module.history_importer(files['xml'], 'history_xml', bulk=True)
+        rows = count_rows(cur, 'history_xml')
+    elif stage == 'history_pbf_importer':
+        module.history_pbf_importer(files['pbf'], 'history')
+        rows = count_rows(cur, 'history')
+    elif stage == 'changeset_importer':
+        rows = module.changeset_importer(files['changesets'], 'changesets')
+    elif stage in ('get_data', 'get_data_fast'):
+        rows = len(get_data(files['pbf'], fast=stage == 'get_data_fast'))
+    elif stage == 'geometry_magnitudes':
+        rows = len(module.compute_modification_magnitudes([row[0] for row in buildings], [row[1] for row in buildings], modified_only=False))
+    else:
+        mode = {'geometry_batch': {'batch': True}, 'geometry_sql': {'in_database': True}, 'geometry_loop': {}}[stage]
+        rows = len(module.get_geometry_modification(out_filename=files['geometry'], **mode))
+
+    seconds = time.perf_counter() - start
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    conn.close()
+    return {'rows': rows, 'seconds': round(seconds, 3), 'rss_before_mb': round(rss_before, 1), 'peak_rss_mb': round(peak_rss, 1),
+            'metrics': metrics.collect()}
+
+
+
+def stage_process(stage, config, queue):
+    # [WORKER PROCESS] runs a stage and sends back its measures (or the error raised)
+    try:
+        queue.put(run_stage(stage, config))
+    except Exception:
+        queue.put(traceback.format_exc())
+
+
+
+def measure_stage(stage, config):
+    """
+    runs a stage in a fresh process ('spawn': nothing inherited from this process, so that the peak RSS is the stage's own;
+    not a 'Pool' worker, since some stages start their own pool of processes)
+
+    Parameters
+    ----------
+    stage : string
+        STAGE NAME.
+    config : dict
+        BENCHMARK PARAMETERS.
+
+    Returns
+    -------
+    dict
+        MEASURES OF THE STAGE (SEE 'run_stage'), WITH ITS THROUGHPUT (rows_per_second).
+
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=stage_process, args=(stage, config, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if not isinstance(result, dict):
+        raise RuntimeError("stage '" + stage + "' failed:\n" + result)
+    result['rows_per_second'] = round(result['rows'] / result['seconds'], 1) if result['seconds'] > 0 else None
+    return result
+
+
+
+def report(results, baseline=None):
+    """
+    prints the per-stage breakdown (and the speedups with respect to a previous run, if any)
+
+    Parameters
+    ----------
+    results : dict
+        STAGE NAME -> MEASURES.
+    baseline : dict, optional
+        RESULTS OF A PREVIOUS RUN (SAME FORMAT).
+
+    Returns
+    -------
+    None.
+
+    """
+    total = sum(result['seconds'] for result in results.values())
+    print("\n\n %-22s %12s %10s %7s %12s %14s" % ('stage', 'rows', 'seconds', 'share', 'rows/s', 'peak RSS (MB)')
+          + ("  speedup" if baseline else ""))
+    for stage, result in results.items():
+        line = " %-22s %12d %10.2f %6.1f%% %12s %14.1f" % (stage, result['rows'], result['seconds'],
+                                                          100 * result['seconds'] / total if total > 0 else 0,
+                                                          result['rows_per_second'], result['peak_rss_mb'])
+        if baseline and stage in baseline and result['seconds'] > 0:
+            line += "  x%.2f" % (baseline[stage]['seconds'] / result['seconds'])
+        print(line)
+    print(" %-22s %12s %10.2f" % ('total', '', total))
+
+
+
+def run_benchmark(config, stages=DEFAULT_STAGES, output=None, baseline=None):
+    """
+    runs the benchmark stages in order, reports them, and saves them as JSON if asked
+
+    Parameters
+    ----------
+    config : dict
+        BENCHMARK PARAMETERS (SEE 'MAIN').
+    stages : string list
+        STAGES TO RUN (SEE 'STAGES'): THE GEOMETRY STAGES NEED THE 'history' TABLE OF 'history_pbf_importer',
+        ALL THE STAGES NEED THE FILES OF 'generate' (BOTH FROM THIS RUN OR A PREVIOUS ONE).
+    output : string, optional
+        JSON FILE WHERE THE RESULTS ARE SAVED.
+    baseline : string, optional
+        JSON FILE OF A PREVIOUS RUN, FOR COMPARISON.
+
+    Returns
+    -------
+    dict
+        STAGE NAME -> MEASURES.
+
+    """
+    os.makedirs(config['directory'], exist_ok=True)
+    create_benchmark_database(config['connection_parameters'])
+
+    results = {}
+    for stage in [stage for stage in STAGES if stage in stages]:
+        print("\n\n ### Stage:", stage)
+        results[stage] = measure_stage(stage, config)
+        print("\n", stage, results[stage])
+
+    baseline_results = None
+    if baseline is not None:
+        with open(baseline) as f:
+            baseline_results = json.load(f)['results']
+    report(results, baseline_results)
+
+    if output is not None:
+        parameters = {key: value for key, value in config.items() if key != 'connection_parameters'}
+        with open(output, 'w') as f:
+            json.dump({'date': datetime.datetime.now().isoformat(timespec='seconds'), 'python': sys.version.split()[0],
+                       'parameters': parameters, 'results': results}, f, indent=2)
+    return results
+
+
+
+
+
+### Main
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark of the OSM history scripts on a synthetic history")
+    parser.add_argument('--nodes', type=int, default=100000, help="number of nodes")
+    parser.add_argument('--ways', type=int, default=20000, help="number of ways (buildings)")
+    parser.add_argument('--relations', type=int, default=1000, help="number of relations (multipolygon buildings)")
+    parser.add_argument('--versions', type=int, default=3, help="average number of versions per feature")
+    parser.add_argument('--geometry-share', type=float, default=0.5, help="share of the new versions being geometry edits")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of the generator")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=DEFAULT_STAGES, help="stages to run")
+    parser.add_argument('--directory', default='benchmark_data', help="directory of the synthetic files")
+    parser.add_argument('--output', help="JSON file where the results are saved")
+    parser.add_argument('--baseline', help="JSON file of a previous run, for comparison")
+    # feel free to change the connection details to fit your needs (dedicated database!)
+    parser.add_argument('--database', default='osm_benchmark')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='postgres')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default='5432')
+    args = parser.parse_args()
+
+    config = {'nodes': args.nodes, 'ways': args.ways, 'relations': args.relations, 'versions': args.versions,
+              'geometry_share': args.geometry_share, 'seed': args.seed, 'directory': args.directory,
+              'connection_parameters': {'database': args.database, 'user': args.user, 'password': args.password,
+                                        'host': args.host, 'port': args.port}}
+
+    run_benchmark(config, args.stages, args.output, args.baseline)
@@ -11,7 +11,7 @@ Created on Tue Jun 20 14:31:54 2023
 ------------------------------------------------------------------------------
 
                     OSM CHANGESET FILE IMPORT TO POSTGRESQL
-                    
+
                    * custom tool by Alexys Ren — June 2023 *
 
 
@@ -20,8 +20,8 @@ Created on Tue Jun 20 14:31:54 2023
 
 
 """
-Important prerequisite: if it happens that you have the raw .osm.bz2 file, please extract the .osm from it
-            before launching this code
+N.B.: the raw .osm.bz2 file can be given directly, it is decompressed on-the-fly while parsing
+      (no need to extract the .osm from it beforehand anymore!)
 """
 
 
@@ -30,131 +30,220 @@ Important prerequisite: if it happens that you have the raw .osm.bz2 file, pleas
 
 from tqdm import tqdm
 
+import bz2    # for streaming the decompression of .osm.bz2 changeset dumps
 import xml.etree.ElementTree as ET
 
 import psycopg2
+from psycopg2 import sql # for generating dynamically SQL queries (for choosing dynamically a table name)
 
+from pgsql_copy import copy_value, copy_hstore, copy_in_batches    # 'COPY FROM STDIN' bulk loading (see 'pgsql_copy.py')
 
 
 
 
 
-### Changeset file import
-
-""" /!\ PLEASE MAKE SURE THIS CURRENT PYTHON FILE IS LOCATED IN THE SAME DIRECTORY AS YOUR
-                        CHANGESET FILE /!\
-"""
-tree = ET.parse('uusimaa-changesets.osm') # feel free to change the filename here to fit your needs
-
-
-
+### Code
 
 
-### Connecting to the PostgreSQL Database
-# feel free again to change the connection details to fit your needs
+# Column encoders for the 'COPY' loading (same column order as the changesets table)
+CHANGESET_COPY_ENCODERS = [copy_value] * 12 + [copy_hstore]
+
+
+
+def create_changeset_table(pgsql_tablename='changesets'):
+    """
+    creates the PostgreSQL table for hosting changesets, if it does not exist yet
+    (an existing table is kept as it is, its columns just have to follow the same order)
+
+    Parameters
+    ----------
+    pgsql_tablename : string
+        Tablename for output PostgreSQL table.
+
+    Returns
+    -------
+    None.
+
+    """
+    cur.execute(sql.SQL("""CREATE TABLE IF NOT EXISTS public.{}
+(
+    id bigint,
+    created_at timestamp without time zone,
+    closed_at timestamp without time zone,
+    open boolean,
+    "user" text,
+    uid bigint,
+    min_lat double precision,
+    min_lon double precision,
+    max_lat double precision,
+    max_lon double precision,
+    num_changes integer,
+    comments_count integer,
+    tags hstore,
+    PRIMARY KEY (id)
+);""").format(sql.Identifier(pgsql_tablename)))
+
+    # Making the previous change to the database persistent
+    conn.commit()
+
+
+
+def parse_changesets(f):
+    """
+    [GENERATOR]
+    parses an OSM changeset file (XML) on-the-fly and yields one tuple per changeset;
+    every parsed changeset is cleared from memory, so memory stays flat whatever the file size
+
+    Parameters
+    ----------
+    f : file object
+        OSM CHANGESET FILE OPENED IN BINARY MODE (POSSIBLY A bz2 STREAM).
+
+    Yields
+    ------
+    tuple
+        (changeset_id, created_at, closed_at, open, user, uid, min_lat, min_lon, max_lat, max_lon,
+         num_changes, comments_count, additional_tags)
+
+    """
+    root = None
+
+    for event, child in ET.iterparse(f, events=('start', 'end')):
+
+        if event == 'start':
+            if root is None:
+                root = child # the <osm> element, cleared after each changeset (see below)
+            continue
+
+        if child.tag != 'changeset':
+            # <tag> elements (and comments of the discussion dumps) are read with their changeset
+            continue
+
+        # every try/except below are meant to test if the related info exists!
+        try:
+            changeset_id = child.attrib['id']
+        except KeyError:
+            changeset_id = None
+        try:
+            created_at = child.attrib['created_at']
+        except KeyError:
+            created_at = None
+        try:
+            closed_at = child.attrib['closed_at']
+        except KeyError:
+            closed_at = None
+        try:
+            Open = child.attrib['open']
+        except KeyError:
+            Open = None
+        try:
+            user = child.attrib['user']
+        except KeyError:
+            user = None
+        try:
+            uid = child.attrib['uid']
+        except KeyError:
+            uid = None
+        try:
+            min_lat = child.attrib['min_lat']
+        except KeyError:
+            min_lat = None
+        try:
+            min_lon = child.attrib['min_lon']
+        except KeyError:
+            min_lon = None
+        try:
+            max_lat = child.attrib['max_lat']
+        except KeyError:
+            max_lat = None
+        try:
+            max_lon = child.attrib['max_lon']
+        except KeyError:
+            max_lon = None
+        try:
+            num_changes = child.attrib['num_changes']
+        except KeyError:
+            num_changes = None
+        try:
+            comments_count = child.attrib['comments_count']
+        except KeyError:
+            comments_count = None
+
+
+
+        # Preparing the additional tags for storing in hstore format (if they exist!)
+
+        additional_tags = [[tag.attrib['k'], tag.attrib['v']] for tag in child.iter('tag')]
+        if len(additional_tags) == 0:
+            additional_tags = None
+
+        yield (changeset_id,created_at,closed_at,Open,user,uid,min_lat,min_lon,max_lat,max_lon,num_changes,comments_count,additional_tags)
+
+        # Freeing the memory: the changeset (and its tags) are dropped from the XML tree
+        root.clear()
+
+
+
+def changeset_importer(osm_changeset_filename, pgsql_tablename='changesets', batch_size=50000):
+    """
+    imports an OSM changeset file (.osm or .osm.bz2) into the PostgreSQL database
+    provided by the user in the 'MAIN', with one 'COPY' statement and one commit per batch
+
+    Parameters
+    ----------
+    osm_changeset_filename : string
+        OSM changeset filename with its extension.
+    pgsql_tablename : string
+        Tablename for output PostgreSQL table.
+    batch_size : int
+        Number of changesets sent per 'COPY' statement.
+
+    Returns
+    -------
+    int
+        Number of changesets imported.
+
+    """
+
+    create_changeset_table(pgsql_tablename)
+
+    if osm_changeset_filename.endswith('.bz2'):
+        f = bz2.open(osm_changeset_filename, 'rb') # decompressed on-the-fly while parsing
+    else:
+        f = open(osm_changeset_filename, 'rb')
 
-conn = psycopg2.connect(database="uusimaa", user="postgres", password="postgres", host="localhost", port="5432")
-cur = conn.cursor() # to perform database operations
+    print("\n\n Parsing changesets, on-the-fly importing... ")
 
+    with f:
+        nb_changesets = copy_in_batches(conn, pgsql_tablename, tqdm(parse_changesets(f)), CHANGESET_COPY_ENCODERS, batch_size)
 
+    print("\n\n Process completed! \n", nb_changesets, "changesets should now be appearing in your '", pgsql_tablename, "' PostgreSQL table!")
+    return nb_changesets
 
 
 
-### Code
 
-root = tree.getroot()
-
-
-changesets = []
-
-print("\n\n Parsing changesets... ")
-
-for child in tqdm(root):
-    # every try/except below are meant to test if the related info exists!
-    try:
-        changeset_id = child.attrib['id']
-    except KeyError:
-        changeset_id = None
-    try:
-        created_at = child.attrib['created_at']
-    except KeyError:
-        created_at = None
-    try:
-        closed_at = child.attrib['closed_at']
-    except KeyError:
-        closed_at = None
-    try:
-        Open = child.attrib['open']
-    except KeyError:
-        Open = None
-    try:
-        user = child.attrib['user']
-    except KeyError:
-        user = None
-    try:
-        uid = child.attrib['uid']
-    except KeyError:
-        uid = None
-    try:
-        min_lat = child.attrib['min_lat']
-    except KeyError:
-        min_lat = None
-    try:
-        min_lon = child.attrib['min_lon']
-    except KeyError:
-        min_lon = None
-    try:
-        max_lat = child.attrib['max_lat']
-    except KeyError:
-        max_lat = None
-    try:
-        max_lon = child.attrib['max_lon']
-    except KeyError:
-        max_lon = None
-    try:
-        num_changes = child.attrib['num_changes']
-    except KeyError:
-        num_changes = None
-    try:
-        comments_count = child.attrib['comments_count']
-    except KeyError:
-        comments_count = None
-    
-    
-    
-    # Preparing the additional tags for storing in hstore format (if they exist!)
-    
-    additional_tags = []
-
-    try:
-        temp = child[0]
-    except IndexError:
-        additional_tags = None
-    else:
-        for tag in child:
-            key = tag.attrib['k']
-            value = tag.attrib['v']
-            additional_tags.append([key,value])
-        
-    changesets.append((changeset_id,created_at,closed_at,Open,user,uid,min_lat,min_lon,max_lat,max_lon,num_changes,comments_count,additional_tags))
-    
-    
 
-### Inserting the output data into PostgreSQL
+### Main
 
-# the targeted table structure has to match with the columns pattern below, and also the table name must be the same!
-# feel free to change if needed!
+if __name__ == '__main__':
 
-print("\n\n Inserting changesets into database... ")
+    ### Connecting to the PostgreSQL Database
+    # feel free to change the connection details to fit your needs
 
-for changeset in tqdm(changesets):
-    cur.execute("""INSERT INTO changesets VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, hstore(%s));""", changeset)
+    conn = psycopg2.connect(database="uusimaa", user="postgres", password="postgres", host="localhost", port="5432")
+    cur = conn.cursor() # to perform database operations
 
-conn.commit() # Make the changes to the database persistent
 
-# Close communication with the database
-cur.close()
-conn.close()
+    """ /!\ PLEASE MAKE SURE THIS CURRENT PYTHON FILE IS LOCATED IN THE SAME DIRECTORY AS YOUR
+                            CHANGESET FILE /!\
+    """
+    filename = 'uusimaa-changesets.osm' # feel free to change the filename here to fit your needs (.osm.bz2 also accepted)
 
+    # the targeted table is created if needed; if it already exists, its structure has to match
+    # with the columns pattern of 'create_changeset_table'!
+    changeset_importer(filename, 'changesets')
 
-    
\ No newline at end of file
+    # Close communication with the database
+    cur.close()
+    conn.close()
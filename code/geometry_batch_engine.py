@@ -0,0 +1,813 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+                    BATCH GEOMETRY MODIFICATION ENGINE
+
+
+------------------------------------------------------------------------------
+"""
+
+"""
+Set-based version of 'nb_geometry_modification' (see 'typology_modif_encoding_copy.py').
+
+Instead of two SQL queries (and two DataFrames) per referenced node and per version pair,
+all the versions of a chunk of features and of their referenced members are loaded in a few
+'WHERE osm_type = %s AND osm_id = ANY(%s)' queries, one per reference depth. The node versions
+valid at a given timestamp are then found for all the references at once, with sorted arrays and 'searchsorted'.
+
+The results are exactly the ones of 'nb_geometry_modification':
+    - the feature type is the one of its first version,
+    - the nodes of a way are looked up as nodes, the members of a relation with their recorded type
+      (or with any type when the history table has no 'members_types' column),
+    - a referenced member is resolved to its latest version older than (or as old as) the
+      timestamp of the way/relation version, the first one in version order on ties,
+    - missing members (edge effect) or members younger than their way/relation give the error code 2,
+      and any error in the sequence of a feature gives None.
+
+Features are identified by lookup keys: osm_id * 4 + type code (see 'TYPE_CODES'), the code ANY_TYPE
+standing for a lookup by id only (all OSM types sharing the id).
+"""
+
+
+
+### Libraries import
+
+from tqdm import tqdm   # for displaying a progress bar on loops
+
+from psycopg2 import sql    # for generating dynamically SQL queries (for choosing dynamically a table name)
+import numpy as np
+
+from history_store import HistoryStore    # local alternative to the history table (see 'history_store.py')
+from metrics import metrics    # 'batch_load' and 'batch_compute' stage timers (see 'metrics.py')
+
+
+
+### Code
+
+
+TYPE_CODES = {'node': 0, 'way': 1, 'relation': 2}
+ANY_TYPE = 3
+
+# Composite search key: (rank of the lookup key) * TIME_KEY_STRIDE + (seconds since the oldest loaded version)
+TIME_KEY_STRIDE = 2 ** 32
+NULL_TIMESTAMP_OFFSET = TIME_KEY_STRIDE - 1 # versions without timestamp can never be selected
+
+# Maximum number of ids sent in one 'WHERE osm_id = ANY(%s)' query
+QUERY_CHUNK_SIZE = 100000
+
+# Code of a relation version pair whose members lead back to itself (cyclic relations, see 'RelationResolver'):
+# propagated to the parent relations, then counted as an error (None) for the feature
+CYCLE = 3
+
+
+
+def lookup_keys(osm_ids, osm_types=None):
+    """
+    returns the lookup keys (osm_id * 4 + type code) of the input features
+
+    Parameters
+    ----------
+    osm_ids : int list
+        OSM FEATURE IDS.
+    osm_types : string list or string, optional
+        OSM TYPES ('node', 'way', 'relation', or None for any type).
+
+    Returns
+    -------
+    numpy array (int64)
+
+    """
+    osm_ids = np.asarray(osm_ids, dtype=np.int64)
+    if osm_types is None or isinstance(osm_types, str):
+        codes = np.full(len(osm_ids), TYPE_CODES.get(osm_types, ANY_TYPE), dtype=np.int64)
+    else:
+        codes = np.array([TYPE_CODES.get(osm_type, ANY_TYPE) for osm_type in osm_types], dtype=np.int64)
+    return osm_ids * 4 + codes
+
+
+
+class VersionStore:
+    """
+    In-memory, columnar copy of all the versions of a set of OSM features,
+    sorted by (lookup key, version, id) like the 'osm_versions' query results
+    """
+    def __init__(self, pgsql_tablename='history'):
+        self.pgsql_tablename = pgsql_tablename
+        self.rows = []
+        self.loaded_keys = np.empty(0, dtype=np.int64)
+        self.has_members_types = None # checked at the first query
+        self.nb_queries = 0
+        self.build()
+
+    def load(self, cur, keys):
+        """
+        loads all the versions of the input features which are not in the store yet
+
+        Parameters
+        ----------
+        cur : psycopg2 cursor or HistoryStore
+            DATABASE CURSOR, OR LOCAL HISTORY STORE (SEE 'history_store.py').
+        keys : numpy array
+            LOOKUP KEYS (SEE 'lookup_keys').
+
+        Returns
+        -------
+        None.
+
+        """
+        keys = np.setdiff1d(np.asarray(keys, dtype=np.int64), self.loaded_keys)
+        if len(keys) == 0:
+            return
+
+        if isinstance(cur, HistoryStore):
+            # versions read from the memory-mapped store, in the same row format as the queries below
+            self.rows.extend(cur.version_rows(keys))
+            self.nb_queries += 1
+            self.loaded_keys = np.union1d(self.loaded_keys, keys)
+            self.build()
+            return
+
+        if self.has_members_types is None:
+            cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = 'members_types';", (self.pgsql_tablename,))
+            self.has_members_types = cur.fetchone() is not None
+        members_types = sql.SQL("members_types" if self.has_members_types else "NULL")
+
+        for osm_type, code in list(TYPE_CODES.items()) + [(None, ANY_TYPE)]:
+            osm_ids = keys[keys % 4 == code] // 4
+            if osm_type is None:
+                type_filter = sql.SQL("osm_type IN ('node', 'way', 'relation')")
+            else:
+                type_filter = sql.SQL("osm_type = {}").format(sql.Literal(osm_type))
+
+            for i in range(0, len(osm_ids), QUERY_CHUNK_SIZE):
+                cur.execute(sql.SQL("""SELECT osm_id * 4 + {}, osm_type, version, id, CAST(EXTRACT(EPOCH FROM "timestamp") AS bigint), lat, lon, members_refs, {}
+FROM {} WHERE {} AND osm_id = ANY(%s);""").format(sql.Literal(code), members_types, sql.Identifier(self.pgsql_tablename), type_filter),
+                            (osm_ids[i:i + QUERY_CHUNK_SIZE].tolist(),))
+                self.rows.extend(cur.fetchall())
+                self.nb_queries += 1
+
+        self.loaded_keys = np.union1d(self.loaded_keys, keys)
+        self.build()
+
+    def load_tags(self, cur, keys):
+        """
+        loads the 'visible' flag and the tags ('other_tags') of all the versions of the input features,
+        already loaded by 'load' (only the features themselves need them, not their members: see 'sequence_encoder.py')
+        
+        N.B.: to be called once all the versions are loaded, 'build' forgets them
+
+        Parameters
+        ----------
+        cur : psycopg2 cursor or HistoryStore
+            DATABASE CURSOR, OR LOCAL HISTORY STORE (SEE 'history_store.py').
+        keys : numpy array
+            LOOKUP KEYS (SEE 'lookup_keys').
+
+        Returns
+        -------
+        None.
+
+        """
+        keys = np.unique(np.asarray(keys, dtype=np.int64))
+        if isinstance(cur, HistoryStore):
+            rows = cur.tag_rows(keys)
+            self.nb_queries += 1
+        else:
+            rows = []
+            for osm_type, code in list(TYPE_CODES.items()) + [(None, ANY_TYPE)]:
+                osm_ids = keys[keys % 4 == code] // 4
+                if osm_type is None:
+                    type_filter = sql.SQL("osm_type IN ('node', 'way', 'relation')")
+                else:
+                    type_filter = sql.SQL("osm_type = {}").format(sql.Literal(osm_type))
+
+                for i in range(0, len(osm_ids), QUERY_CHUNK_SIZE):
+                    cur.execute(sql.SQL("""SELECT osm_id * 4 + {}, version, id, visible, other_tags
+FROM {} WHERE {} AND osm_id = ANY(%s);""").format(sql.Literal(code), sql.Identifier(self.pgsql_tablename), type_filter),
+                                (osm_ids[i:i + QUERY_CHUNK_SIZE].tolist(),))
+                    rows.extend(cur.fetchall())
+                    self.nb_queries += 1
+
+        # same order as the versions of the store: the rows of a feature are its segment
+        rows.sort(key=lambda row: (row[0], row[1], row[2]))
+        first, count = self.segments(keys)
+        if count.sum() != len(rows):
+            raise ValueError("the versions of the features have changed since they were loaded")
+        positions = np.concatenate([np.arange(f, f + c) for f, c in zip(first, count) if c > 0] or [np.empty(0, dtype=np.int64)])
+        self.visible[positions] = [row[3] is not False for row in rows]
+        self.tags[positions] = [row[4] for row in rows]
+
+    def build(self):
+        # Sorting the versions and (re)building the columns and the search structures
+        rows = sorted(self.rows, key=lambda row: (row[0], row[2], row[3]))
+        self.rows = rows
+        n = len(rows)
+
+        self.key = np.array([row[0] for row in rows], dtype=np.int64)
+        self.osm_type = np.array([row[1] for row in rows], dtype=object)
+        self.row_id = np.array([row[3] for row in rows], dtype=np.int64) # primary key of the version in the history table
+        self.version = np.array([row[2] if row[2] is not None else -1 for row in rows], dtype=np.int64)
+        self.timestamp = np.array([row[4] if row[4] is not None else 0 for row in rows], dtype=np.int64)
+        self.has_timestamp = np.array([row[4] is not None for row in rows], dtype=bool)
+        self.lat = np.array([row[5] for row in rows], dtype=np.float64) # None -> NaN
+        self.lon = np.array([row[6] for row in rows], dtype=np.float64)
+        # 'visible' flag and tags (hstore text) of the versions, only filled by 'load_tags'
+        self.visible = np.ones(n, dtype=bool)
+        self.tags = np.full(n, None, dtype=object)
+
+        # Member references in CSR layout: refs of version k = ref_values[ref_offset[k]:ref_offset[k] + ref_count[k]]
+        # (ref_count = -1 when there are no references at all, i.e. 'members_refs' is NULL)
+        self.ref_count = np.array([len(row[7]) if row[7] is not None else -1 for row in rows], dtype=np.int64)
+        self.ref_offset = np.zeros(n, dtype=np.int64)
+        if n > 0:
+            self.ref_offset[1:] = np.cumsum(np.maximum(self.ref_count, 0))[:-1]
+        self.ref_values = np.array([ref for row in rows if row[7] is not None for ref in row[7]], dtype=np.int64)
+        # type code of every reference (ANY_TYPE when the member types are unknown)
+        self.ref_types = np.array([TYPE_CODES.get(member_type, ANY_TYPE) if row[8] is not None else ANY_TYPE
+                                   for row in rows if row[7] is not None
+                                   for member_type in (row[8] if row[8] is not None else row[7])], dtype=np.int64)
+
+        # Segments of versions per lookup key
+        self.unique_keys, self.segment_start, self.segment_count = np.unique(self.key, return_index=True, return_counts=True)
+        self.key_rank = np.repeat(np.arange(len(self.unique_keys), dtype=np.int64), self.segment_count)
+
+        # Sorted composite keys (lookup key rank, timestamp) for resolving references: ties on the timestamp are
+        # sorted in reverse version order, so that the last key found is the first version (see 'idxmax')
+        self.timestamp_min = self.timestamp[self.has_timestamp].min() if self.has_timestamp.any() else 0
+        offset = np.where(self.has_timestamp, self.timestamp - self.timestamp_min, NULL_TIMESTAMP_OFFSET)
+        time_keys = self.key_rank * TIME_KEY_STRIDE + offset
+        self.time_key_order = np.lexsort((-np.arange(n), time_keys))
+        self.sorted_time_keys = time_keys[self.time_key_order]
+
+    def references(self, k):
+        # member references of the version k (empty array if NULL)
+        return self.ref_values[self.ref_offset[k]:self.ref_offset[k] + max(self.ref_count[k], 0)]
+
+    def reference_keys(self, k):
+        # lookup keys of the members of the version k (with their types when known)
+        start, end = self.ref_offset[k], self.ref_offset[k] + max(self.ref_count[k], 0)
+        return self.ref_values[start:end] * 4 + self.ref_types[start:end]
+
+    def segments(self, keys):
+        """
+        returns the (first version index, number of versions) of each input feature
+
+        Parameters
+        ----------
+        keys : numpy array
+            LOOKUP KEYS.
+
+        Returns
+        -------
+        (numpy array, numpy array)
+            FIRST VERSION INDEX (-1 IF NOT FOUND), NUMBER OF VERSIONS (0 IF NOT FOUND).
+
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(self.unique_keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64), np.zeros(len(keys), dtype=np.int64)
+        rank = np.minimum(np.searchsorted(self.unique_keys, keys), len(self.unique_keys) - 1)
+        found = self.unique_keys[rank] == keys
+        return np.where(found, self.segment_start[rank], -1), np.where(found, self.segment_count[rank], 0)
+
+    def resolve(self, member_keys, feature_timestamps, feature_has_timestamp=None):
+        """
+        vectorized 'geometry_references_resolver': for each (member, timestamp) pair,
+        returns the index of the latest member version older than (or as old as) the timestamp
+
+        Parameters
+        ----------
+        member_keys : numpy array
+            LOOKUP KEYS OF THE REFERENCED MEMBERS.
+        feature_timestamps : numpy array
+            TIMESTAMPS (SECONDS) OF THE WAYS/RELATIONS THE MEMBERS ARE REFERENCED TO.
+        feature_has_timestamp : numpy array, optional
+            FALSE WHERE THE WAY/RELATION TIMESTAMP IS NULL.
+
+        Returns
+        -------
+        numpy array
+            VERSION INDEX, OR -1 IF THE MEMBER IS MISSING OR YOUNGER THAN THE TIMESTAMP (ERROR CODE 2).
+
+        """
+        member_keys = np.asarray(member_keys, dtype=np.int64)
+        if len(self.unique_keys) == 0 or len(member_keys) == 0:
+            return np.full(len(member_keys), -1, dtype=np.int64)
+
+        rank = np.minimum(np.searchsorted(self.unique_keys, member_keys), len(self.unique_keys) - 1)
+        found = self.unique_keys[rank] == member_keys
+        if feature_has_timestamp is not None:
+            found &= feature_has_timestamp
+
+        offset = np.clip(np.asarray(feature_timestamps, dtype=np.int64) - self.timestamp_min, -1, NULL_TIMESTAMP_OFFSET - 1)
+        position = np.searchsorted(self.sorted_time_keys, rank * TIME_KEY_STRIDE + offset, side='right') - 1
+        candidate = self.time_key_order[np.maximum(position, 0)]
+
+        # the version found has to belong to the same member (and not to the previous key)
+        found &= (position >= 0) & (self.key_rank[candidate] == rank)
+        return np.where(found, candidate, -1)
+
+    def coordinates(self, node_ids, feature_timestamps, feature_has_timestamp=None):
+        # same interface as 'NodeCoordinateIndex.coordinates' (see 'node_index.py')
+        k = self.resolve(lookup_keys(node_ids, 'node'), feature_timestamps, feature_has_timestamp)
+        found = k >= 0
+        return found, np.where(found, self.lat[k], np.nan), np.where(found, self.lon[k], np.nan)
+
+
+
+def nodes_unchanged(lat1, lon1, lat2, lon2):
+    """
+    vectorized node comparison of 'geometry_modification': True when the coordinates are equal
+    or when the geometry has been erased in the current version
+
+    Parameters
+    ----------
+    lat1, lon1 : numpy arrays
+        COORDINATES OF THE PREVIOUS VERSIONS.
+    lat2, lon2 : numpy arrays
+        COORDINATES OF THE CURRENT VERSIONS.
+
+    Returns
+    -------
+    numpy array (boolean)
+
+    """
+    return ((lat1 == lat2) & (lon1 == lon2)) | (np.isnan(lat2) & np.isnan(lon2))
+
+
+
+def way_coordinates(store, k, nodes=None):
+    """
+    resolves all the nodes of way versions at once, each one at the timestamp of its way version
+
+    Parameters
+    ----------
+    store : VersionStore
+        LOADED VERSIONS.
+    k : numpy array
+        INDEXES OF THE WAY VERSIONS.
+    nodes : NodeCoordinateIndex, optional
+        WHERE THE REFERENCED NODES ARE RESOLVED (DEFAULT: THE STORE ITSELF, WHICH THEN HAS TO HOLD THEM).
+
+    Returns
+    -------
+    tuple of numpy arrays
+        (NUMBER OF NODES OF EACH VERSION (0 IF 'members_refs' IS NULL), POSITION IN k OF EACH NODE,
+         FOUND, LAT, LON OF EACH NODE (NaN WHERE NOT FOUND)), VERSION AFTER VERSION.
+
+    """
+    k = np.asarray(k, dtype=np.int64)
+    counts = np.maximum(store.ref_count[k], 0)
+    version_of_ref = np.repeat(np.arange(len(k)), counts)
+    rank_in_version = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    refs = store.ref_values[np.repeat(store.ref_offset[k], counts) + rank_in_version]
+    if nodes is None:
+        nodes = store
+    found, lat, lon = nodes.coordinates(refs, np.repeat(store.timestamp[k], counts), np.repeat(store.has_timestamp[k], counts))
+    return counts, version_of_ref, found, lat, lon
+
+
+
+def way_modification_codes(store, k1, k2, nodes=None, fingerprints=None):
+    """
+    vectorized 'geometry_modification' for pairs of way versions:
+    0 (None) if no geometry modification, 1 if there has been one, 2 in case of error
+
+    Parameters
+    ----------
+    store : VersionStore
+        LOADED VERSIONS.
+    k1 : numpy array
+        INDEXES OF THE PREVIOUS VERSIONS.
+    k2 : numpy array
+        INDEXES OF THE CURRENT VERSIONS.
+    nodes : NodeCoordinateIndex, optional
+        WHERE THE REFERENCED NODES ARE RESOLVED (DEFAULT: THE STORE ITSELF, WHICH THEN HAS TO HOLD THEM).
+    fingerprints : GeometryFingerprints, optional
+        PRECOMPUTED WAY FINGERPRINTS (SEE 'geometry_fingerprint.py'): THE PAIRS THEY DECIDE ARE NOT COMPARED NODE BY NODE.
+
+    Returns
+    -------
+    numpy array (int)
+        ONE CODE PER VERSION PAIR.
+
+    """
+    k1 = np.asarray(k1, dtype=np.int64)
+    k2 = np.asarray(k2, dtype=np.int64)
+    c1, c2 = store.ref_count[k1], store.ref_count[k2]
+
+    codes = np.zeros(len(k1), dtype=np.int64)
+    erased = c2 < 0                                 # geometry erased: None
+    no_refs = ~erased & (c1 < 0)                    # no referenced members: DATA error
+    codes[no_refs] = 2
+    codes[~erased & ~no_refs & (c1 != c2)] = 1      # different numbers of nodes
+
+    # Remaining pairs: node-by-node comparison, all the references being resolved at once
+    pairs = np.nonzero(~erased & ~no_refs & (c1 == c2) & (c1 > 0))[0]
+    if fingerprints is not None and len(pairs) > 0:
+        # one hash comparison for the pairs whose versions both have a comparable fingerprint
+        fingerprint_codes = fingerprints.codes(store.row_id[k1[pairs]], store.row_id[k2[pairs]], store.key[k1[pairs]] // 4,
+                                               store.version[k1[pairs]], store.version[k2[pairs]])
+        decided = fingerprint_codes >= 0
+        codes[pairs[decided]] = fingerprint_codes[decided]
+        metrics.count('way_fingerprint_hits', int(decided.sum()))
+        pairs = pairs[~decided]
+    if len(pairs) == 0:
+        return codes
+
+    counts = c1[pairs]
+    pair_of_ref = np.repeat(np.arange(len(pairs)), counts)
+    rank_in_pair = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    refs1 = store.ref_values[np.repeat(store.ref_offset[k1[pairs]], counts) + rank_in_pair]
+    refs2 = store.ref_values[np.repeat(store.ref_offset[k2[pairs]], counts) + rank_in_pair]
+    if nodes is None:
+        nodes = store
+    found1, lat1, lon1 = nodes.coordinates(refs1, np.repeat(store.timestamp[k1[pairs]], counts), np.repeat(store.has_timestamp[k1[pairs]], counts))
+    found2, lat2, lon2 = nodes.coordinates(refs2, np.repeat(store.timestamp[k2[pairs]], counts), np.repeat(store.has_timestamp[k2[pairs]], counts))
+
+    status = np.where(~found1 | ~found2, 2, np.where(nodes_unchanged(lat1, lon1, lat2, lon2), 0, 1))
+
+    # The code of a pair is the status of its first node that is not unchanged (nodes are scanned in order)
+    nonzero = np.nonzero(status)[0]
+    first_pairs, first_index = np.unique(pair_of_ref[nonzero], return_index=True)
+    codes[pairs[first_pairs]] = status[nonzero[first_index]]
+    return codes
+
+
+
+class RelationResolver:
+    """
+    'geometry_modification' of relation version pairs, on loaded versions:
+        - the codes of the member pairs (resolved member versions) are memoized, so that the member ways
+          shared by several relations of the chunk are compared only once,
+        - all the node and way members of a relation pair are compared at once (vectorized, one node lookup per relation pair),
+        - relations are followed with an explicit stack instead of Python recursion (large, deeply nested relations),
+        - cyclic relations (a relation pair reached again while being evaluated) get the code CYCLE instead of an endless recursion.
+    As in 'geometry_modification', the members are scanned in order and the first decisive one wins,
+    so that a member which would not have been reached is never followed.
+    """
+    def __init__(self, store, nodes=None, fingerprints=None):
+        self.store = store
+        self.nodes = nodes # where the nodes of the ways are resolved (default: the store itself)
+        self.fingerprints = fingerprints # precomputed way fingerprints, if any (see 'way_modification_codes')
+        self.codes = {} # (k1, k2) -> code of the way/relation version pairs evaluated so far
+        self.hits = 0
+        self.cycles = 0
+
+    def way_codes(self, k1, k2):
+        # codes of pairs of way versions, the ones not memoized yet being computed at once
+        pairs = list(zip(k1.tolist(), k2.tolist()))
+        missing = [i for i, pair in enumerate(pairs) if pair not in self.codes]
+        if missing:
+            for i, code in zip(missing, way_modification_codes(self.store, k1[missing], k2[missing], self.nodes, self.fingerprints).tolist()):
+                self.codes[pairs[i]] = code
+        self.hits += len(pairs) - len(missing)
+        return [self.codes[pair] for pair in pairs]
+
+    def frame(self, k1, k2):
+        """
+        starts the evaluation of a relation version pair: its code if no member has to be looked at,
+        or its evaluation frame (members resolved, node and way members already compared)
+
+        Parameters
+        ----------
+        k1 : int
+            INDEX OF THE PREVIOUS VERSION.
+        k2 : int
+            INDEX OF THE CURRENT VERSION.
+
+        Returns
+        -------
+        int or list
+            CODE, OR [k1, k2, MEMBER VERSIONS 1, MEMBER VERSIONS 2, MEMBER TYPES, MEMBER STATUS, NEXT MEMBER]
+            WITH MEMBER STATUS: 2 (MISSING), 1 (DIFFERENT TYPES OR MODIFIED), 0 (UNCHANGED), -1 (RELATION, TO BE FOLLOWED).
+
+        """
+        store = self.store
+        c1, c2 = store.ref_count[k1], store.ref_count[k2]
+        if c2 < 0:
+            return 0
+        if c1 < 0:
+            return 2
+        if c1 != c2:
+            return 1
+
+        m1 = store.resolve(store.reference_keys(k1), np.full(c1, store.timestamp[k1]), np.full(c1, store.has_timestamp[k1]))
+        m2 = store.resolve(store.reference_keys(k2), np.full(c2, store.timestamp[k2]), np.full(c2, store.has_timestamp[k2]))
+        found = (m1 >= 0) & (m2 >= 0)
+        types1, types2 = store.osm_type[np.maximum(m1, 0)], store.osm_type[np.maximum(m2, 0)]
+
+        status = np.where(found, np.where(types1 != types2, 1, 0), 2)
+        nodes = found & (types1 == types2) & (types1 == 'node')
+        status[nodes] = np.where(nodes_unchanged(store.lat[m1[nodes]], store.lon[m1[nodes]], store.lat[m2[nodes]], store.lon[m2[nodes]]), 0, 1)
+        ways = found & (types1 == types2) & (types1 == 'way')
+        # N.B.: as in 'geometry_modification', an error in a member counts as a modification
+        status[ways] = np.minimum(self.way_codes(m1[ways], m2[ways]), 1)
+        status[found & (types1 == types2) & (types1 == 'relation')] = -1
+        return [k1, k2, m1, m2, types1, status, 0]
+
+    def code(self, k1, k2):
+        """
+        'geometry_modification' for a pair of relation versions
+
+        Parameters
+        ----------
+        k1 : int
+            INDEX OF THE PREVIOUS VERSION.
+        k2 : int
+            INDEX OF THE CURRENT VERSION.
+
+        Returns
+        -------
+        int
+            0 (None), 1, 2, or CYCLE (cyclic relations).
+
+        """
+        root = (int(k1), int(k2))
+        if root in self.codes:
+            self.hits += 1
+            return self.codes[root]
+
+        stack = [] # frames of the relation pairs being evaluated, the innermost last
+        in_progress = set()
+        pending = root # relation pair to start evaluating
+        result = None # code of the last relation pair evaluated, for its parent frame
+
+        while True:
+            if pending is not None:
+                frame = self.frame(*pending)
+                if isinstance(frame, list):
+                    stack.append(frame)
+                    in_progress.add(pending)
+                    pending = None
+                else:
+                    self.codes[pending] = result = frame
+                    pending = None
+                    if not stack:
+                        return result
+
+            frame = stack[-1]
+            m1, m2, status, i = frame[2], frame[3], frame[5], frame[6]
+            code = None
+            if result is not None:
+                # the relation member i has just been evaluated
+                code = CYCLE if result == CYCLE else (1 if result != 0 else None)
+                i += 1
+                result = None
+
+            # Scanning the members in order, until the first decisive one
+            while code is None and i < len(status):
+                if status[i] != -1:
+                    code = status[i] if status[i] != 0 else None
+                    i += 1
+                    continue
+                member = (int(m1[i]), int(m2[i]))
+                if member in self.codes:
+                    self.hits += 1
+                    member_code = self.codes[member]
+                    code = CYCLE if member_code == CYCLE else (1 if member_code != 0 else None)
+                    i += 1
+                elif member in in_progress:
+                    # the relation leads back to itself
+                    self.cycles += 1
+                    code = CYCLE
+                else:
+                    pending = member
+                    break
+            frame[6] = i
+            if pending is not None:
+                continue
+
+            # Relation pair evaluated: its code is memoized and handed over to its parent
+            pair = (int(frame[0]), int(frame[1]))
+            self.codes[pair] = result = code if code is not None else 0
+            in_progress.discard(pair)
+            stack.pop()
+            if not stack:
+                return result
+
+
+
+def modification_code(store, k1, k2, osm_type, nodes=None, resolver=None):
+    """
+    'geometry_modification' evaluated on loaded versions, for a single version pair
+    (used for relations, through 'RelationResolver'; nodes and ways go through the vectorized functions)
+
+    Parameters
+    ----------
+    store : VersionStore
+        LOADED VERSIONS.
+    k1 : int
+        INDEX OF THE PREVIOUS VERSION.
+    k2 : int
+        INDEX OF THE CURRENT VERSION.
+    osm_type : string
+        FEATURE TYPE.
+    nodes : NodeCoordinateIndex, optional
+        WHERE THE NODES OF THE WAYS ARE RESOLVED (DEFAULT: THE STORE ITSELF).
+    resolver : RelationResolver, optional
+        RESOLVER (AND ITS MEMOIZED CODES) SHARED BY THE PAIRS OF A CHUNK.
+
+    Returns
+    -------
+    int
+        0 (None), 1 or 2, see 'geometry_modification' (cyclic relations: 2, i.e. an error).
+
+    """
+    if osm_type == 'node':
+        return 0 if nodes_unchanged(store.lat[k1], store.lon[k1], store.lat[k2], store.lon[k2]) else 1
+
+    if osm_type == 'way':
+        return way_modification_codes(store, [k1], [k2], nodes, resolver.fingerprints if resolver is not None else None)[0]
+
+    # So frow now on, only relations are considered
+    if resolver is None:
+        resolver = RelationResolver(store, nodes)
+    code = resolver.code(k1, k2)
+    return 2 if code == CYCLE else code
+
+
+
+def load_references(cur, store, keys, way_nodes=True):
+    """
+    loads the versions of the input features and, depth after depth, of all the members
+    that 'geometry_modification' may need (one set of queries per reference depth)
+
+    Parameters
+    ----------
+    cur : psycopg2 cursor or HistoryStore
+        DATABASE CURSOR, OR LOCAL HISTORY STORE.
+    store : VersionStore
+        STORE TO FILL.
+    keys : numpy array
+        LOOKUP KEYS OF THE FEATURES.
+    way_nodes : boolean
+        IF FALSE, THE NODES REFERENCED BY WAYS ARE NOT LOADED (RESOLVED WITH A 'NodeCoordinateIndex' INSTEAD).
+
+    Returns
+    -------
+    None.
+
+    """
+    empty = np.empty(0, dtype=np.int64)
+
+    # 'expanded' features have their references followed; the others are only compared as nodes
+    to_expand = np.unique(np.asarray(keys, dtype=np.int64))
+    to_load = to_expand
+    expanded = empty
+    depth = 0
+
+    while len(to_load) > 0:
+        store.load(cur, to_load)
+        expanded = np.union1d(expanded, to_expand)
+
+        first, count = store.segments(to_expand)
+        rows = np.concatenate([np.arange(s, s + c) for s, c in zip(first, count) if c > 0] or [empty])
+        row_types = store.osm_type[rows]
+        # all the versions of an input feature are compared with the type of its first version (lookups by id only
+        # may mix OSM types), while the versions of the members are compared with their own type
+        feature_types = np.repeat(store.osm_type[first[count > 0]], count[count > 0]) if depth == 0 else row_types
+        depth += 1
+
+        # members of relations may be ways or relations themselves: their own references are needed,
+        # while the references of the ways are nodes
+        as_relation = rows[(row_types == 'relation') | (feature_types == 'relation')]
+        as_way = rows[(row_types != 'relation') | (feature_types == 'way')]
+        next_expand = np.unique(np.concatenate([store.reference_keys(k) for k in as_relation] or [empty]))
+        next_plain = empty
+        if way_nodes:
+            next_plain = np.unique(np.concatenate([store.references(k) for k in as_way] or [empty]))
+            next_plain = lookup_keys(next_plain, 'node')
+
+        to_expand = np.setdiff1d(next_expand, expanded)
+        to_load = np.union1d(to_expand, next_plain)
+
+
+
+def batch_nb_geometry_modification(cur, osm_ids, pgsql_tablename='history', chunk_size=20000, node_index=None, osm_types=None,
+                                   progress=True, fingerprints=None):
+    """
+    batch version of 'nb_geometry_modification', for a list of features:
+    returns the number of geometry modifications of each feature (None in case of error)
+
+    Parameters
+    ----------
+    cur : psycopg2 cursor or HistoryStore
+        DATABASE CURSOR, OR LOCAL HISTORY STORE (SEE 'history_store.py').
+    osm_ids : int list
+        OSM FEATURE IDS.
+    pgsql_tablename : string
+        HISTORY TABLE NAME.
+    chunk_size : int
+        NUMBER OF FEATURES PROCESSED AT ONCE (MEMORY BOUND).
+    node_index : NodeCoordinateIndex, optional
+        PREBUILT NODE INDEX (SEE 'node_index.py'): THE NODES OF THE WAYS ARE THEN RESOLVED FROM IT
+        INSTEAD OF BEING LOADED FOR EACH CHUNK.
+    osm_types : string list, optional
+        OSM TYPE OF EACH FEATURE (None: LOOKUP BY ID ONLY, AS 'nb_geometry_modification(osm_id)').
+    progress : boolean
+        DISPLAY A PROGRESS BAR OVER THE CHUNKS.
+    fingerprints : GeometryFingerprints, optional
+        PRECOMPUTED WAY FINGERPRINTS (SEE 'geometry_fingerprint.py').
+
+    Returns
+    -------
+    list
+        NUMBER OF GEOMETRY MODIFICATIONS PER FEATURE (int or None), IN THE INPUT ORDER.
+
+    """
+    keys = lookup_keys(osm_ids, osm_types)
+    results = []
+
+    for i in tqdm(range(0, len(keys), chunk_size), disable=not progress):
+        chunk = keys[i:i + chunk_size]
+
+        store = VersionStore(pgsql_tablename)
+        with metrics.timer('batch_load'):
+            load_references(cur, store, chunk, way_nodes=node_index is None)
+        with metrics.timer('batch_compute'):
+            results.extend(chunk_nb_geometry_modification(store, chunk, node_index, fingerprints))
+
+    return results
+
+
+
+def chunk_pair_codes(store, keys, nodes=None, fingerprints=None):
+    """
+    'geometry_modification' codes of all the consecutive version pairs of a chunk of features whose versions
+    (and members) are loaded, feature after feature (as in 'sequence_modifications')
+
+    Parameters
+    ----------
+    store : VersionStore
+        LOADED VERSIONS.
+    keys : numpy array
+        LOOKUP KEYS OF THE FEATURES.
+    nodes : NodeCoordinateIndex, optional
+        WHERE THE NODES OF THE WAYS ARE RESOLVED (DEFAULT: THE STORE ITSELF).
+    fingerprints : GeometryFingerprints, optional
+        PRECOMPUTED WAY FINGERPRINTS (SEE 'geometry_fingerprint.py').
+
+    Returns
+    -------
+    tuple of numpy arrays
+        (NUMBER OF VERSIONS PER FEATURE, FEATURE OF EACH PAIR, PREVIOUS AND CURRENT VERSION INDEXES OF EACH PAIR,
+         CODE OF EACH PAIR: 0 (None), 1 OR 2).
+
+    """
+    first, count = store.segments(keys)
+
+    # All the consecutive version pairs of all the features, with the type of the feature's first version
+    nb_pairs = np.maximum(count - 1, 0)
+    feature_of_pair = np.repeat(np.arange(len(keys)), nb_pairs)
+    k1 = np.repeat(first, nb_pairs) + np.arange(nb_pairs.sum()) - np.repeat(np.cumsum(nb_pairs) - nb_pairs, nb_pairs)
+    k2 = k1 + 1
+    feature_type = store.osm_type[np.repeat(first, nb_pairs)]
+
+    codes = np.zeros(len(k1), dtype=np.int64)
+    is_node = feature_type == 'node'
+    is_way = feature_type == 'way'
+    n1, n2 = k1[is_node], k2[is_node]
+    codes[is_node] = np.where(nodes_unchanged(store.lat[n1], store.lon[n1], store.lat[n2], store.lon[n2]), 0, 1)
+    codes[is_way] = way_modification_codes(store, k1[is_way], k2[is_way], nodes, fingerprints)
+    resolver = RelationResolver(store, nodes, fingerprints) # member codes memoized for all the relations of the chunk
+    for p in np.nonzero(~is_node & ~is_way)[0]:
+        codes[p] = modification_code(store, k1[p], k2[p], feature_type[p], nodes, resolver)
+    metrics.count('relation_member_memo_hits', resolver.hits)
+    metrics.count('relation_cycles', resolver.cycles)
+    return count, feature_of_pair, k1, k2, codes
+
+
+
+def chunk_nb_geometry_modification(store, keys, nodes=None, fingerprints=None):
+    """
+    'nb_geometry_modification' for a chunk of features whose versions (and members) are loaded
+
+    Parameters
+    ----------
+    store : VersionStore
+        LOADED VERSIONS.
+    keys : numpy array
+        LOOKUP KEYS OF THE FEATURES.
+    nodes : NodeCoordinateIndex, optional
+        WHERE THE NODES OF THE WAYS ARE RESOLVED (DEFAULT: THE STORE ITSELF).
+    fingerprints : GeometryFingerprints, optional
+        PRECOMPUTED WAY FINGERPRINTS (SEE 'geometry_fingerprint.py').
+
+    Returns
+    -------
+    list
+        NUMBER OF GEOMETRY MODIFICATIONS PER FEATURE (int or None).
+
+    """
+    count, feature_of_pair, k1, k2, codes = chunk_pair_codes(store, keys, nodes, fingerprints)
+
+    nb_modifications = np.bincount(feature_of_pair, weights=(codes == 1), minlength=len(keys))
+    nb_errors = np.bincount(feature_of_pair, weights=(codes == 2), minlength=len(keys))
+
+    # features missing from the history ('[2]' sequence) or with an error in their sequence: None
+    return [None if count[j] < 1 or nb_errors[j] > 0 else int(nb_modifications[j]) for j in range(len(keys))]
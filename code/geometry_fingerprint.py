@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+                    WAY GEOMETRY FINGERPRINTS
+
+
+------------------------------------------------------------------------------
+"""
+
+"""
+Per-version geometry fingerprints of the ways: a 64-bit hash of the coordinate sequence of the way version,
+its nodes being resolved once (as in 'geometry_modification': latest node version older than the way version).
+They are computed in one precomputation pass over the history and stored in a side table
+('geometry_fingerprints': primary key of the way version in the history table, osm_id, version, number of nodes, fingerprint).
+
+Comparing two way versions is then a single hash comparison instead of resolving their nodes one by one,
+with exactly the results of 'geometry_modification' (up to a 2^-64 chance of hash collision):
+    - both versions have a fingerprint: 1 if the numbers of nodes or the fingerprints differ, None otherwise,
+    - a version has a missing node, a node younger than the way, or an erased node, has no fingerprint (NULL):
+      the rules of 'geometry_modification' depend on the node order there (first node found different or missing),
+      so the nodes of the pair are still compared one by one ('UNDECIDED'),
+    - way versions not in the side table (e.g. imported since the last pass) are 'UNDECIDED' too. The versions are
+      looked up by primary key, osm_id and version: after a re-import of the history table (primary keys restarting
+      in file order), a stored row whose id now belongs to another version is ignored until the next pass, which
+      deletes it and recomputes the way.
+
+The stored fingerprints also give the repeated and reverted geometries of the history with a single query
+(see 'reverted_geometries' and 'repeated_geometries').
+
+[Quick start]:
+    build_geometry_fingerprints(conn, 'history')                  # precomputation pass (only the new way versions when run again)
+    fingerprints = GeometryFingerprints.from_table(conn)          # loaded in memory...
+    fingerprints.save('geometry_fingerprints')                    # ... saved, and reloaded memory-mapped
+    batch_nb_geometry_modification(cur, osm_ids, osm_types=osm_types, fingerprints=fingerprints)
+"""
+
+
+
+### Librairies import
+
+import os
+from tqdm import tqdm   # for displaying a progress bar on loops
+
+from psycopg2 import sql    # for generating dynamically SQL queries (for choosing dynamically a table name)
+import numpy as np
+import pandas as pd
+
+from geometry_batch_engine import VersionStore, lookup_keys, load_references, way_coordinates    # batch loading of the way versions and of their nodes
+from pgsql_copy import copy_rows, copy_value    # bulk insertion with COPY (see 'pgsql_copy.py')
+from metrics import metrics    # 'batch_load' and 'fingerprint' stage timers (see 'metrics.py')
+
+
+
+### Code
+
+
+FINGERPRINTS_TABLENAME = 'geometry_fingerprints'
+
+# Code of a pair of way versions the fingerprints cannot decide: the nodes have to be compared one by one
+UNDECIDED = -1
+
+FINGERPRINT_ARRAYS = ['ids', 'osm_ids', 'versions', 'nb_nodes', 'fingerprint', 'comparable']
+
+# Constants of the splitmix64 finalizer (see 'mix64')
+_MIX1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX2 = np.uint64(0x94d049bb133111eb)
+_GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+
+
+
+def mix64(x):
+    # splitmix64 finalizer: scrambles the bits of uint64 values (NumPy integer arrays wrap around on overflow)
+    x = x ^ (x >> np.uint64(30))
+    x = x * _MIX1
+    x = x ^ (x >> np.uint64(27))
+    x = x * _MIX2
+    return x ^ (x >> np.uint64(31))
+
+
+
+def sequence_fingerprints(lat, lon, counts):
+    """
+    order-sensitive 64-bit hashes of coordinate sequences: every node is hashed with its position
+    in the sequence, then the hashes of the nodes of a sequence are summed (modulo 2^64)
+
+    Parameters
+    ----------
+    lat, lon : numpy arrays (float64)
+        COORDINATES OF ALL THE SEQUENCES, SEQUENCE AFTER SEQUENCE.
+    counts : numpy array
+        NUMBER OF NODES OF EACH SEQUENCE.
+
+    Returns
+    -------
+    numpy array (int64)
+        ONE FINGERPRINT PER SEQUENCE (0 FOR AN EMPTY SEQUENCE).
+
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    position = (np.arange(counts.sum()) - np.repeat(starts, counts)).astype(np.uint64)
+
+    # (+ 0.0: -0.0 and 0.0 are equal coordinates, they must have the same bits)
+    lat_bits = np.ascontiguousarray(np.asarray(lat, dtype=np.float64) + 0.0).view(np.uint64)
+    lon_bits = np.ascontiguousarray(np.asarray(lon, dtype=np.float64) + 0.0).view(np.uint64)
+    node_hashes = mix64(lat_bits ^ mix64(lon_bits ^ mix64(position + _GOLDEN)))
+
+    fingerprints = np.zeros(len(counts), dtype=np.uint64)
+    nonempty = counts > 0
+    if nonempty.any():
+        fingerprints[nonempty] = np.add.reduceat(node_hashes, starts[nonempty])
+    return fingerprints.view(np.int64)
+
+
+
+def version_fingerprints(store, k, nodes=None):
+    """
+    fingerprints of way versions loaded in a store (see module description)
+
+    Parameters
+    ----------
+    store : VersionStore
+        LOADED VERSIONS (WITH THEIR NODES, UNLESS 'nodes' IS GIVEN).
+    k : numpy array
+        INDEXES OF THE WAY VERSIONS.
+    nodes : NodeCoordinateIndex, optional
+        WHERE THE NODES ARE RESOLVED (DEFAULT: THE STORE ITSELF).
+
+    Returns
+    -------
+    (numpy array, numpy array, numpy array)
+        NUMBER OF NODES (-1 IF 'members_refs' IS NULL), FINGERPRINT, COMPARABLE (FALSE: NO FINGERPRINT).
+
+    """
+    k = np.asarray(k, dtype=np.int64)
+    nb_nodes = store.ref_count[k]
+    # All the nodes of all the versions resolved at once, at the timestamp of their way version
+    counts, version_of_ref, found, lat, lon = way_coordinates(store, k, nodes)
+
+    # versions with a missing, younger or erased node: no fingerprint (see module description)
+    resolved = found & ~np.isnan(lat) & ~np.isnan(lon)
+    nb_unresolved = np.bincount(version_of_ref, weights=~resolved, minlength=len(k))
+    comparable = (nb_nodes >= 0) & (nb_unresolved == 0)
+
+    fingerprint = np.where(comparable, sequence_fingerprints(lat, lon, counts), 0)
+    return nb_nodes, fingerprint, comparable
+
+
+
+class GeometryFingerprints:
+    """
+    Fingerprints of the way versions, by primary key of the version in the history table:
+    the version ids[r] (version versions[r] of the way osm_ids[r]) has nb_nodes[r] nodes and the fingerprint
+    fingerprint[r] if comparable[r]
+    """
+    def __init__(self, ids, osm_ids, versions, nb_nodes, fingerprint, comparable):
+        self.ids = ids
+        self.osm_ids = osm_ids
+        self.versions = versions
+        self.nb_nodes = nb_nodes
+        self.fingerprint = fingerprint
+        self.comparable = comparable
+
+    @classmethod
+    def from_arrays(cls, ids, osm_ids, versions, nb_nodes, fingerprint, comparable):
+        # (sorted by primary key for the lookups)
+        order = np.argsort(ids, kind='stable')
+        return cls(ids[order], osm_ids[order], versions[order], nb_nodes[order], fingerprint[order], comparable[order])
+
+    @classmethod
+    def from_table(cls, conn, fingerprint_tablename=FINGERPRINTS_TABLENAME, itersize=1000000):
+        """
+        loads all the fingerprints of the side table (streamed with a server-side cursor)
+
+        Parameters
+        ----------
+        conn : psycopg2 connection
+            DATABASE CONNECTION.
+        fingerprint_tablename : string
+            FINGERPRINT TABLE NAME.
+        itersize : int
+            NUMBER OF ROWS FETCHED AT ONCE.
+
+        Returns
+        -------
+        GeometryFingerprints
+
+        """
+        cur = conn.cursor(name='fingerprint_loader')
+        cur.execute(sql.SQL("SELECT id, osm_id, version, COALESCE(nb_nodes, -1), COALESCE(fingerprint, 0), fingerprint IS NOT NULL FROM {} ORDER BY id;")
+                    .format(sql.Identifier(fingerprint_tablename)))
+
+        ids, osm_ids, versions, nb_nodes, fingerprint, comparable = [], [], [], [], [], []
+        while True:
+            rows = cur.fetchmany(itersize)
+            if not rows:
+                break
+            columns = list(zip(*rows))
+            ids.append(np.array(columns[0], dtype=np.int64))
+            osm_ids.append(np.array(columns[1], dtype=np.int64))
+            versions.append(np.array([version if version is not None else -1 for version in columns[2]], dtype=np.int64))
+            nb_nodes.append(np.array(columns[3], dtype=np.int64))
+            fingerprint.append(np.array(columns[4], dtype=np.int64))
+            comparable.append(np.array(columns[5], dtype=bool))
+        cur.close()
+
+        if not ids:
+            empty = np.empty(0, dtype=np.int64)
+            return cls(empty, empty, empty, empty, empty, np.empty(0, dtype=bool))
+        return cls(np.concatenate(ids), np.concatenate(osm_ids), np.concatenate(versions), np.concatenate(nb_nodes),
+                   np.concatenate(fingerprint), np.concatenate(comparable))
+
+    def save(self, directory):
+        """
+        saves the fingerprints as .npy files in a directory (created if needed)
+
+        Parameters
+        ----------
+        directory : string
+            OUTPUT DIRECTORY.
+
+        Returns
+        -------
+        None.
+
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in FINGERPRINT_ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), np.asarray(getattr(self, name)))
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        loads fingerprints saved with 'save', memory-mapped by default (see 'NodeCoordinateIndex.load')
+
+        Parameters
+        ----------
+        directory : string
+            FINGERPRINTS DIRECTORY.
+        mmap : boolean
+            MEMORY-MAP THE ARRAYS INSTEAD OF READING THEM.
+
+        Returns
+        -------
+        GeometryFingerprints
+
+        """
+        mmap_mode = 'r' if mmap else None
+        return cls(*[np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in FINGERPRINT_ARRAYS])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def positions(self, ids, osm_ids, versions):
+        # positions of way versions (primary keys) in the arrays, -1 if they have no fingerprint, or if the stored row
+        # is another version (primary key reused by a re-import of the history table since the last pass)
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        position = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        found = ((self.ids[position] == ids) & (self.osm_ids[position] == np.asarray(osm_ids, dtype=np.int64))
+                 & (self.versions[position] == np.asarray(versions, dtype=np.int64)) & self.comparable[position])
+        return np.where(found, position, -1)
+
+    def codes(self, ids1, ids2, osm_ids, versions1, versions2):
+        """
+        bulk comparison of pairs of way versions by their fingerprints
+
+        Parameters
+        ----------
+        ids1 : numpy array
+            PRIMARY KEYS OF THE PREVIOUS VERSIONS.
+        ids2 : numpy array
+            PRIMARY KEYS OF THE CURRENT VERSIONS.
+        osm_ids : numpy array
+            OSM IDS OF THE WAYS.
+        versions1 : numpy array
+            VERSION NUMBERS OF THE PREVIOUS VERSIONS.
+        versions2 : numpy array
+            VERSION NUMBERS OF THE CURRENT VERSIONS.
+
+        Returns
+        -------
+        numpy array (int)
+            ONE CODE PER PAIR: 0 (None), 1, OR UNDECIDED (NODES TO BE COMPARED ONE BY ONE).
+
+        """
+        p1, p2 = self.positions(ids1, osm_ids, versions1), self.positions(ids2, osm_ids, versions2)
+        decided = (p1 >= 0) & (p2 >= 0)
+        p1, p2 = np.maximum(p1, 0), np.maximum(p2, 0)
+        unchanged = (self.nb_nodes[p1] == self.nb_nodes[p2]) & (self.fingerprint[p1] == self.fingerprint[p2])
+        return np.where(decided, np.where(unchanged, 0, 1), UNDECIDED)
+
+    def way_modification(self, t1, t2):
+        """
+        comparison of two way versions by their fingerprints, as in 'geometry_modification'
+
+        Parameters
+        ----------
+        t1 : pandas Series
+            PREVIOUS VERSION (ROW OF THE HISTORY TABLE: id, osm_id, version).
+        t2 : pandas Series
+            CURRENT VERSION.
+
+        Returns
+        -------
+        int or None
+            None (NO GEOMETRY MODIFICATION), 1, OR UNDECIDED.
+
+        """
+        code = int(self.codes([t1['id']], [t2['id']], [t1['osm_id']], [t1['version']], [t2['version']])[0])
+        return None if code == 0 else code
+
+
+
+def create_fingerprints_table(cur, fingerprint_tablename=FINGERPRINTS_TABLENAME):
+    """
+    creates the side table of the fingerprints, if it does not exist yet
+
+    Parameters
+    ----------
+    cur : psycopg2 cursor
+        DATABASE CURSOR.
+    fingerprint_tablename : string
+        FINGERPRINT TABLE NAME.
+
+    Returns
+    -------
+    None.
+
+    """
+    cur.execute(sql.SQL("""CREATE TABLE IF NOT EXISTS {}
+(
+    id bigint PRIMARY KEY,
+    osm_id bigint,
+    version integer,
+    nb_nodes integer,
+    fingerprint bigint
+);""").format(sql.Identifier(fingerprint_tablename)))
+    # for the queries per way (reverted geometries) and per fingerprint (repeated geometries)
+    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (osm_id, version);").format(
+        sql.Identifier(fingerprint_tablename + '_osm_id_idx'), sql.Identifier(fingerprint_tablename)))
+    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (fingerprint);").format(
+        sql.Identifier(fingerprint_tablename + '_fingerprint_idx'), sql.Identifier(fingerprint_tablename)))
+
+
+
+def build_geometry_fingerprints(conn, pgsql_tablename='history', fingerprint_tablename=FINGERPRINTS_TABLENAME, chunk_size=20000,
+                                node_index=None, progress=True):
+    """
+    precomputation pass: computes and stores the fingerprints of the way versions of the history table.
+    Only the ways with versions missing from the side table are (re)computed, so that running it again
+    after an update of the history only processes the new versions. Stored rows whose (id, osm_id, version)
+    is no longer a way version of the history table (e.g. after a re-import) are deleted first.
+
+    Parameters
+    ----------
+    conn : psycopg2 connection
+        DATABASE CONNECTION.
+    pgsql_tablename : string
+        HISTORY TABLE NAME.
+    fingerprint_tablename : string
+        FINGERPRINT TABLE NAME.
+    chunk_size : int
+        NUMBER OF WAYS PROCESSED AT ONCE.
+    node_index : NodeCoordinateIndex, optional
+        PREBUILT NODE INDEX (SEE 'node_index.py'): THE NODES ARE THEN RESOLVED FROM IT INSTEAD OF BEING LOADED.
+    progress : boolean
+        DISPLAY A PROGRESS BAR OVER THE CHUNKS.
+
+    Returns
+    -------
+    int
+        NUMBER OF WAY VERSIONS FINGERPRINTED.
+
+    """
+    cur = conn.cursor()
+    create_fingerprints_table(cur, fingerprint_tablename)
+    conn.commit()
+
+    # Stale rows: primary keys reused by another version, or versions gone from the history table
+    cur.execute(sql.SQL("""DELETE FROM {1} AS f WHERE NOT EXISTS
+(SELECT 1 FROM {0} AS h WHERE h.id = f.id AND h.osm_id = f.osm_id AND h.version = f.version AND h.osm_type = 'way');""")
+                .format(sql.Identifier(pgsql_tablename), sql.Identifier(fingerprint_tablename)))
+    conn.commit()
+
+    cur.execute(sql.SQL("""SELECT DISTINCT h.osm_id FROM {} AS h LEFT JOIN {} AS f ON f.id = h.id
+WHERE h.osm_type = 'way' AND f.id IS NULL ORDER BY h.osm_id;""").format(sql.Identifier(pgsql_tablename), sql.Identifier(fingerprint_tablename)))
+    way_ids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+
+    nb_versions = 0
+    for i in tqdm(range(0, len(way_ids), chunk_size), disable=not progress):
+        chunk = way_ids[i:i + chunk_size]
+        keys = lookup_keys(chunk, 'way')
+
+        store = VersionStore(pgsql_tablename)
+        with metrics.timer('batch_load'):
+            load_references(cur, store, keys, way_nodes=node_index is None)
+        with metrics.timer('fingerprint'):
+            first, count = store.segments(keys)
+            k = np.concatenate([np.arange(f, f + c) for f, c in zip(first, count) if c > 0] or [np.empty(0, dtype=np.int64)])
+            nb_nodes, fingerprint, comparable = version_fingerprints(store, k, node_index)
+
+        rows = [(row_id, key // 4, store.rows[version][2], nb if nb >= 0 else None, value if is_comparable else None)
+                for version, row_id, key, nb, value, is_comparable in zip(k.tolist(), store.row_id[k].tolist(), store.key[k].tolist(),
+                                                                          nb_nodes.tolist(), fingerprint.tolist(), comparable.tolist())]
+        # (all the versions of the ways of the chunk are replaced)
+        cur.execute(sql.SQL("DELETE FROM {} WHERE osm_id = ANY(%s);").format(sql.Identifier(fingerprint_tablename)), (chunk.tolist(),))
+        copy_rows(cur, fingerprint_tablename, rows, [copy_value] * 5)
+        conn.commit()
+        nb_versions += len(rows)
+
+    return nb_versions
+
+
+
+def reverted_geometries(cur, fingerprint_tablename=FINGERPRINTS_TABLENAME):
+    """
+    returns the way versions whose geometry modification restored an older geometry of the same way
+    (fingerprint different from the previous version's, but equal to the one of an earlier version)
+
+    Parameters
+    ----------
+    cur : psycopg2 cursor
+        DATABASE CURSOR.
+    fingerprint_tablename : string
+        FINGERPRINT TABLE NAME.
+
+    Returns
+    -------
+    pandas DataFrame
+        osm_id, version, reverted_to_version (THE LATEST EARLIER VERSION WITH THE SAME GEOMETRY).
+
+    """
+    cur.execute(sql.SQL("""WITH v AS (
+    SELECT osm_id, version, nb_nodes, fingerprint,
+           lag(version) OVER w AS previous_version, lag(nb_nodes) OVER w AS previous_nb_nodes, lag(fingerprint) OVER w AS previous_fingerprint
+    FROM {0} WINDOW w AS (PARTITION BY osm_id ORDER BY version)
+)
+SELECT v.osm_id, v.version, max(e.version) AS reverted_to_version
+FROM v JOIN {0} AS e ON e.osm_id = v.osm_id AND e.version < v.previous_version
+                    AND e.nb_nodes = v.nb_nodes AND e.fingerprint = v.fingerprint
+WHERE v.fingerprint IS NOT NULL AND v.previous_fingerprint IS NOT NULL
+  AND (v.previous_nb_nodes <> v.nb_nodes OR v.previous_fingerprint <> v.fingerprint)
+GROUP BY v.osm_id, v.version ORDER BY v.osm_id, v.version;""").format(sql.Identifier(fingerprint_tablename)))
+    return pd.DataFrame(cur.fetchall(), columns=['osm_id', 'version', 'reverted_to_version'])
+
+
+
+def repeated_geometries(cur, fingerprint_tablename=FINGERPRINTS_TABLENAME, min_nb_ways=2):
+    """
+    returns the geometries shared by several ways of the history (e.g. buildings imported twice)
+
+    Parameters
+    ----------
+    cur : psycopg2 cursor
+        DATABASE CURSOR.
+    fingerprint_tablename : string
+        FINGERPRINT TABLE NAME.
+    min_nb_ways : int
+        MINIMAL NUMBER OF DISTINCT WAYS SHARING A GEOMETRY.
+
+    Returns
+    -------
+    pandas DataFrame
+        fingerprint, nb_nodes, nb_ways, osm_ids (LIST OF THE WAYS), MOST SHARED GEOMETRIES FIRST.
+
+    """
+    cur.execute(sql.SQL("""SELECT fingerprint, nb_nodes, count(DISTINCT osm_id) AS nb_ways, array_agg(DISTINCT osm_id) AS osm_ids
+FROM {} WHERE fingerprint IS NOT NULL
+GROUP BY fingerprint, nb_nodes HAVING count(DISTINCT osm_id) >= %s
+ORDER BY nb_ways DESC, fingerprint;""").format(sql.Identifier(fingerprint_tablename)), (min_nb_ways,))
+    return pd.DataFrame(cur.fetchall(), columns=['fingerprint', 'nb_nodes', 'nb_ways', 'osm_ids'])
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+                    GEOMETRY MODIFICATION MAGNITUDES
+
+
+------------------------------------------------------------------------------
+"""
+
+"""
+'geometry_modification' tells whether the geometry of a feature changed between two versions (exact equality of the
+coordinates), not how much: a building moved by a few centimetres counts as much as a building redrawn from scratch.
+This module measures the magnitude of the modifications of consecutive version pairs, for the risk assessment of the imports:
+    - hausdorff_distance: largest distance from a point of one version to the other version (metres),
+    - area_delta: area of the current version minus area of the previous one (square metres),
+    - centroid_shift: distance between the centroids of both versions (metres),
+    - significant: True if at least one magnitude exceeds its tolerance threshold (see 'DEFAULT_THRESHOLDS').
+
+The geometries of all the version pairs of a chunk of features are built at once with the array functions of
+Shapely 2.x (GEOS), from the versions loaded by the batch engine (see 'geometry_batch_engine.py'), with the rules
+of 'geometry_modification' for resolving the nodes and members (latest version older than the way/relation version):
+    - nodes are points, closed ways (at least 4 nodes) are polygons, the other ways are linestrings,
+    - relations are the areas formed by the linework of their way members ('build_area': the history table does not
+      store the roles, so inner rings are holes by even-odd rule); their node and relation members are ignored,
+    - coordinates are projected on a local plane (equirectangular, centred on the latitude of the pair): at the scale
+      of a building, distances are accurate to well under a millimetre, without any projection library,
+    - a version with a missing, younger or erased node/member (or a relation without any ring) has no geometry:
+      the magnitudes of its pairs are NaN,
+    - so are the pairs of versions of different types (lookups by id only: a node and a way/relation sharing the id),
+      whose geometries are unrelated.
+
+Example:
+    magnitudes = batch_modification_magnitudes(cur, osm_ids, osm_types)
+    risky = magnitudes[magnitudes.significant]
+"""
+
+
+
+### Librairies import
+
+from tqdm import tqdm   # for displaying a progress bar on loops
+
+import numpy as np
+import pandas as pd
+
+try:
+    import shapely    # Shapely 2.x, vectorized GEOS operations (optional: only needed by this module)
+except ImportError:
+    shapely = None
+
+from geometry_batch_engine import VersionStore, lookup_keys, load_references, chunk_pair_codes, way_coordinates    # batch loading and geometry codes
+from metrics import metrics    # 'batch_load' and 'magnitude' stage timers (see 'metrics.py')
+
+
+
+### Code
+
+
+EARTH_RADIUS = 6371008.8 # mean Earth radius, in metres
+
+# Tolerance thresholds of the magnitudes (absolute values, in metres or square metres): below all of them,
+# a geometry modification is considered as insignificant (e.g. a node moved by a few centimetres)
+DEFAULT_THRESHOLDS = {'hausdorff_distance': 1.0, 'area_delta': 5.0, 'centroid_shift': 0.5}
+
+MAGNITUDE_COLUMNS = ['osm_id', 'osm_type', 'version1', 'version2', 'geometry_modification',
+                     'hausdorff_distance', 'area_delta', 'centroid_shift', 'significant']
+
+
+
+def version_geometries(store, k, nodes=None):
+    """
+    builds the geometries of versions loaded in a store, in degrees (x: longitude, y: latitude)
+
+    Parameters
+    ----------
+    store : VersionStore
+        LOADED VERSIONS (WITH THEIR MEMBERS).
+    k : numpy array
+        INDEXES OF THE VERSIONS.
+    nodes : NodeCoordinateIndex, optional
+        WHERE THE NODES OF THE WAYS ARE RESOLVED (DEFAULT: THE STORE ITSELF).
+
+    Returns
+    -------
+    numpy array (object)
+        SHAPELY GEOMETRY OF EACH VERSION, None IF IT CANNOT BE BUILT.
+
+    """
+    k = np.asarray(k, dtype=np.int64)
+    geometries = np.full(len(k), None, dtype=object)
+    osm_type = store.osm_type[k]
+
+    # Nodes: points (None if erased)
+    is_node = np.nonzero(osm_type == 'node')[0]
+    lat, lon = store.lat[k[is_node]], store.lon[k[is_node]]
+    geometries[is_node] = np.where(np.isnan(lat) | np.isnan(lon), None, shapely.points(lon, lat))
+
+    # Ways and relations are made of "parts": the way version itself, or the way members of the relation version
+    is_way = np.nonzero(osm_type == 'way')[0]
+    is_relation = np.nonzero(osm_type == 'relation')[0]
+    part_owner, part_version = [is_way], [k[is_way]]
+    valid = np.ones(len(k), dtype=bool)
+
+    r = k[is_relation]
+    counts = np.maximum(store.ref_count[r], 0)
+    relation_of_member = np.repeat(np.arange(len(r)), counts)
+    member_keys = np.concatenate([store.reference_keys(version) for version in r] or [np.empty(0, dtype=np.int64)])
+    members = store.resolve(member_keys, np.repeat(store.timestamp[r], counts), np.repeat(store.has_timestamp[r], counts))
+    # (missing members: no geometry, as the error code 2 of 'geometry_modification')
+    valid[is_relation[np.unique(relation_of_member[members < 0])]] = False
+    member_ways = (members >= 0) & (store.osm_type[np.maximum(members, 0)] == 'way')
+    part_owner.append(is_relation[relation_of_member[member_ways]])
+    part_version.append(members[member_ways])
+    valid[is_relation[np.bincount(relation_of_member[member_ways], minlength=len(r)) == 0]] = False
+    valid[is_way[store.ref_count[k[is_way]] < 0]] = False
+
+    part_owner, part_version = np.concatenate(part_owner), np.concatenate(part_version)
+    nb_nodes, part_of_node, found, lat, lon = way_coordinates(store, part_version, nodes)
+
+    # (missing, younger or erased nodes, and parts too short for a line: no geometry)
+    resolved = found & ~np.isnan(lat) & ~np.isnan(lon)
+    valid[part_owner[np.bincount(part_of_node, weights=~resolved, minlength=len(part_version)) > 0]] = False
+    valid[part_owner[nb_nodes < 2]] = False
+    part_valid = valid[part_owner]
+
+    keep = part_valid[part_of_node]
+    coordinates = np.column_stack([lon[keep], lat[keep]])
+    part_of_node = part_of_node[keep]
+    nb_nodes = np.where(part_valid, nb_nodes, 0)
+    starts = np.cumsum(nb_nodes) - nb_nodes
+
+    # Closed ways (and relations made of a single closed way): polygons; other ways and members of relations: linestrings
+    closed = np.zeros(len(part_version), dtype=bool)
+    candidates = np.nonzero(part_valid & (nb_nodes >= 4))[0]
+    closed[candidates] = (coordinates[starts[candidates]] == coordinates[starts[candidates] + nb_nodes[candidates] - 1]).all(axis=1)
+    single_part = np.bincount(part_owner, minlength=len(k))[part_owner] == 1
+    whole_geometry = (osm_type[part_owner] == 'way') | (closed & single_part) # part being the geometry of its version
+    as_polygon = closed & whole_geometry
+    as_line = part_valid & ~as_polygon
+
+    parts = np.full(len(part_version), None, dtype=object)
+    for selection, build in [(as_polygon, shapely.linearrings), (as_line, shapely.linestrings)]:
+        selected_nodes = selection[part_of_node]
+        if selected_nodes.any():
+            # ('indices' are the positions of the parts among the selected ones)
+            rank = np.cumsum(selection) - 1
+            parts[selection] = build(coordinates[selected_nodes], indices=rank[part_of_node[selected_nodes]])
+    parts[as_polygon] = shapely.polygons(parts[as_polygon])
+
+    wholes = part_valid & whole_geometry
+    geometries[part_owner[wholes]] = parts[wholes]
+
+    relation_parts = part_valid & ~whole_geometry
+    if relation_parts.any():
+        owners, owner_rank = np.unique(part_owner[relation_parts], return_inverse=True)
+        # (linework noded first: member ways may cross each other or themselves)
+        geometries[owners] = shapely.build_area(shapely.node(shapely.multilinestrings(parts[relation_parts], indices=owner_rank)))
+
+    # (e.g. relations whose members do not form any ring: no area, no geometry)
+    geometries[shapely.is_empty(geometries)] = None
+    return geometries
+
+
+
+def project(geometries, lat0):
+    """
+    projects geometries in degrees on local planes (equirectangular projection, in metres)
+
+    Parameters
+    ----------
+    geometries : numpy array (object)
+        GEOMETRIES IN DEGREES (None ALLOWED).
+    lat0 : numpy array
+        LATITUDE OF THE CENTRE OF THE PROJECTION OF EACH GEOMETRY (DEGREES).
+
+    Returns
+    -------
+    numpy array (object)
+        PROJECTED GEOMETRIES (NEW OBJECTS, THE INPUT ONES ARE LEFT UNCHANGED).
+
+    """
+    _, index = shapely.get_coordinates(geometries, return_index=True)
+    scale = EARTH_RADIUS * np.pi / 180
+    factors = np.column_stack([scale * np.cos(np.radians(np.asarray(lat0, dtype=np.float64)[index])), np.full(len(index), scale)])
+    # ('transform' gets all the coordinates at once, in the order of 'get_coordinates')
+    return shapely.transform(geometries, lambda xy: xy * factors)
+
+
+
+def modification_magnitudes(g1, g2, thresholds=None):
+    """
+    magnitudes of the modifications between two arrays of geometries (see module description)
+
+    Parameters
+    ----------
+    g1 : numpy array (object)
+        GEOMETRIES OF THE PREVIOUS VERSIONS (None: UNKNOWN).
+    g2 : numpy array (object)
+        GEOMETRIES OF THE CURRENT VERSIONS.
+    thresholds : dict, optional
+        TOLERANCE THRESHOLDS (DEFAULT: 'DEFAULT_THRESHOLDS').
+
+    Returns
+    -------
+    dict
+        'hausdorff_distance', 'area_delta', 'centroid_shift' (NaN WHEN UNKNOWN) AND 'significant' ARRAYS.
+
+    """
+    if thresholds is None:
+        thresholds = DEFAULT_THRESHOLDS
+    magnitudes = {'hausdorff_distance': shapely.hausdorff_distance(g1, g2),
+                  'area_delta': shapely.area(g2) - shapely.area(g1),
+                  'centroid_shift': shapely.distance(shapely.centroid(g1), shapely.centroid(g2))}
+    # (NaN > threshold is False: unknown magnitudes are not significant)
+    significant = np.zeros(len(g1), dtype=bool)
+    for name, threshold in thresholds.items():
+        significant |= np.abs(magnitudes[name]) > threshold
+    magnitudes['significant'] = significant
+    return magnitudes
+
+
+
+def chunk_modification_magnitudes(store, keys, nodes=None, thresholds=None, modified_only=True, fingerprints=None):
+    """
+    magnitudes of the modifications of all the consecutive version pairs of a chunk of features
+    whose versions (and members) are loaded
+
+    Parameters
+    ----------
+    store : VersionStore
+        LOADED VERSIONS.
+    keys : numpy array
+        LOOKUP KEYS OF THE FEATURES.
+    nodes : NodeCoordinateIndex, optional
+        WHERE THE NODES OF THE WAYS ARE RESOLVED (DEFAULT: THE STORE ITSELF).
+    thresholds : dict, optional
+        TOLERANCE THRESHOLDS (DEFAULT: 'DEFAULT_THRESHOLDS').
+    modified_only : boolean
+        ONLY THE PAIRS WITH A GEOMETRY MODIFICATION (CODE 1), THE OTHERS HAVING NOTHING TO MEASURE.
+    fingerprints : GeometryFingerprints, optional
+        PRECOMPUTED WAY FINGERPRINTS (SEE 'geometry_fingerprint.py').
+
+    Returns
+    -------
+    pandas DataFrame
+        ONE LINE PER VERSION PAIR (SEE 'MAGNITUDE_COLUMNS').
+
+    """
+    count, feature_of_pair, k1, k2, codes = chunk_pair_codes(store, keys, nodes, fingerprints)
+    if modified_only:
+        modified = codes == 1
+        feature_of_pair, k1, k2, codes = feature_of_pair[modified], k1[modified], k2[modified], codes[modified]
+
+    # All the versions of the pairs built at once (each one once, most versions being in two pairs),
+    # then projected around the latitude of the pair (centroid of the previous version, or of the current one if unknown)
+    versions, position = np.unique(np.concatenate([k1, k2]), return_inverse=True)
+    geometries = version_geometries(store, versions, nodes)[position]
+    g1, g2 = geometries[:len(k1)], geometries[len(k1):]
+    # (versions of different types, with untyped lookups: unrelated geometries, nothing to measure)
+    mixed = store.osm_type[k1] != store.osm_type[k2]
+    g1[mixed], g2[mixed] = None, None
+    lat0 = shapely.get_y(shapely.centroid(g1))
+    lat0 = np.where(np.isnan(lat0), shapely.get_y(shapely.centroid(g2)), lat0)
+    geometries = project(geometries, np.concatenate([lat0, lat0]))
+    magnitudes = modification_magnitudes(geometries[:len(k1)], geometries[len(k1):], thresholds)
+
+    first, _ = store.segments(keys)
+    return pd.DataFrame({'osm_id': np.asarray(keys, dtype=np.int64)[feature_of_pair] // 4,
+                         'osm_type': store.osm_type[first[feature_of_pair]],
+                         'version1': [store.rows[k][2] for k in k1.tolist()],
+                         'version2': [store.rows[k][2] for k in k2.tolist()],
+                         'geometry_modification': codes,
+                         **magnitudes}, columns=MAGNITUDE_COLUMNS)
+
+
+
+def batch_modification_magnitudes(cur, osm_ids, osm_types=None, pgsql_tablename='history', chunk_size=20000, node_index=None,
+                                  thresholds=None, modified_only=True, progress=True, fingerprints=None):
+    """
+    magnitudes of the geometry modifications of a list of features (see module description)
+
+    Parameters
+    ----------
+    cur : psycopg2 cursor or HistoryStore
+        DATABASE CURSOR, OR LOCAL HISTORY STORE (SEE 'history_store.py').
+    osm_ids : int list
+        OSM FEATURE IDS.
+    osm_types : string list, optional
+        OSM TYPE OF EACH FEATURE (None: LOOKUP BY ID ONLY).
+    pgsql_tablename : string
+        HISTORY TABLE NAME.
+    chunk_size : int
+        NUMBER OF FEATURES PROCESSED AT ONCE (MEMORY BOUND).
+    node_index : NodeCoordinateIndex, optional
+        PREBUILT NODE INDEX (SEE 'node_index.py').
+    thresholds : dict, optional
+        TOLERANCE THRESHOLDS (DEFAULT: 'DEFAULT_THRESHOLDS').
+    modified_only : boolean
+        ONLY THE PAIRS WITH A GEOMETRY MODIFICATION.
+    progress : boolean
+        DISPLAY A PROGRESS BAR OVER THE CHUNKS.
+    fingerprints : GeometryFingerprints, optional
+        PRECOMPUTED WAY FINGERPRINTS (SEE 'geometry_fingerprint.py').
+
+    Returns
+    -------
+    pandas DataFrame
+        ONE LINE PER VERSION PAIR (SEE 'MAGNITUDE_COLUMNS'), FEATURE AFTER FEATURE IN THE INPUT ORDER.
+
+    """
+    if shapely is None:
+        raise ImportError("the modification magnitudes require the 'shapely' library, version 2 or later (pip install shapely)")
+
+    keys = lookup_keys(osm_ids, osm_types)
+    frames = []
+
+    for i in tqdm(range(0, len(keys), chunk_size), disable=not progress):
+        chunk = keys[i:i + chunk_size]
+
+        store = VersionStore(pgsql_tablename)
+        with metrics.timer('batch_load'):
+            load_references(cur, store, chunk, way_nodes=node_index is None)
+        with metrics.timer('magnitude'):
+            frames.append(chunk_modification_magnitudes(store, chunk, node_index, thresholds, modified_only, fingerprints))
+
+    if not frames:
+        return pd.DataFrame(columns=MAGNITUDE_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
@@ -19,13 +19,13 @@ import numpy as np
 
 def get_geom_modif_ids(filename):
     """
-    create a new .csv file containing the OSM feature ids of those that have
+    create a new .csv (or .parquet) file containing the OSM feature ids of those that have
     underwent geometry modification from the input file
 
     Parameters
     ----------
     filename : string
-        CSV filename with its extension.
+        CSV or Parquet filename with its extension (the output file has the same format).
 
     Returns
     -------
@@ -33,9 +33,15 @@ def get_geom_modif_ids(filename):
 
     """
     
-    df = pd.read_csv(os.path.join(os.getcwd(), filename), delimiter=" ")
+    root, extension = os.path.splitext(filename)
     
-    osm_id = df['osm_id']
+    # Only the two needed columns are read (no text parsing at all for Parquet files)
+    if extension == ".parquet":
+        df = pd.read_parquet(os.path.join(os.getcwd(), filename), columns=['osm_id', 'nb_geometry_modification'])
+    else:
+        df = pd.read_csv(os.path.join(os.getcwd(), filename), delimiter=" ", usecols=['osm_id', 'nb_geometry_modification'])
+    
+    osm_id = df['osm_id'].to_numpy()
     nb_geometry_modification = df['nb_geometry_modification']
     arr = np.array(nb_geometry_modification)
     
@@ -47,8 +53,11 @@ def get_geom_modif_ids(filename):
     
     osm_ids = pd.DataFrame(np.take(osm_id, non_zero_and_non_nan_values[0]), columns=["osm_id"])
     
-    output_filename = filename[:-4] + "_geom_modif_ids.csv"
-    osm_ids.to_csv(output_filename, float_format="%.3f", index_label="index", sep=" ")
+    output_filename = root + "_geom_modif_ids" + extension
+    if extension == ".parquet":
+        osm_ids.to_parquet(output_filename, index=False)
+    else:
+        osm_ids.to_csv(output_filename, float_format="%.3f", index_label="index", sep=" ")
     
     print("\n\nThe result has been successfully saved in '" + os.getcwd() + "/" + output_filename + "'!")
     
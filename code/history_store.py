@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+                    MEMORY-MAPPED HISTORY STORE
+
+
+------------------------------------------------------------------------------
+"""
+
+"""
+Local, binary alternative to the PostgreSQL history table: an OSM history file is turned once into
+column files (NumPy .npy), memory-mapped at analysis time, so that 'osm_versions' and the batch engine
+can run without any database server and with near-zero startup cost.
+
+Layout (one value per feature version, sorted by (osm_id * 4 + type code, version, id), i.e. the lookup keys
+of 'geometry_batch_engine.py'):
+    - id, osm_id, version, timestamp (seconds), uid, changeset_id: int64; osm_type: int8 (see 'TYPE_CODES'),
+    - lat, lon: fixed-point int32 (1e-7 degrees, the OSM precision; NULL_COORDINATE for deleted nodes),
+    - members_refs: CSR layout, the references of version k being ref_values[ref_offsets[k]:ref_offsets[k + 1]]
+      (with the type code of every member in ref_types),
+    - user names, tag keys and tag values: dictionary-encoded in a single pool of UTF-8 strings,
+      the tags being in CSR layout as well (tag_offsets, tag_keys, tag_values).
+
+The versions are returned exactly as by 'query_versions' (same columns, same values, 'other_tags' as the
+hstore text sent by PostgreSQL). The primary keys ('id') are the ones given by the importers of
+'history_to_pgsql_enhanced.py' to the same file imported into an empty table:
+    - by default, consecutive keys in file order, as the sequential importers ('history_importer', 'history_pbf_importer'),
+    - with 'block_keys=True' (.osh.pbf files only), block-based keys, as 'parallel_history_pbf_importer'
+      (block index * BLOCK_KEY_STRIDE + rank in the block).
+A store built with the other scheme has different keys than the table: lookups by primary key
+(e.g. the way fingerprints, see 'geometry_fingerprint.py') then find nothing, and fall back to the slower path.
+
+[Quick start]:
+    store = HistoryStore.build('finland.osh.pbf', 'history_store')    # built once from the history file
+    # store = HistoryStore.build('finland.osh.pbf', 'history_store', block_keys=True)    # (table of the parallel importer)
+    store = HistoryStore.load('history_store')                         # then reused (memory-mapped)
+    versions = store.versions(123456, 'way')
+"""
+
+
+
+### Libraries import
+
+import os
+import datetime
+from array import array    # compact typed buffers while reading the history file
+from tqdm import tqdm   # for displaying a progress bar on loops
+
+import numpy as np
+import pandas as pd
+import osmium    # PyOsmium, for reading .osh.pbf/.osh history files natively
+
+from history_to_pgsql_enhanced import MEMBER_TYPES, BLOCK_KEY_STRIDE
+from pbf_framing import pbf_blocks    # PBF block locator, for the block-based primary keys (see 'pbf_framing.py')
+from node_index import NodeCoordinateIndex    # versioned node coordinates (see 'node_index.py')
+
+
+
+
+### Code
+
+
+TYPE_CODES = {'node': 0, 'way': 1, 'relation': 2}
+OSM_TYPES = ('node', 'way', 'relation')
+ANY_TYPE = 3 # member of unknown type (lookup by id only)
+
+COORDINATE_PRECISION = 10 ** 7
+NULL_COORDINATE = np.iinfo(np.int32).min
+NULL_TIMESTAMP = np.iinfo(np.int64).min
+
+EPOCH = datetime.datetime(1970, 1, 1) # timestamps are stored in UTC, as in the history table
+
+STORE_ARRAYS = ['key', 'id', 'osm_id', 'osm_type', 'version', 'timestamp', 'uid', 'user', 'changeset_id', 'visible',
+                'lat', 'lon', 'ref_offsets', 'ref_values', 'ref_types', 'has_refs', 'tag_offsets', 'tag_keys', 'tag_values',
+                'strings', 'string_offsets']
+
+# Columns of the history table (see 'create_history_table' in 'history_to_pgsql_enhanced.py')
+HISTORY_COLUMNS = ['id', 'osm_id', 'osm_type', 'version', 'timestamp', 'uid', 'user', 'changeset_id', 'visible',
+                   'lat', 'lon', 'members_refs', 'other_tags', 'members_types']
+
+
+
+def hstore_text(tags):
+    """
+    returns the text PostgreSQL sends for an hstore value (keys sorted by length, then bytes)
+
+    Parameters
+    ----------
+    tags : list of (key, value) tuples
+        TAGS.
+
+    Returns
+    -------
+    string or None
+        HSTORE TEXT (None IF NO TAGS).
+
+    """
+    if not tags:
+        return None
+    escape = lambda text: text.replace('\\', '\\\\').replace('"', '\\"')
+    unique_tags = {}
+    for key, value in tags:
+        unique_tags.setdefault(key, value) # duplicate keys: the first value is kept, as by 'hstore(text[])'
+    return ', '.join(['"' + escape(key) + '"=>"' + escape(value) + '"'
+                      for key, value in sorted(unique_tags.items(), key=lambda tag: (len(tag[0].encode()), tag[0].encode()))])
+
+
+
+class HistoryStoreHandler(osmium.SimpleHandler):
+    """
+    PyOsmium handler reading every version of every feature from a history file into typed buffers
+    (same records as 'HistoryHandler' in 'history_to_pgsql_enhanced.py', dictionary-encoded strings)
+    """
+    def __init__(self, progress=True):
+        osmium.SimpleHandler.__init__(self)
+        self.columns = {'id': array('q'), 'osm_id': array('q'), 'osm_type': array('b'), 'version': array('q'),
+                        'timestamp': array('q'), 'uid': array('q'), 'user': array('i'), 'changeset_id': array('q'),
+                        'visible': array('b'), 'lat': array('i'), 'lon': array('i'),
+                        'ref_counts': array('q'), 'ref_values': array('q'), 'ref_types': array('b'),
+                        'tag_counts': array('q'), 'tag_keys': array('i'), 'tag_values': array('i')}
+        self.string_codes = {'': 0} # string -> position in the pool ('' for missing user names)
+        self.id_primary_key = 0 # primary key of the last record (set at the beginning of each block for the block-based keys)
+        self.progress = tqdm(disable=not progress)
+
+    def string_code(self, string):
+        code = self.string_codes.get(string)
+        if code is None:
+            code = self.string_codes[string] = len(self.string_codes)
+        return code
+
+    def add_record(self, o, osm_type, lat, lon, members_refs, members_types):
+        # N.B.: PyOsmium objects are only valid inside the callbacks, everything is copied here
+        columns = self.columns
+        self.id_primary_key += 1 # same primary key as the importers (one per feature version, see 'HistoryStore.build')
+        columns['id'].append(self.id_primary_key)
+        columns['osm_id'].append(o.id)
+        columns['osm_type'].append(TYPE_CODES[osm_type])
+        columns['version'].append(o.version)
+        columns['timestamp'].append(int(o.timestamp.timestamp()))
+        columns['uid'].append(o.uid) # 0 for anonymous edits (NULL in the history table)
+        columns['user'].append(self.string_code(o.user))
+        columns['changeset_id'].append(o.changeset)
+        columns['visible'].append(o.visible)
+        columns['lat'].append(lat)
+        columns['lon'].append(lon)
+        columns['ref_counts'].append(len(members_refs))
+        columns['ref_values'].extend(members_refs)
+        columns['ref_types'].extend(members_types)
+        nb_tags = 0
+        for tag in o.tags:
+            columns['tag_keys'].append(self.string_code(tag.k))
+            columns['tag_values'].append(self.string_code(tag.v))
+            nb_tags += 1
+        columns['tag_counts'].append(nb_tags)
+        self.progress.update()
+
+    def node(self, n):
+        if n.location.valid():
+            self.add_record(n, 'node', n.location.y, n.location.x, [], []) # fixed-point (lat, lon)
+        else:
+            # deleted node versions have no coordinates
+            self.add_record(n, 'node', NULL_COORDINATE, NULL_COORDINATE, [], [])
+
+    def way(self, w):
+        refs = [nd.ref for nd in w.nodes]
+        self.add_record(w, 'way', NULL_COORDINATE, NULL_COORDINATE, refs, [TYPE_CODES['node']] * len(refs))
+
+    def relation(self, r):
+        members = [(member.ref, TYPE_CODES[MEMBER_TYPES[member.type]]) for member in r.members]
+        self.add_record(r, 'relation', NULL_COORDINATE, NULL_COORDINATE,
+                        [ref for ref, member_type in members], [member_type for ref, member_type in members])
+
+
+
+class HistoryStore:
+    """
+    Column store of all the versions of a history file, sorted by (lookup key, version, id)
+    (see the module description for the layout)
+    """
+    def __init__(self, arrays):
+        for name in STORE_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.string_cache = {} # decoded strings of the pool
+
+    @classmethod
+    def build(cls, osm_history_filename, directory, progress=True, block_keys=False):
+        """
+        reads a history file (.osh.pbf, .osh, or any format read by PyOsmium) and saves it
+        as a store in a directory (created if needed)
+
+        Parameters
+        ----------
+        osm_history_filename : string
+            OSM HISTORY FILENAME WITH ITS EXTENSION.
+        directory : string
+            OUTPUT DIRECTORY.
+        progress : boolean
+            DISPLAY A PROGRESS BAR.
+        block_keys : boolean
+            BLOCK-BASED PRIMARY KEYS, AS 'parallel_history_pbf_importer' (.osh.pbf FILES ONLY); DEFAULT: CONSECUTIVE
+            KEYS, AS THE SEQUENTIAL IMPORTERS (SEE THE MODULE DESCRIPTION).
+
+        Returns
+        -------
+        HistoryStore
+            THE STORE, MEMORY-MAPPED FROM THE SAVED FILES.
+
+        """
+        handler = HistoryStoreHandler(progress)
+        if not block_keys:
+            handler.apply_file(osm_history_filename)
+        else:
+            if not osm_history_filename.endswith('.pbf'):
+                raise ValueError("block-based primary keys need a .osh.pbf history file, not " + osm_history_filename)
+            # Read block by block, as by the parallel importer: the keys of a block start at block index * BLOCK_KEY_STRIDE
+            header_block, data_blocks = pbf_blocks(osm_history_filename)
+            with open(osm_history_filename, "rb") as f:
+                for block_index, (offset, size) in enumerate(data_blocks):
+                    f.seek(offset)
+                    handler.id_primary_key = block_index * BLOCK_KEY_STRIDE
+                    handler.apply_buffer(header_block + f.read(size), 'osh.pbf')
+        handler.progress.close()
+        columns = {name: np.frombuffer(values, dtype=values.typecode) if len(values) > 0 else np.empty(0, dtype=values.typecode)
+                   for name, values in handler.columns.items()}
+
+        # Sorting the versions by (lookup key, version, id), as the 'osm_versions' query results
+        key = columns['osm_id'] * 4 + columns['osm_type']
+        order = np.lexsort((columns['id'], columns['version'], key))
+        arrays = {'key': key[order]}
+        for name in ['id', 'osm_id', 'osm_type', 'version', 'timestamp', 'uid', 'user', 'changeset_id', 'lat', 'lon']:
+            arrays[name] = columns[name][order]
+        arrays['visible'] = columns['visible'][order].astype(bool)
+
+        # Reordering the CSR columns (references and tags) along with the versions
+        for prefix, counts, value_columns in [('ref', columns['ref_counts'], ['ref_values', 'ref_types']),
+                                              ('tag', columns['tag_counts'], ['tag_keys', 'tag_values'])]:
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64) if len(counts) > 0 else np.empty(0, dtype=np.int64)
+            sorted_counts = counts[order]
+            offsets = np.zeros(len(order) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(sorted_counts)
+            positions = np.repeat(starts[order], sorted_counts) + np.arange(offsets[-1]) - np.repeat(offsets[:-1], sorted_counts)
+            arrays[prefix + '_offsets'] = offsets
+            for name in value_columns:
+                arrays[name] = columns[name][positions]
+        # the history table has NULL references (and not empty arrays) for nodes and ways/relations without members
+        arrays['has_refs'] = np.diff(arrays['ref_offsets']) > 0
+
+        # String pool: all the strings concatenated, string i being strings[string_offsets[i]:string_offsets[i + 1]]
+        encoded = [string.encode() for string in handler.string_codes] # in code order (insertion order)
+        arrays['string_offsets'] = np.zeros(len(encoded) + 1, dtype=np.int64)
+        arrays['string_offsets'][1:] = np.cumsum([len(string) for string in encoded])
+        arrays['strings'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        os.makedirs(directory, exist_ok=True)
+        for name in STORE_ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), arrays[name])
+        return cls.load(directory)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        loads a store saved with 'build', memory-mapped by default (near-zero loading time,
+        only the pages actually needed by the lookups are read from disk)
+
+        Parameters
+        ----------
+        directory : string
+            STORE DIRECTORY.
+        mmap : boolean
+            MEMORY-MAP THE ARRAYS INSTEAD OF READING THEM.
+
+        Returns
+        -------
+        HistoryStore
+
+        """
+        mmap_mode = 'r' if mmap else None
+        return cls({name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in STORE_ARRAYS})
+
+    def __len__(self):
+        return len(self.key)
+
+    def string(self, code):
+        # decoded string of the pool
+        string = self.string_cache.get(code)
+        if string is None:
+            string = self.string_cache[code] = bytes(self.strings[self.string_offsets[code]:self.string_offsets[code + 1]]).decode()
+        return string
+
+    def segment(self, key):
+        # (first, last + 1) positions of the versions of a lookup key
+        return int(np.searchsorted(self.key, key, side='left')), int(np.searchsorted(self.key, key, side='right'))
+
+    def positions(self, osm_id, osm_type=None):
+        """
+        returns the positions of all the versions of a OSM feature, in version order
+
+        Parameters
+        ----------
+        osm_id : int
+            OSM FEATURE ID.
+        osm_type : string, optional
+            OSM FEATURE TYPE (None for all the features sharing the id, as in 'query_versions').
+
+        Returns
+        -------
+        numpy array
+            POSITIONS IN THE COLUMNS.
+
+        """
+        if osm_type is not None:
+            first, end = self.segment(int(osm_id) * 4 + TYPE_CODES[osm_type])
+            return np.arange(first, end)
+        # versions of the three OSM types sharing the id, ordered by (version, id)
+        positions = np.concatenate([np.arange(*self.segment(int(osm_id) * 4 + code)) for code in range(3)])
+        return positions[np.lexsort((self.id[positions], self.version[positions]))]
+
+    def record(self, k):
+        # version k, as a history table row (same Python values as psycopg2 returns)
+        timestamp = int(self.timestamp[k])
+        lat, lon = int(self.lat[k]), int(self.lon[k])
+        refs, types = None, None
+        if self.has_refs[k]:
+            start, end = self.ref_offsets[k], self.ref_offsets[k + 1]
+            refs = self.ref_values[start:end].tolist()
+            if self.osm_type[k] == TYPE_CODES['relation']:
+                types = [OSM_TYPES[code] for code in self.ref_types[start:end]]
+        tag_start, tag_end = self.tag_offsets[k], self.tag_offsets[k + 1]
+        tags = [(self.string(key), self.string(value)) for key, value in zip(self.tag_keys[tag_start:tag_end], self.tag_values[tag_start:tag_end])]
+        return (int(self.id[k]),
+                int(self.osm_id[k]),
+                OSM_TYPES[self.osm_type[k]],
+                int(self.version[k]),
+                EPOCH + datetime.timedelta(seconds=timestamp) if timestamp != NULL_TIMESTAMP else None,
+                int(self.uid[k]) if self.uid[k] != 0 else None,
+                self.string(int(self.user[k])) or None,
+                int(self.changeset_id[k]),
+                bool(self.visible[k]),
+                lat / COORDINATE_PRECISION if lat != NULL_COORDINATE else None,
+                lon / COORDINATE_PRECISION if lon != NULL_COORDINATE else None,
+                refs,
+                hstore_text(tags),
+                types)
+
+    def versions(self, osm_id, osm_type=None):
+        """
+        returns all the versions of a OSM feature, as 'query_versions' does from the history table
+
+        Parameters
+        ----------
+        osm_id : int
+            OSM FEATURE ID.
+        osm_type : string, optional
+            OSM FEATURE TYPE (None for all the features sharing the id).
+
+        Returns
+        -------
+        pandas DataFrame
+            ONE LINE PER VERSION, WITH THE COLUMNS OF THE HISTORY TABLE.
+
+        """
+        return pd.DataFrame([self.record(k) for k in self.positions(osm_id, osm_type)], columns=HISTORY_COLUMNS)
+
+    def version_rows(self, keys):
+        """
+        returns the versions of a set of features in the row format of 'VersionStore.load'
+        (see 'geometry_batch_engine.py'): the store then replaces the database for the batch engine
+
+        Parameters
+        ----------
+        keys : numpy array
+            LOOKUP KEYS (osm_id * 4 + type code, ANY_TYPE FOR A LOOKUP BY ID ONLY).
+
+        Returns
+        -------
+        list of tuples
+            (LOOKUP KEY, OSM TYPE, VERSION, ID, TIMESTAMP (SECONDS), LAT, LON, MEMBERS REFS, MEMBERS TYPES).
+
+        """
+        rows = []
+        for key in np.asarray(keys, dtype=np.int64):
+            osm_id, code = int(key) // 4, int(key) % 4
+            for k in self.positions(osm_id, OSM_TYPES[code] if code != ANY_TYPE else None):
+                timestamp, lat, lon = int(self.timestamp[k]), int(self.lat[k]), int(self.lon[k])
+                refs, types = None, None
+                if self.has_refs[k]:
+                    start, end = self.ref_offsets[k], self.ref_offsets[k + 1]
+                    refs = self.ref_values[start:end].tolist()
+                    if self.osm_type[k] == TYPE_CODES['relation']:
+                        types = [OSM_TYPES[member_code] for member_code in self.ref_types[start:end]]
+                rows.append((int(key), OSM_TYPES[self.osm_type[k]], int(self.version[k]), int(self.id[k]),
+                             timestamp if timestamp != NULL_TIMESTAMP else None,
+                             lat / COORDINATE_PRECISION if lat != NULL_COORDINATE else None,
+                             lon / COORDINATE_PRECISION if lon != NULL_COORDINATE else None,
+                             refs, types))
+        return rows
+
+    def tag_rows(self, keys):
+        """
+        returns the 'visible' flag and the tags of the versions of a set of features,
+        in the row format of 'VersionStore.load_tags' (tags as a dict, the first value being kept for duplicate keys)
+
+        Parameters
+        ----------
+        keys : numpy array
+            LOOKUP KEYS.
+
+        Returns
+        -------
+        list of tuples
+            (LOOKUP KEY, VERSION, ID, VISIBLE, TAGS (None IF NO TAGS)).
+
+        """
+        rows = []
+        for key in np.asarray(keys, dtype=np.int64):
+            osm_id, code = int(key) // 4, int(key) % 4
+            for k in self.positions(osm_id, OSM_TYPES[code] if code != ANY_TYPE else None):
+                tags = {}
+                for tag_key, tag_value in zip(self.tag_keys[self.tag_offsets[k]:self.tag_offsets[k + 1]],
+                                              self.tag_values[self.tag_offsets[k]:self.tag_offsets[k + 1]]):
+                    tags.setdefault(self.string(tag_key), self.string(tag_value))
+                rows.append((int(key), int(self.version[k]), int(self.id[k]), bool(self.visible[k]), tags or None))
+        return rows
+
+    def node_index(self):
+        """
+        returns the node coordinate index of all the node versions of the store (see 'node_index.py'),
+        without going through the database
+
+        Returns
+        -------
+        NodeCoordinateIndex
+
+        """
+        nodes = np.nonzero((np.asarray(self.osm_type) == TYPE_CODES['node']) & (np.asarray(self.timestamp) != NULL_TIMESTAMP))[0]
+        lat = np.where(self.lat[nodes] != NULL_COORDINATE, self.lat[nodes] / COORDINATE_PRECISION, np.nan)
+        lon = np.where(self.lon[nodes] != NULL_COORDINATE, self.lon[nodes] / COORDINATE_PRECISION, np.nan)
+        # node versions are already sorted by (osm_id, version, id)
+        return NodeCoordinateIndex.from_arrays(self.osm_id[nodes], self.timestamp[nodes], lat, lon)
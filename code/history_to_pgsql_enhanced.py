@@ -23,6 +23,12 @@ Created on Wed Jul 19 11:42:19 2023
 """
 User guideline: Please take a look at the 'MAIN' part at the end of this script,
                 so to make the necessary changes to import your own OSM history file !
+
+N.B.: imports are checkpointed (see 'history_import_checkpoints' table): an interrupted import
+      can be resumed from its last committed batch with 'python history_to_pgsql_enhanced.py --resume'
+
+N.B.: an existing history table can be kept up to date with OSM replication diffs (.osc/.osc.gz),
+      instead of importing a new full history file: 'python history_to_pgsql_enhanced.py --update 000/123/456.osc.gz ...'
 """
 
 
@@ -31,25 +37,56 @@ User guideline: Please take a look at the 'MAIN' part at the end of this script,
 ### Librairies import
 
 from tqdm import tqdm    # for displaying the elapsed time after launching the code, and the number of iterations per second
+import os
+import re    # for reading replication sequence numbers from diff filenames
+import argparse    # for the '--resume' command line option
+import time    # for the stage timers (see 'metrics.py')
+from multiprocessing import Pool    # for the parallel import mode (one process and one database connection per worker)
+
 import psycopg2    # PostgreSQL driver for Python support
 from psycopg2 import sql # for generating dynamically SQL queries (for choosing dynamically a table name)
 import lxml.etree    # for processing XML data, using C-based libraries libxml2 and libxslt — superior to the native ElementTree API in terms of processing time and functionalities
 
+import osmium    # PyOsmium, for reading .osh.pbf history files directly (no conversion to XML needed)
+
+from pbf_framing import pbf_blocks    # locates the blocks of .osh.pbf files, for the batches and the parallel import (see 'pbf_framing.py')
+from pgsql_copy import copy_value, copy_array, copy_text_array, copy_hstore, copy_rows, copy_in_batches    # 'COPY FROM STDIN' bulk loading (see 'pgsql_copy.py')
+from metrics import metrics    # stage-level profiling of the imports (see 'metrics.py')
+
 
 
 
 ### Code
 
 
-def history_importer(osm_history_filename, pgsql_tablename='OSM_history'):
+# Column encoders for the 'COPY' bulk loading mode (same column order as the history table)
+HISTORY_COPY_ENCODERS = [copy_value] * 11 + [copy_array, copy_hstore, copy_text_array]
+
+# PyOsmium relation member types
+MEMBER_TYPES = {'n': 'node', 'w': 'way', 'r': 'relation'}
+
+# Parallel PBF import: primary key = block index * BLOCK_KEY_STRIDE + rank of the feature version in its block
+# (unique and deterministic whatever the number of workers, as a PBF block never holds that many objects)
+BLOCK_KEY_STRIDE = 2 ** 32
+
+# Table recording the progress of every import (see 'save_checkpoint')
+CHECKPOINT_TABLENAME = 'history_import_checkpoints'
+
+# Table recording the last replication diff applied to each history table (see 'history_diff_updater')
+REPLICATION_STATE_TABLENAME = 'history_replication_state'
+
+# Replication diff path: .../AAA/BBB/CCC.osc(.gz) -> sequence number AAABBBCCC
+REPLICATION_PATH_PATTERN = re.compile(r'(\d{3})[/\\](\d{3})[/\\](\d{3})\.osc(\.gz)?$')
+
+
+
+def create_history_table(pgsql_tablename):
     """
-    imports an OSM history file (XML) as a new table in the PostgreSQL database
-    provided by the user in the 'MAIN'
+    creates a new PostgreSQL table for hosting history data, if it does not exist yet
+    (an existing table is kept as it is: new feature versions are appended to it)
 
     Parameters
     ----------
-    osm_history_filename : string
-        OSM history filename with its extension.
     pgsql_tablename : string
         Tablename for output PostgreSQL table.
 
@@ -58,9 +95,7 @@ def history_importer(osm_history_filename, pgsql_tablename='OSM_history'):
     None.
 
     """
-    
-    # Creating a new PostgreSQL table for hosting history data
-    cur.execute(sql.SQL("""CREATE TABLE public.{}
+    cur.execute(sql.SQL("""CREATE TABLE IF NOT EXISTS public.{}
 (
     id bigint,
     osm_id bigint,
@@ -75,206 +110,951 @@ def history_importer(osm_history_filename, pgsql_tablename='OSM_history'):
     lon double precision,
     members_refs bigint[],
     other_tags hstore,
+    members_types text[],
     PRIMARY KEY (id)
 );""").format(sql.Identifier(pgsql_tablename)))
     
     # Making the previous change to the database persistent
     conn.commit()
+
+
+
+def create_checkpoint_table():
+    """
+    creates the PostgreSQL table recording the progress of the imports, if it does not exist yet:
+    one row per import task (a single task, 0, for the sequential imports; one per range of
+    PBF blocks for the parallel import), updated in the same transaction as the imported data
+
+    Returns
+    -------
+    None.
+
+    """
+    cur.execute(sql.SQL("""CREATE TABLE IF NOT EXISTS public.{}
+(
+    tablename text,
+    task bigint,
+    filename text,
+    first_id bigint,
+    "position" bigint,
+    last_id bigint,
+    completed boolean,
+    updated_at timestamp without time zone DEFAULT now(),
+    PRIMARY KEY (tablename, task)
+);""").format(sql.Identifier(CHECKPOINT_TABLENAME)))
     
+    # Making the previous change to the database persistent
+    conn.commit()
 
-    with open(osm_history_filename, "rb") as f:
-        
-        id_primary_key = 0
+
+
+def save_checkpoint(cur, pgsql_tablename, osm_history_filename, first_id, position, last_id, task=0, completed=False):
+    """
+    records the progress of an import task (N.B.: not committed here, so that the checkpoint
+    is committed together with the batch of feature versions it describes)
+
+    Parameters
+    ----------
+    cur : psycopg2 cursor
+        DATABASE CURSOR.
+    pgsql_tablename : string
+        TABLENAME OF THE HISTORY TABLE.
+    osm_history_filename : string
+        OSM HISTORY FILENAME.
+    first_id : int
+        FIRST PRIMARY KEY OF THE TASK (MINUS ONE).
+    position : int
+        POSITION IN THE INPUT FILE: (APPROXIMATE) BYTE OFFSET FOR XML FILES, INDEX OF THE NEXT BLOCK FOR PBF FILES.
+    last_id : int
+        LAST PRIMARY KEY COMMITTED (PARALLEL IMPORT: LAST PRIMARY KEY OF THE TASK RANGE).
+    task : int
+        TASK NUMBER (0 FOR THE SEQUENTIAL IMPORTS, FIRST BLOCK INDEX FOR THE PARALLEL IMPORT).
+    completed : boolean
+        TRUE ONCE THE TASK IS OVER.
+
+    Returns
+    -------
+    None.
+
+    """
+    cur.execute(sql.SQL("""INSERT INTO {} (tablename, task, filename, first_id, "position", last_id, completed, updated_at)
+VALUES (%s, %s, %s, %s, %s, %s, %s, now())
+ON CONFLICT (tablename, task) DO UPDATE SET filename = EXCLUDED.filename, first_id = EXCLUDED.first_id, "position" = EXCLUDED."position",
+last_id = EXCLUDED.last_id, completed = EXCLUDED.completed, updated_at = EXCLUDED.updated_at;""").format(sql.Identifier(CHECKPOINT_TABLENAME)),
+                (pgsql_tablename, task, osm_history_filename, first_id, position, last_id, completed))
+
+
+
+def load_checkpoints(pgsql_tablename, osm_history_filename):
+    """
+    returns the recorded progress of the import of a file into a table
+
+    Parameters
+    ----------
+    pgsql_tablename : string
+        TABLENAME OF THE HISTORY TABLE.
+    osm_history_filename : string
+        OSM HISTORY FILENAME.
+
+    Returns
+    -------
+    list of tuples
+        (task, first_id, position, last_id, completed) PER TASK, SORTED BY TASK (EMPTY IF NO CHECKPOINT).
+
+    """
+    cur.execute(sql.SQL("""SELECT task, first_id, "position", last_id, completed FROM {}
+WHERE tablename = %s AND filename = %s ORDER BY task;""").format(sql.Identifier(CHECKPOINT_TABLENAME)),
+                (pgsql_tablename, osm_history_filename))
+    return cur.fetchall()
+
+
+
+def start_import(pgsql_tablename, osm_history_filename, resume):
+    """
+    prepares the history and checkpoint tables before an import, and returns the checkpoints to resume from:
+        - if 'resume' is True and the import of this file has been checkpointed, it is continued,
+        - otherwise, a new import starts, appended to the existing feature versions (if any).
+
+    Parameters
+    ----------
+    pgsql_tablename : string
+        TABLENAME OF THE HISTORY TABLE.
+    osm_history_filename : string
+        OSM HISTORY FILENAME.
+    resume : boolean
+        RESUME THE IMPORT FROM ITS LAST CHECKPOINT.
+
+    Returns
+    -------
+    checkpoints : list of tuples
+        SEE 'load_checkpoints' (EMPTY FOR A NEW IMPORT).
+    max_id : int
+        GREATEST PRIMARY KEY ALREADY IN THE TABLE (0 IF EMPTY).
+
+    """
+    create_history_table(pgsql_tablename)
+    create_checkpoint_table()
+    
+    checkpoints = load_checkpoints(pgsql_tablename, osm_history_filename) if resume else []
+    if resume and not checkpoints:
+        print("\n\n No checkpoint found for '", osm_history_filename, "' in '", pgsql_tablename, "': starting a new import.")
+    
+    if not checkpoints:
+        # New import: previous checkpoints of this table are dropped
+        cur.execute(sql.SQL("DELETE FROM {} WHERE tablename = %s;").format(sql.Identifier(CHECKPOINT_TABLENAME)), (pgsql_tablename,))
+        conn.commit()
+    
+    cur.execute(sql.SQL("SELECT COALESCE(MAX(id), 0) FROM public.{};").format(sql.Identifier(pgsql_tablename)))
+    max_id = cur.fetchone()[0]
+    if max_id > 0 and not checkpoints:
+        print("\n\n N.B.: '", pgsql_tablename, "' already holds feature versions, the new ones are appended after them (primary keys >", max_id, ").")
+    
+    return checkpoints, max_id
+
+
+
+def create_history_indexes(pgsql_tablename, timestamp_index=False, changeset_index=False):
+    """
+    creates the indexes of the history table, once the data is loaded
+    (building them at the end is much faster than updating them for every inserted row):
+        - (osm_type, osm_id, version), used by every lookup of the analysis ('osm_versions'),
+        - optionally "timestamp" and changeset_id.
+
+    Parameters
+    ----------
+    pgsql_tablename : string
+        Tablename of the history table.
+    timestamp_index : boolean
+        Also index the "timestamp" column.
+    changeset_index : boolean
+        Also index the changeset_id column.
+
+    Returns
+    -------
+    None.
+
+    """
+    
+    print("\n\n Creating indexes... ")
     
+    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON public.{} (osm_type, osm_id, version);").format(
+        sql.Identifier(pgsql_tablename + '_type_id_version_idx'), sql.Identifier(pgsql_tablename)))
+    if timestamp_index:
+        cur.execute(sql.SQL('CREATE INDEX IF NOT EXISTS {} ON public.{} ("timestamp");').format(
+            sql.Identifier(pgsql_tablename + '_timestamp_idx'), sql.Identifier(pgsql_tablename)))
+    if changeset_index:
+        cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON public.{} (changeset_id);").format(
+            sql.Identifier(pgsql_tablename + '_changeset_id_idx'), sql.Identifier(pgsql_tablename)))
+    
+    # Refreshing the planner statistics, so that the new indexes are used right away
+    cur.execute(sql.SQL("ANALYZE public.{};").format(sql.Identifier(pgsql_tablename)))
+    
+    # Making the previous change to the database persistent
+    conn.commit()
+
+
+
+def parse_history(f, id_primary_key=0):
+    """
+    [GENERATOR]
+    parses an OSM history file (XML) on-the-fly and yields one record per feature version,
+    in the column order of the history table
+
+    Parameters
+    ----------
+    f : file object
+        OSM HISTORY FILE OPENED IN BINARY MODE.
+    id_primary_key : int
+        PRIMARY KEY OF THE FIRST FEATURE VERSION, MINUS ONE (KEYS ARE CONSECUTIVE).
+
+    Yields
+    ------
+    history_record : list
+        [id, osm_id, osm_type, version, timestamp, uid, user, changeset_id, visible,
+         lat, lon, members_refs, other_tags, members_types]
+
+    """
+    
+    # Members and tags read before their feature (see (A) below)
+    next_members_refs = []
+    next_members_types = [] # type of each referenced member of a relation (node/way/relation)
+    next_additional_tags = []
+    
+    for event, child in tqdm(lxml.etree.iterparse(f)):
         
-        print("\n\n Parsing history from XML, on-the-fly importing... ")
-        print("\n N.B.: For reference, importing a 7.73GB history file took me 1:30h (around 22 million feature versions). Please also consider your memory capacity!")
-        print("\n\n ** Ongoing process, please make sure the screen saver mode is disabled on your computer! (otherwise the kernel will be interrupted!) **")
         
-        for event, child in tqdm(lxml.etree.iterparse(f)):
-            
-            
-            osm_type = child.tag
+        osm_type = child.tag
+        
+        if osm_type == 'osm':
+            # Ignore 'OSM' XML tag (metadata)
+            continue
+        
+        if osm_type in ['node', 'way', 'relation']:
             
-            if osm_type == 'osm':
-                # Ignore 'OSM' XML tag (metadata)
-                continue
+            try:
+                if osm_id == child.attrib['id'] and version == child.attrib['version']:
+                    """ The closing XML tag for a OSM feature can either be '/>' or either like '</feature_type>'.
+                    In the case it is '</feature_type>', we jump directly to the next iteration, as the iterparse function considers this closing XML tag as a OSM feature in its own right
+                    with all the information related to the very previous feature """
+                    continue
+            except UnboundLocalError: # triggered only once at the first iteration since both 'osm_id' and 'version' are not initialised yet!
+                pass
             
-            if osm_type in ['node', 'way', 'relation']:
-                
-                try:
-                    if osm_id == child.attrib['id'] and version == child.attrib['version']:
-                        """ The closing XML tag for a OSM feature can either be '/>' or either like '</feature_type>'.
-                        In the case it is '</feature_type>', we jump directly to the next iteration, as the iterparse function considers this closing XML tag as a OSM feature in its own right
-                        with all the information related to the very previous feature """
-                        continue
-                except UnboundLocalError: # triggered only once at the first iteration since both 'osm_id' and 'version' are not initialised yet!
-                    pass
-                
-                osm_id = child.attrib['id']
-                version = child.attrib['version']
+            osm_id = child.attrib['id']
+            version = child.attrib['version']
 
-                id_primary_key += 1 # inserting a new id column so every record has a unique identifier
-                                    # (one feature can have several versions using the same feature ID!)
-                # every try/except below is meant to test if the related info exists!
-                try:
-                    timestamp = child.attrib['timestamp']
-                except KeyError:
-                    timestamp = None
-                try:
-                    uid = child.attrib['uid']
-                except KeyError:
-                    uid = None
-                try:
-                    user = child.attrib['user']
-                except KeyError:
-                    user = None
+            id_primary_key += 1 # inserting a new id column so every record has a unique identifier
+                                # (one feature can have several versions using the same feature ID!)
+            # every try/except below is meant to test if the related info exists!
+            try:
+                timestamp = child.attrib['timestamp']
+            except KeyError:
+                timestamp = None
+            try:
+                uid = child.attrib['uid']
+            except KeyError:
+                uid = None
+            try:
+                user = child.attrib['user']
+            except KeyError:
+                user = None
+            try:
+                changeset_id = child.attrib['changeset']
+            except KeyError:
+                changeset_id = None
+            try:
+                visible = child.attrib['visible']
+            except KeyError:
+                visible = None
+        
+            
+            if osm_type == 'node': # if the OSM object is a node
                 try:
-                    changeset_id = child.attrib['changeset']
+                    lat = child.attrib['lat']
                 except KeyError:
-                    changeset_id = None
+                    lat = None
                 try:
-                    visible = child.attrib['visible']
+                    lon = child.attrib['lon']
                 except KeyError:
-                    visible = None
-            
-                
-                if osm_type == 'node': # if the OSM object is a node
-                    try:
-                        lat = child.attrib['lat']
-                    except KeyError:
-                        lat = None
-                    try:
-                        lon = child.attrib['lon']
-                    except KeyError:
-                        lon = None
-                else:
-                    lat = None
                     lon = None
-                    
-                
-                
-                # Saving currently available data on the current OSM feature in a list
-                history_record = [id_primary_key, 
-                                        osm_id,
-                                        osm_type,
-                                        version, 
-                                        timestamp, 
-                                        uid,
-                                        user,
-                                        changeset_id,
-                                        visible,
-                                        lat,
-                                        lon]
-                
-                """
-                    (A): The 'etree.iterparse' method from lxml read all tags and members related to any OSM feature before the feature itself. Below, we retrieve any additional information
-                    about the current OSM feature, and append it to the end of 'history_record' list.
-                """
-                
-                try:
-                    if len(next_members_refs) > 0:
-                        # If member references were read
-                        history_record.append(next_members_refs)
-                    else:
-                        history_record.append(None)
-                except UnboundLocalError: # triggered only once at the first iteration since 'next_members_refs' is not initialised yet!
-                    history_record.append(None)
-                    
-                    
-                try:
-                    if len(next_additional_tags) > 0:
-                        # If tags were read
-                        history_record.append(next_additional_tags)
-                    else:
-                        history_record.append(None)
-                except UnboundLocalError: # triggered only once at the first iteration since 'next_additional_tags' is not initialised yet!
-                    history_record.append(None)
-                
+            else:
+                lat = None
+                lon = None
                 
-                """
-                    No more information about the current OSM feature is contained in the XML file, we proceed with the insertion phase.
-                """
+            
+            
+            # Saving currently available data on the current OSM feature in a list
+            history_record = [id_primary_key, 
+                                    osm_id,
+                                    osm_type,
+                                    version, 
+                                    timestamp, 
+                                    uid,
+                                    user,
+                                    changeset_id,
+                                    visible,
+                                    lat,
+                                    lon]
+            
+            """
+                (A): The 'etree.iterparse' method from lxml read all tags and members related to any OSM feature before the feature itself. Below, we retrieve any additional information
+                about the current OSM feature, and append it to the end of 'history_record' list.
+            """
+            
+            if len(next_members_refs) > 0:
+                # If member references were read
+                history_record.append(next_members_refs)
+            else:
+                history_record.append(None)
                 
-                # SQL query for inserting the data
-                # N.B.: the 'INSERT' operation is repeated over all the OSM feature versions in the OSM history file
-                cur.execute(sql.SQL("""INSERT INTO {} VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, hstore(%s));""").format(sql.Identifier(pgsql_tablename)), history_record)
+            if len(next_additional_tags) > 0:
+                # If tags were read
+                history_record.append(next_additional_tags)
+            else:
+                history_record.append(None)
+            
+            if len(next_members_types) > 0:
+                # If relation members were read (way members are always nodes, their types are not stored)
+                history_record.append(next_members_types)
+            else:
+                history_record.append(None)
+            
+            
+            """
+                No more information about the current OSM feature is contained in the XML file, we hand it over for insertion.
+            """
+            
+            yield history_record
+            
+            
+            # Variable initialisation for the next iteration
+            # N.B.: new lists are created (no in-place clearing), as the yielded record may still be held by the caller (batch)
+            next_members_refs = []
+            next_members_types = []
+            next_additional_tags = []
+            
+            
+            
+            
+        
+        else:
+            # if the XML element is actually a OSM tag
+            """
+                See (A).
+            """
+    
+
+            # if the tag is a referenced member of a way or a relation 
+            if osm_type == "nd" or osm_type == "member":
                 
-                # Make the changes to the database persistent
-                conn.commit()
+                member_id = int(child.attrib['ref'])
+                next_members_refs.append(member_id)
                 
-                # Freeing the memory
-                del history_record
+                if osm_type == "member":
+                    next_members_types.append(child.attrib['type'])
                 
+            
+            # if the tag is just a common attribute
+            else:
                 
-                # Freeing memory and variable initialisation for the next iteration
-                try:
-                    del next_members_refs
-                except NameError: # triggered only once at the first iteration since 'next_members_refs' is not initialised yet!
-                    pass
-                next_members_refs = []
-                try:
-                    del next_additional_tags
-                except NameError: # triggered only once at the first iteration since 'next_additional_tags' is not initialised yet!
-                    pass
-                next_additional_tags = []
+                key = child.attrib['k']
+                value = child.attrib['v']
                 
+                tag = [key,value]
                 
+                next_additional_tags.append(tag)
                 
                 
+        # Freeing the memory for the next iteration
+        child.clear()
+
+
+
+def history_importer(osm_history_filename, pgsql_tablename='OSM_history', bulk=False, batch_size=50000,
+                     timestamp_index=False, changeset_index=False, resume=False):
+    """
+    imports an OSM history file (XML) as a new table in the PostgreSQL database
+    provided by the user in the 'MAIN' (appended to the table if it already exists)
+    
+    N.B.: the progress is checkpointed with every commit (see 'save_checkpoint'); when resuming,
+          the file is parsed again from its beginning (XML cannot be split safely), but the
+          feature versions already committed are skipped instead of being sent again
+
+    Parameters
+    ----------
+    osm_history_filename : string
+        OSM history filename with its extension.
+    pgsql_tablename : string
+        Tablename for output PostgreSQL table.
+    bulk : boolean
+        If True, records are streamed with 'COPY FROM STDIN' and committed once per batch,
+        instead of one 'INSERT' and one commit per feature version (same table content, much faster).
+    batch_size : int
+        Number of feature versions sent per 'COPY' statement (bulk mode only).
+    timestamp_index, changeset_index : boolean
+        Also index the "timestamp"/changeset_id columns (see 'create_history_indexes').
+    resume : boolean
+        Resume the import of this file from its last checkpoint (see 'start_import').
+
+    Returns
+    -------
+    None.
+
+    """
+    
+    # Creating the PostgreSQL table for hosting history data (if needed), and looking for a checkpoint
+    checkpoints, max_id = start_import(pgsql_tablename, osm_history_filename, resume)
+    
+    if checkpoints:
+        task, first_id, position, last_id, completed = checkpoints[0]
+        print("\n\n Resuming the import after", last_id - first_id, "feature versions (around", round(position / 1024 ** 2), "MB of the file)...")
+    else:
+        first_id = last_id = max_id
+        completed = False
+    
+
+    with open(osm_history_filename, "rb") as f:
+        
+        if completed:
+            print("\n\n The import of this file is already completed!")
+        
+        else:
+            print("\n\n Parsing history from XML, on-the-fly importing... ")
+            if bulk:
+                print("\n N.B.: Bulk mode ('COPY FROM STDIN'), one commit every", batch_size, "feature versions.")
+            else:
+                print("\n N.B.: For reference, importing a 7.73GB history file took me 1:30h (around 22 million feature versions). Please also consider your memory capacity!")
+            print("\n\n ** Ongoing process: if it gets interrupted, it can be resumed from its last commit (resume=True / '--resume') **")
+            
+            # Feature versions already committed (resumed import) are skipped
+            history_records = (history_record for history_record in parse_history(f, first_id) if history_record[0] > last_id)
+            
+            def checkpoint(cur, batch):
+                # committed together with the batch (see 'copy_in_batches')
+                save_checkpoint(cur, pgsql_tablename, osm_history_filename, first_id, f.tell(), batch[-1][0])
+            
+            if bulk:
+                copy_in_batches(conn, pgsql_tablename, history_records, HISTORY_COPY_ENCODERS, batch_size, on_batch=checkpoint)
             
             else:
-                # if the XML element is actually a OSM tag
-                """
-                    See (A).
-                """
-        
-    
-                # if the tag is a referenced member of a way or a relation 
-                if osm_type == "nd" or osm_type == "member":
-                    
-                    member_id = int(child.attrib['ref'])
-                    next_members_refs.append(member_id)
+                for history_record in metrics.timed_iter(history_records, 'parse'):
                     
-                
-                # if the tag is just a common attribute
-                else:
-                    
-                    key = child.attrib['k']
-                    value = child.attrib['v']
-                    
-                    tag = [key,value]
+                    # SQL query for inserting the data
+                    # N.B.: the 'INSERT' operation is repeated over all the OSM feature versions in the OSM history file
+                    with metrics.timer('db_execute'):
+                        cur.execute(sql.SQL("""INSERT INTO {} VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, hstore(%s), %s);""").format(sql.Identifier(pgsql_tablename)), history_record)
+                        checkpoint(cur, [history_record])
+                    metrics.count('records')
                     
-                    next_additional_tags.append(tag)
-                    
-                    
-            # Freeing the memory for the next iteration
-            child.clear()
+                    # Make the changes to the database persistent
+                    with metrics.timer('commit'):
+                        conn.commit()
+            
+            # Marking the import as completed
+            cur.execute(sql.SQL("UPDATE {} SET completed = true, updated_at = now() WHERE tablename = %s AND task = 0;").format(sql.Identifier(CHECKPOINT_TABLENAME)), (pgsql_tablename,))
+            conn.commit()
+
+    # Indexing the loaded data (see 'create_history_indexes')
+    create_history_indexes(pgsql_tablename, timestamp_index, changeset_index)
+
+    print("\n\n Process completed! \n Your OSM history file content should now be appearing in your '", pgsql_tablename, "' PostgreSQL table!")
+
+
+
+
+class HistoryHandler(osmium.SimpleHandler):
+    """
+    PyOsmium handler reading every version of every feature from a .osh.pbf history file,
+    and sending them to the history table with 'COPY FROM STDIN' every 'batch_size' versions
+    (or only when 'flush' is called, if 'batch_size' is None)
+    """
+    def __init__(self, pgsql_tablename, batch_size=50000, progress=True):
+        osmium.SimpleHandler.__init__(self)
+        self.pgsql_tablename = pgsql_tablename
+        self.batch_size = batch_size
+        self.id_primary_key = 0
+        self.history_records = []
+        self.progress = tqdm(disable=not progress)
+        
+    def add_record(self, o, osm_type, lat, lon, members_refs, members_types=None):
+        # N.B.: PyOsmium objects are only valid inside the callbacks, everything is copied here
+        start = time.perf_counter()
+        self.id_primary_key += 1 # same unique identifier as the XML import (one per feature version)
+        additional_tags = [[tag.k, tag.v] for tag in o.tags]
+        self.history_records.append([self.id_primary_key,
+                                     o.id,
+                                     osm_type,
+                                     o.version,
+                                     o.timestamp,
+                                     o.uid if o.uid != 0 else None, # anonymous edits (no 'uid' attribute in XML)
+                                     o.user if o.user != '' else None,
+                                     o.changeset,
+                                     o.visible,
+                                     lat,
+                                     lon,
+                                     members_refs if len(members_refs) > 0 else None,
+                                     additional_tags if len(additional_tags) > 0 else None,
+                                     members_types if members_types else None])
+        metrics.add_time('build', time.perf_counter() - start)
+        self.progress.update()
+        if self.batch_size is not None and len(self.history_records) >= self.batch_size:
+            self.flush()
+        
+    def node(self, n):
+        if n.location.valid():
+            self.add_record(n, 'node', n.location.lat, n.location.lon, [])
+        else:
+            # deleted node versions have no coordinates
+            self.add_record(n, 'node', None, None, [])
+        
+    def way(self, w):
+        self.add_record(w, 'way', None, None, [nd.ref for nd in w.nodes])
+        
+    def relation(self, r):
+        members = [(member.ref, MEMBER_TYPES[member.type]) for member in r.members]
+        self.add_record(r, 'relation', None, None, [ref for ref, member_type in members], [member_type for ref, member_type in members])
+        
+    def apply_block(self, data_block):
+        # Reading a raw PBF block: the 'parse' stage is the time spent in PyOsmium itself, i.e. without the
+        # callbacks ('build') and the batches they may send ('encode', 'db_execute', 'commit')
+        callbacks_seconds = sum([metrics.seconds(stage) for stage in ('build', 'encode', 'db_execute', 'commit')])
+        start = time.perf_counter()
+        self.apply_buffer(data_block, 'osh.pbf')
+        callbacks_seconds = sum([metrics.seconds(stage) for stage in ('build', 'encode', 'db_execute', 'commit')]) - callbacks_seconds
+        metrics.add_time('parse', time.perf_counter() - start - callbacks_seconds)
+        
+    def flush(self, on_flush=None):
+        # Sending the pending records in one 'COPY' statement, then making them persistent
+        # ('on_flush(cur)' is run before the commit, e.g. for saving a checkpoint in the same transaction)
+        if self.history_records:
+            copy_rows(cur, self.pgsql_tablename, self.history_records, HISTORY_COPY_ENCODERS)
+        if on_flush is not None:
+            on_flush(cur)
+        with metrics.timer('commit'):
+            conn.commit()
+        self.history_records = []
+
+
+
+def history_pbf_importer(osm_history_filename, pgsql_tablename='OSM_history', batch_size=50000,
+                         timestamp_index=False, changeset_index=False, resume=False):
+    """
+    imports an OSM history file (.osh.pbf) as a new table in the PostgreSQL database
+    provided by the user in the 'MAIN', reading it natively with PyOsmium
+    (same table structure as 'history_importer', without the 'osmium cat' conversion to XML)
+    
+    N.B.: the file is read block by block (see 'pbf_blocks'), and batches are committed at block
+          boundaries together with a checkpoint (index of the next block, last primary key),
+          so that an interrupted import can be resumed at the first block not committed
+
+    Parameters
+    ----------
+    osm_history_filename : string
+        OSM history filename with its extension (.osh.pbf).
+    pgsql_tablename : string
+        Tablename for output PostgreSQL table.
+    batch_size : int
+        Number of feature versions sent per 'COPY' statement (at least, as batches end with a block).
+    timestamp_index, changeset_index : boolean
+        Also index the "timestamp"/changeset_id columns (see 'create_history_indexes').
+    resume : boolean
+        Resume the import of this file from its last checkpoint (see 'start_import').
+
+    Returns
+    -------
+    None.
+
+    """
+    
+    # Creating the PostgreSQL table for hosting history data (if needed), and looking for a checkpoint
+    checkpoints, max_id = start_import(pgsql_tablename, osm_history_filename, resume)
+    
+    if checkpoints:
+        task, first_id, next_block, last_id, completed = checkpoints[0]
+        print("\n\n Resuming the import at block", next_block, "(", last_id - first_id, "feature versions already imported)...")
+    else:
+        first_id = last_id = max_id
+        next_block = 0
+    
+    header_block, data_blocks = pbf_blocks(osm_history_filename)
+    
+    print("\n\n Reading history from PBF, on-the-fly importing... ")
+    
+    historyHandler = HistoryHandler(pgsql_tablename, batch_size=None) # flushed at block boundaries only (see below)
+    historyHandler.id_primary_key = last_id
+    
+    with open(osm_history_filename, "rb") as f:
+        for block_index in range(next_block, len(data_blocks)):
+            offset, size = data_blocks[block_index]
+            f.seek(offset)
+            historyHandler.apply_block(header_block + f.read(size))
+            
+            last_block = block_index == len(data_blocks) - 1
+            if len(historyHandler.history_records) >= batch_size or last_block:
+                historyHandler.flush(lambda cur: save_checkpoint(cur, pgsql_tablename, osm_history_filename, first_id, block_index + 1,
+                                                                 historyHandler.id_primary_key, completed=last_block))
+    historyHandler.progress.close()
+
+    # Indexing the loaded data (see 'create_history_indexes')
+    create_history_indexes(pgsql_tablename, timestamp_index, changeset_index)
 
     print("\n\n Process completed! \n Your OSM history file content should now be appearing in your '", pgsql_tablename, "' PostgreSQL table!")
 
 
 
 
+def init_import_worker(connection_parameters):
+    """
+    [PARALLEL IMPORT] initialises a worker process with its own PostgreSQL connection
+    (module-level 'conn' and 'cur', as in the 'MAIN')
+
+    Parameters
+    ----------
+    connection_parameters : dict
+        psycopg2.connect KEYWORD ARGUMENTS.
+
+    Returns
+    -------
+    None.
+
+    """
+    global conn, cur
+    conn = psycopg2.connect(**connection_parameters)
+    cur = conn.cursor()
+
+
+
+def import_pbf_blocks(task):
+    """
+    [PARALLEL IMPORT] imports a range of consecutive PBF blocks into the history table
+    (run by a worker process, see 'parallel_history_pbf_importer')
+
+    Parameters
+    ----------
+    task : tuple
+        (OSM HISTORY FILENAME, TABLENAME, BATCH SIZE, RAW 'OSMHeader' BLOCK,
+         INDEX OF THE FIRST BLOCK, FIRST PRIMARY KEY OF THE TASK (MINUS ONE), LIST OF (OFFSET, SIZE) OF THE BLOCKS).
+
+    Returns
+    -------
+    tuple
+        (NUMBER OF FEATURE VERSIONS IMPORTED, METRICS OF THE TASK (SEE 'metrics.py')).
+
+    """
+    osm_history_filename, pgsql_tablename, batch_size, header_block, first_block_index, first_id, blocks = task
+    metrics.reset() # metrics of this task only, merged by the main process
+    
+    historyHandler = HistoryHandler(pgsql_tablename, batch_size, progress=False)
+    nb_records = 0
+    
+    with open(osm_history_filename, "rb") as f:
+        for i, (offset, size) in enumerate(blocks):
+            f.seek(offset)
+            data_block = f.read(size)
+            
+            # Deterministic primary keys: they only depend on the block index (see 'BLOCK_KEY_STRIDE')
+            block_first_id = first_id + i * BLOCK_KEY_STRIDE
+            historyHandler.id_primary_key = block_first_id
+            historyHandler.apply_block(header_block + data_block)
+            nb_records += historyHandler.id_primary_key - block_first_id
+    
+    # remaining records (last, incomplete batch), committed with the completion of the task
+    historyHandler.flush(lambda cur: save_checkpoint(cur, pgsql_tablename, osm_history_filename, first_id, first_block_index,
+                                                     first_id + len(blocks) * BLOCK_KEY_STRIDE - 1, task=first_block_index, completed=True))
+    return nb_records, metrics.collect()
+
+
+
+def parallel_history_pbf_importer(osm_history_filename, connection_parameters, pgsql_tablename='OSM_history',
+                                  nb_workers=None, blocks_per_task=16, batch_size=50000,
+                                  timestamp_index=False, changeset_index=False, resume=False):
+    """
+    imports an OSM history file (.osh.pbf) as a new table in the PostgreSQL database,
+    splitting its PBF blocks across a pool of processes, each one with its own database connection.
+    
+    N.B.: primary keys are block-based ('BLOCK_KEY_STRIDE'), so they are unique and always the same for a
+          given file, but not consecutive as in 'history_pbf_importer'.
+          XML history files cannot be split safely, please use the .osh.pbf file for this mode.
+          Every task is checkpointed when it is over: when resuming, the unfinished tasks are rolled back
+          (their primary key ranges are known) and imported again.
+
+    Parameters
+    ----------
+    osm_history_filename : string
+        OSM history filename with its extension (.osh.pbf).
+    connection_parameters : dict
+        psycopg2.connect keyword arguments, used by every worker.
+    pgsql_tablename : string
+        Tablename for output PostgreSQL table.
+    nb_workers : int
+        Number of worker processes (default: number of CPU cores).
+    blocks_per_task : int
+        Number of consecutive PBF blocks handed to a worker at once.
+    batch_size : int
+        Number of feature versions sent per 'COPY' statement, per worker.
+    timestamp_index, changeset_index : boolean
+        Also index the "timestamp"/changeset_id columns (see 'create_history_indexes').
+    resume : boolean
+        Resume the import of this file from its last checkpoints (see 'start_import').
+
+    Returns
+    -------
+    None.
+
+    """
+    
+    # Creating the PostgreSQL table for hosting history data (if needed), and looking for checkpoints
+    checkpoints, max_id = start_import(pgsql_tablename, osm_history_filename, resume)
+    
+    header_block, data_blocks = pbf_blocks(osm_history_filename)
+    
+    if checkpoints:
+        # Resumed import: the tasks recorded at the beginning of the import, except the completed ones,
+        # whose partially imported feature versions are deleted first
+        tasks = []
+        for task, first_id, first_block_index, last_id, completed in checkpoints:
+            if completed:
+                continue
+            cur.execute(sql.SQL("DELETE FROM public.{} WHERE id > %s AND id <= %s;").format(sql.Identifier(pgsql_tablename)), (first_id, last_id))
+            nb_blocks = (last_id - first_id + 1) // BLOCK_KEY_STRIDE
+            tasks.append((osm_history_filename, pgsql_tablename, batch_size, header_block, first_block_index, first_id,
+                          data_blocks[first_block_index:first_block_index + nb_blocks]))
+        conn.commit()
+        print("\n\n Resuming the import:", len(checkpoints) - len(tasks), "tasks out of", len(checkpoints), "already completed...")
+    
+    else:
+        # New import: primary keys start after the existing ones, at a block boundary
+        base_key = -(-max_id // BLOCK_KEY_STRIDE) * BLOCK_KEY_STRIDE
+        tasks = [(osm_history_filename, pgsql_tablename, batch_size, header_block, i, base_key + i * BLOCK_KEY_STRIDE, data_blocks[i:i + blocks_per_task])
+                 for i in range(0, len(data_blocks), blocks_per_task)]
+        
+        # All the tasks are recorded (not completed yet), with their primary key ranges
+        for task in tasks:
+            first_block_index, first_id, blocks = task[4], task[5], task[6]
+            save_checkpoint(cur, pgsql_tablename, osm_history_filename, first_id, first_block_index,
+                            first_id + len(blocks) * BLOCK_KEY_STRIDE - 1, task=first_block_index)
+        conn.commit()
+    
+    if nb_workers is None:
+        nb_workers = os.cpu_count()
+    
+    print("\n\n Reading history from PBF with", nb_workers, "workers (", len(data_blocks), "blocks ), on-the-fly importing... ")
+    
+    nb_records = 0
+    with Pool(nb_workers, initializer=init_import_worker, initargs=(connection_parameters,)) as pool:
+        for nb_task_records, task_metrics in tqdm(pool.imap_unordered(import_pbf_blocks, tasks), total=len(tasks)):
+            nb_records += nb_task_records
+            metrics.merge(task_metrics) # (stage times summed over the workers)
+    
+    # Indexing the loaded data (see 'create_history_indexes')
+    create_history_indexes(pgsql_tablename, timestamp_index, changeset_index)
+    
+    print("\n\n Process completed! \n", nb_records, "feature versions should now be appearing in your '", pgsql_tablename, "' PostgreSQL table!")
+
+
+
+
+def create_replication_tables(pgsql_tablename):
+    """
+    creates, if they do not exist yet, the PostgreSQL tables used by the incremental updates:
+        - 'history_replication_state': last replication sequence number applied to each history table,
+        - '<history table>_touched': features whose history has been updated (new versions),
+          to be recomputed by the analysis (see 'typology_modif_encoding_copy.py').
+
+    Parameters
+    ----------
+    pgsql_tablename : string
+        Tablename of the history table.
+
+    Returns
+    -------
+    None.
+
+    """
+    cur.execute(sql.SQL("""CREATE TABLE IF NOT EXISTS public.{}
+(
+    tablename text,
+    sequence bigint,
+    filename text,
+    updated_at timestamp without time zone DEFAULT now(),
+    PRIMARY KEY (tablename)
+);""").format(sql.Identifier(REPLICATION_STATE_TABLENAME)))
+    
+    cur.execute(sql.SQL("""CREATE TABLE IF NOT EXISTS public.{}
+(
+    osm_type text,
+    osm_id bigint,
+    sequence bigint,
+    PRIMARY KEY (osm_type, osm_id)
+);""").format(sql.Identifier(pgsql_tablename + '_touched')))
+    
+    # Making the previous change to the database persistent
+    conn.commit()
+
+
+
+def replication_sequence(osc_filename):
+    """
+    returns the replication sequence number of a diff file, from its replication path
+    (e.g. '.../minute/006/123/456.osc.gz' -> 6123456)
+
+    Parameters
+    ----------
+    osc_filename : string
+        OSM DIFF FILENAME.
+
+    Returns
+    -------
+    int
+        SEQUENCE NUMBER.
+
+    """
+    match = REPLICATION_PATH_PATTERN.search(osc_filename)
+    if match is None:
+        raise ValueError("no replication sequence number in '" + osc_filename + "': please give (sequence, filename) pairs instead")
+    return int(match.group(1) + match.group(2) + match.group(3))
+
+
+
+def apply_diff(osc_filename, pgsql_tablename, sequence):
+    """
+    appends the feature versions of a diff file (.osc or .osc.gz) to the history table, in a single transaction:
+    new versions (primary keys following the greatest one), touched features and replication state
+    are all committed together, so that a diff is either fully applied or not at all
+
+    Parameters
+    ----------
+    osc_filename : string
+        OSM DIFF FILENAME.
+    pgsql_tablename : string
+        Tablename of the history table.
+    sequence : int
+        REPLICATION SEQUENCE NUMBER OF THE DIFF.
+
+    Returns
+    -------
+    int
+        NUMBER OF FEATURE VERSIONS APPENDED.
+
+    """
+    
+    # Reading the diff (created/modified/deleted features: deletions are new versions with visible = false)
+    historyHandler = HistoryHandler(pgsql_tablename, batch_size=None, progress=False) # never flushed: sent below
+    historyHandler.apply_file(osc_filename)
+    history_records = historyHandler.history_records
+    
+    # Feature versions already in the table (diff applied twice, or overlapping the imported history) are skipped
+    cur.execute(sql.SQL("""SELECT h.osm_type, h.osm_id, h.version FROM public.{} AS h
+JOIN unnest(%s::text[], %s::bigint[]) AS d(osm_type, osm_id) ON h.osm_type = d.osm_type AND h.osm_id = d.osm_id;""").format(sql.Identifier(pgsql_tablename)),
+                ([record[2] for record in history_records], [record[1] for record in history_records]))
+    existing_versions = set(cur.fetchall())
+    history_records = [record for record in history_records if (record[2], record[1], record[3]) not in existing_versions]
+    
+    # Primary keys following the greatest one, in the order of the diff
+    cur.execute(sql.SQL("SELECT COALESCE(MAX(id), 0) FROM public.{};").format(sql.Identifier(pgsql_tablename)))
+    max_id = cur.fetchone()[0]
+    for i, record in enumerate(history_records, 1):
+        record[0] = max_id + i
+    
+    copy_rows(cur, pgsql_tablename, history_records, HISTORY_COPY_ENCODERS)
+    
+    # Marking the touched features, for their recomputation
+    cur.execute(sql.SQL("""INSERT INTO public.{} (osm_type, osm_id, sequence)
+SELECT DISTINCT osm_type, osm_id, %s FROM unnest(%s::text[], %s::bigint[]) AS d(osm_type, osm_id)
+ON CONFLICT (osm_type, osm_id) DO UPDATE SET sequence = EXCLUDED.sequence;""").format(sql.Identifier(pgsql_tablename + '_touched')),
+                (sequence, [record[2] for record in history_records], [record[1] for record in history_records]))
+    
+    # Recording the last diff applied
+    cur.execute(sql.SQL("""INSERT INTO public.{} (tablename, sequence, filename, updated_at) VALUES (%s, %s, %s, now())
+ON CONFLICT (tablename) DO UPDATE SET sequence = EXCLUDED.sequence, filename = EXCLUDED.filename, updated_at = EXCLUDED.updated_at;""").format(sql.Identifier(REPLICATION_STATE_TABLENAME)),
+                (pgsql_tablename, sequence, osc_filename))
+    
+    # Making the changes to the database persistent (all at once)
+    conn.commit()
+    return len(history_records)
+
+
+
+def history_diff_updater(osc_filenames, pgsql_tablename='OSM_history'):
+    """
+    updates an existing history table with OSM replication diffs (.osc or .osc.gz files, e.g. the daily
+    diffs of Geofabrik), instead of importing a new full history file: the diffs are applied in sequence order,
+    and the ones already applied (sequence number lower than or equal to the recorded one) are skipped,
+    so that the update can safely be run again with the same files
+
+    Parameters
+    ----------
+    osc_filenames : list of strings, or of (int, string) tuples
+        OSM diff filenames, with a replication path (see 'replication_sequence'),
+        or (sequence number, filename) pairs.
+    pgsql_tablename : string
+        Tablename of the history table.
+
+    Returns
+    -------
+    int
+        Number of feature versions appended.
+
+    """
+    create_replication_tables(pgsql_tablename)
+    
+    diffs = sorted((osc_filename if isinstance(osc_filename, tuple) else (replication_sequence(osc_filename), osc_filename))
+                   for osc_filename in osc_filenames)
+    
+    cur.execute(sql.SQL("SELECT sequence FROM public.{} WHERE tablename = %s;").format(sql.Identifier(REPLICATION_STATE_TABLENAME)), (pgsql_tablename,))
+    state = cur.fetchone()
+    last_sequence = state[0] if state is not None else None
+    
+    print("\n\n Applying", len(diffs), "diffs to '", pgsql_tablename, "' (last sequence applied:", last_sequence, ")... ")
+    
+    nb_records = 0
+    for sequence, osc_filename in tqdm(diffs):
+        if last_sequence is not None and sequence <= last_sequence:
+            continue # already applied
+        nb_records += apply_diff(osc_filename, pgsql_tablename, sequence)
+        last_sequence = sequence
+    
+    print("\n\n Process completed! \n", nb_records, "new feature versions appended to '", pgsql_tablename, "', now up to sequence", last_sequence, "!")
+    return nb_records
+
+
+
+
 ### Main — Code execution
 
 
 if __name__ == '__main__':
     
+    # '--resume': continuing an interrupted import from its last checkpoint
+    parser = argparse.ArgumentParser(description="OSM history file import into PostgreSQL")
+    parser.add_argument('--resume', action='store_true', help="resume the import from its last checkpoint")
+    parser.add_argument('--update', nargs='+', metavar='OSC_FILE', help="apply replication diffs (.osc/.osc.gz) to the history table instead of importing the history file")
+    parser.add_argument('--metrics', metavar='FILE', help="write the stage timings to FILE at the end of the run (Prometheus text for .prom files, JSON otherwise)")
+    parser.add_argument('--metrics-interval', type=float, metavar='SECONDS', help="also write them every SECONDS seconds during the import")
+    args = parser.parse_args()
+    if args.metrics_interval is not None and not args.metrics:
+        parser.error("--metrics-interval requires --metrics (file where the stage timings are written)")
+    if args.metrics_interval is not None and args.metrics_interval <= 0:
+        parser.error("--metrics-interval must be a positive number of seconds")
+    
+    # Stage-level profiling (parse, build, encode, db_execute, commit, see 'metrics.py')
+    if args.metrics and args.metrics_interval:
+        metrics.start_periodic_report(args.metrics, args.metrics_interval)
+    
     # Connecting to the PostgreSQL Database
-    conn = psycopg2.connect(database="uusimaa", user="postgres", password="postgres", host="localhost", port="5432")
+    connection_parameters = dict(database="uusimaa", user="postgres", password="postgres", host="localhost", port="5432")
+    conn = psycopg2.connect(**connection_parameters)
     
     # Opening a cursor to perform database operations
     cur = conn.cursor()
     
     # Selecting the OSM history file for import
     """
-    Important prerequisite: if it happens that you have the raw .osh.pbf file,
-                            please convert it to .osh format (XML) before launching this code
-                            ('osmium cat' command can be used for that purpose)
+    Both the raw .osh.pbf file and its .osh (XML) conversion are accepted:
+    .osh.pbf files are read natively with PyOsmium, no 'osmium cat' conversion needed anymore!
     """
     #filename = 'otaniemi-history.osh'
-    filename = 'uusimaa-history.osh'
+    filename = 'uusimaa-history.osh.pbf'
     
     """ /!\ PLEASE MAKE SURE THIS CURRENT PYTHON FILE IS LOCATED IN THE SAME DIRECTORY AS YOUR
                             HISTORY FILE /!\
@@ -283,8 +1063,23 @@ if __name__ == '__main__':
     # Choosing a name for the output PostgreSQL table (optional, default='OSM_history')
     tablename = 'history'
 
-    # Importing history file content
-    history_importer(filename, tablename)
+    # Number of processes for importing .osh.pbf files (1 = sequential import, with consecutive primary keys)
+    nb_workers = 1
+
+    # Importing history file content (or updating it with replication diffs, see '--update')
+    if args.update:
+        history_diff_updater(args.update, tablename)
+    elif filename.endswith('.pbf') and nb_workers > 1:
+        parallel_history_pbf_importer(filename, connection_parameters, tablename, nb_workers, resume=args.resume)
+    elif filename.endswith('.pbf'):
+        history_pbf_importer(filename, tablename, batch_size=50000, resume=args.resume)
+    else:
+        # (bulk=True streams the records with 'COPY FROM STDIN' in batches: same table content, minutes instead of hours)
+        history_importer(filename, tablename, bulk=True, batch_size=50000, resume=args.resume)
+    
+    if args.metrics:
+        metrics.stop_periodic_report(final=False)
+        metrics.write(args.metrics)
     
     
     # Close communication with the database
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+                    STAGE-LEVEL PROFILING AND METRICS
+
+
+------------------------------------------------------------------------------
+"""
+
+"""
+A small, dependency-free metrics registry shared by the import and analysis scripts, telling where the time goes:
+    - timers: number of calls, total and maximum time of a stage
+              (import: 'parse', 'build', 'encode', 'db_execute', 'commit';
+               analysis: 'osm_versions_query', 'resolver', 'batch_load', 'batch_compute', 'fingerprint'),
+    - counters: number of events ('records', 'batches', 'geometry_modification_calls'...),
+    - gauges: highest value seen (e.g. 'geometry_modification_max_depth', the depth of recursion into relations).
+
+The module-level 'metrics' registry is the one used by the scripts; a snapshot can be written at any time
+as structured JSON or as Prometheus text exposition format (e.g. for the textfile collector of node_exporter),
+at the end of a run ('write') and periodically during long runs ('start_periodic_report').
+
+Example:
+    from metrics import metrics
+    metrics.start_periodic_report('import_metrics.prom', interval=60)
+    history_pbf_importer('uusimaa-history.osh.pbf', 'history')
+    metrics.stop_periodic_report() # last snapshot written
+    print(metrics.to_json())
+
+N.B.: the timers cost a couple of 'perf_counter' calls per observation; 'metrics.enabled = False' turns them off.
+      Worker processes have their own registry: their snapshots are sent back with their results and merged ('merge').
+"""
+
+
+
+### Librairies import
+
+import os
+import json
+import time
+import threading    # for the periodic reports, written by a background thread
+from contextlib import contextmanager
+from functools import wraps
+
+
+
+
+### Code
+
+
+class Metrics:
+    """
+    registry of timers, counters and gauges (see module description)
+    """
+    def __init__(self, namespace='osm_history'):
+        self.namespace = namespace # prefix of the Prometheus metric names
+        self.enabled = True
+        self.timers = {} # stage -> [number of calls, total seconds, maximum seconds]
+        self.counters = {} # name -> value
+        self.gauges = {} # name -> highest value
+        self.depths = {} # current recursion depth of the functions decorated with 'track_depth'
+        self.started = time.time()
+        self.reporter = None # (thread, stop event, filename) of the periodic report, if any
+
+    def reset(self):
+        # forgets everything recorded so far (e.g. between two benchmark stages)
+        self.timers, self.counters, self.gauges, self.depths = {}, {}, {}, {}
+        self.started = time.time()
+
+    def add_time(self, stage, seconds, calls=1):
+        # records 'calls' calls of a stage, lasting 'seconds' in total
+        if not self.enabled:
+            return
+        timer = self.timers.get(stage)
+        if timer is None:
+            self.timers[stage] = [calls, seconds, seconds]
+        else:
+            timer[0] += calls
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+    def seconds(self, stage):
+        # total time recorded for a stage
+        timer = self.timers.get(stage)
+        return timer[1] if timer is not None else 0.0
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_max(self, name, value):
+        if self.enabled and value > self.gauges.get(name, value - 1):
+            self.gauges[name] = value
+
+    @contextmanager
+    def timer(self, stage):
+        # 'with metrics.timer(stage):' times the enclosed block
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed(self, stage):
+        # decorator timing every call of a function
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.add_time(stage, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def track_depth(self, name):
+        # decorator for recursive functions: counts the calls ('<name>_calls') and records the deepest recursion ('<name>_max_depth')
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                depth = self.depths.get(name, 0) + 1
+                self.depths[name] = depth
+                self.count(name + '_calls')
+                self.set_max(name + '_max_depth', depth)
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.depths[name] = depth - 1
+            return wrapper
+        return decorator
+
+    def timed_iter(self, iterable, stage):
+        # [GENERATOR] yields the items of 'iterable', recording the time spent producing each of them
+        # (e.g. the parsing time of a generator of records)
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def collect(self):
+        """
+        snapshot of all the metrics (N.B.: dictionaries copied first, as the periodic report runs in another thread)
+
+        Returns
+        -------
+        dict
+            {'uptime_seconds', 'timers': {STAGE: {'calls', 'seconds', 'max_seconds', 'mean_seconds'}}, 'counters', 'gauges'}.
+
+        """
+        timers, counters, gauges = dict(self.timers), dict(self.counters), dict(self.gauges)
+        snapshot_timers = {}
+        for stage, (calls, seconds, max_seconds) in sorted(timers.items()):
+            snapshot_timers[stage] = {'calls': calls, 'seconds': round(seconds, 6), 'max_seconds': round(max_seconds, 6),
+                                      'mean_seconds': round(seconds / calls, 9) if calls > 0 else None}
+        return {'uptime_seconds': round(time.time() - self.started, 3),
+                'timers': snapshot_timers,
+                'counters': dict(sorted(counters.items())),
+                'gauges': dict(sorted(gauges.items()))}
+
+    def merge(self, snapshot):
+        # adds a snapshot of another registry (e.g. of a worker process, see 'collect') to this one
+        for stage, timer in snapshot['timers'].items():
+            calls, seconds, max_seconds = self.timers.get(stage, [0, 0.0, 0.0])
+            self.timers[stage] = [calls + timer['calls'], seconds + timer['seconds'], max(max_seconds, timer['max_seconds'])]
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+        for name, value in snapshot['gauges'].items():
+            self.set_max(name, value)
+
+    def to_json(self):
+        return json.dumps(self.collect(), indent=2)
+
+    def to_prometheus(self):
+        """
+        snapshot of all the metrics in Prometheus text exposition format: one family per kind of metric,
+        stages as labels ('<namespace>_stage_seconds_total{stage="parse"}'), counters and gauges by name
+
+        Returns
+        -------
+        string
+            PROMETHEUS TEXT.
+
+        """
+        snapshot = self.collect()
+        prefix = self.namespace + '_'
+        lines = ['# HELP ' + prefix + 'uptime_seconds Time since the metrics were (re)set.',
+                 '# TYPE ' + prefix + 'uptime_seconds gauge',
+                 prefix + 'uptime_seconds ' + repr(snapshot['uptime_seconds'])]
+        if snapshot['timers']:
+            for family, key, kind, description in [('stage_seconds_total', 'seconds', 'counter', 'Total time spent in the stage.'),
+                                                   ('stage_calls_total', 'calls', 'counter', 'Number of timed calls of the stage.'),
+                                                   ('stage_seconds_max', 'max_seconds', 'gauge', 'Longest call of the stage.')]:
+                lines += ['# HELP ' + prefix + family + ' ' + description, '# TYPE ' + prefix + family + ' ' + kind]
+                lines += [prefix + family + '{stage="' + stage + '"} ' + repr(timer[key]) for stage, timer in snapshot['timers'].items()]
+        for name, value in snapshot['counters'].items():
+            lines += ['# TYPE ' + prefix + name + '_total counter', prefix + name + '_total ' + repr(value)]
+        for name, value in snapshot['gauges'].items():
+            lines += ['# TYPE ' + prefix + name + ' gauge', prefix + name + ' ' + repr(value)]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """
+        writes a snapshot of the metrics: Prometheus text for '.prom'/'.txt' files, JSON otherwise.
+        The file is replaced atomically, so that a reader (or a scraper) never sees a partial snapshot
+
+        Parameters
+        ----------
+        filename : string
+            OUTPUT FILENAME.
+
+        Returns
+        -------
+        None.
+
+        """
+        text = self.to_prometheus() if filename.endswith(('.prom', '.txt')) else self.to_json()
+        temporary_filename = filename + '.tmp'
+        with open(temporary_filename, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temporary_filename, filename)
+
+    def start_periodic_report(self, filename, interval=60):
+        """
+        writes a snapshot of the metrics every 'interval' seconds (background thread), until 'stop_periodic_report'
+
+        Parameters
+        ----------
+        filename : string
+            OUTPUT FILENAME (SEE 'write').
+        interval : float
+            SECONDS BETWEEN TWO SNAPSHOTS.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.stop_periodic_report(final=False)
+        stop = threading.Event()
+        def report():
+            while not stop.wait(interval):
+                self.write(filename)
+        thread = threading.Thread(target=report, name='metrics-report', daemon=True)
+        thread.start()
+        self.reporter = (thread, stop, filename)
+
+    def stop_periodic_report(self, final=True):
+        # stops the periodic report, writing a last snapshot (end of the run) unless final=False
+        if self.reporter is None:
+            return
+        thread, stop, filename = self.reporter
+        stop.set()
+        thread.join()
+        self.reporter = None
+        if final:
+            self.write(filename)
+
+
+
+# Registry shared by the scripts of this project
+metrics = Metrics()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+                    VERSIONED NODE COORDINATE INDEX
+
+
+------------------------------------------------------------------------------
+"""
+
+"""
+Answers "coordinates of node N at time T" without querying PostgreSQL: for every node id,
+the timestamps and coordinates of all its versions are kept in sorted NumPy arrays
+(optionally memory-mapped from disk), so that one lookup costs two binary searches,
+and millions of (node, time) pairs can be resolved at once.
+
+The version selected is the one of 'geometry_references_resolver': the latest version older than
+(or as old as) T, the first one in version order on ties.
+
+[Quick start]:
+    index = NodeCoordinateIndex.from_history(conn, 'history')    # built once from the history table
+    index.save('node_index')                                     # ... and saved
+    index = NodeCoordinateIndex.load('node_index')               # then reused (memory-mapped)
+"""
+
+
+
+### Libraries import
+
+import os
+
+from psycopg2 import sql    # for generating dynamically SQL queries (for choosing dynamically a table name)
+import numpy as np
+
+
+
+### Code
+
+
+# Composite search key: (rank of the node id) * TIME_KEY_STRIDE + (seconds since the oldest node version)
+TIME_KEY_STRIDE = 2 ** 32
+
+INDEX_ARRAYS = ['node_ids', 'offsets', 'keys', 'lat', 'lon', 'timestamp_min']
+
+
+
+class NodeCoordinateIndex:
+    """
+    Versioned node coordinates: the versions of node_ids[r] are stored in [offsets[r], offsets[r + 1]),
+    sorted by timestamp (reverse version order on ties), in the 'keys', 'lat' and 'lon' arrays
+    """
+    def __init__(self, node_ids, offsets, keys, lat, lon, timestamp_min):
+        self.node_ids = node_ids
+        self.offsets = offsets
+        self.keys = keys
+        self.lat = lat
+        self.lon = lon
+        self.timestamp_min = int(timestamp_min)
+
+    @classmethod
+    def from_arrays(cls, osm_id, timestamp, lat, lon):
+        """
+        builds the index from node versions sorted by (osm_id, version)
+
+        Parameters
+        ----------
+        osm_id : numpy array (int64)
+            NODE IDS.
+        timestamp : numpy array (int64)
+            TIMESTAMPS IN SECONDS (VERSIONS WITHOUT TIMESTAMP MUST BE LEFT OUT).
+        lat : numpy array (float64)
+            LATITUDES (NaN FOR DELETED VERSIONS).
+        lon : numpy array (float64)
+            LONGITUDES (NaN FOR DELETED VERSIONS).
+
+        Returns
+        -------
+        NodeCoordinateIndex
+
+        """
+        node_ids, rank, counts = np.unique(osm_id, return_inverse=True, return_counts=True)
+        timestamp_min = timestamp.min() if len(timestamp) > 0 else 0
+        keys = rank.astype(np.int64) * TIME_KEY_STRIDE + (timestamp - timestamp_min)
+
+        # stable reordering by key, the later versions first on equal timestamps (see 'resolve')
+        order = np.lexsort((-np.arange(len(keys)), keys))
+        offsets = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        return cls(node_ids, offsets, keys[order], lat[order], lon[order], timestamp_min)
+
+    @classmethod
+    def from_history(cls, conn, pgsql_tablename='history', itersize=1000000):
+        """
+        builds the index from all the node versions of the history table
+        (streamed with a server-side cursor, so that the rows are never all held as Python objects)
+
+        Parameters
+        ----------
+        conn : psycopg2 connection
+            DATABASE CONNECTION.
+        pgsql_tablename : string
+            HISTORY TABLE NAME.
+        itersize : int
+            NUMBER OF ROWS FETCHED AT ONCE.
+
+        Returns
+        -------
+        NodeCoordinateIndex
+
+        """
+        cur = conn.cursor(name='node_index_builder')
+        cur.execute(sql.SQL("""SELECT osm_id, CAST(EXTRACT(EPOCH FROM "timestamp") AS bigint), lat, lon FROM {}
+WHERE osm_type = 'node' AND "timestamp" IS NOT NULL ORDER BY osm_id, version, id;""").format(sql.Identifier(pgsql_tablename)))
+
+        osm_id, timestamp, lat, lon = [], [], [], []
+        while True:
+            rows = cur.fetchmany(itersize)
+            if not rows:
+                break
+            columns = list(zip(*rows))
+            osm_id.append(np.array(columns[0], dtype=np.int64))
+            timestamp.append(np.array(columns[1], dtype=np.int64))
+            lat.append(np.array(columns[2], dtype=np.float64)) # None -> NaN
+            lon.append(np.array(columns[3], dtype=np.float64))
+        cur.close()
+
+        if not osm_id:
+            empty = np.empty(0, dtype=np.int64)
+            return cls.from_arrays(empty, empty, np.empty(0), np.empty(0))
+        return cls.from_arrays(np.concatenate(osm_id), np.concatenate(timestamp), np.concatenate(lat), np.concatenate(lon))
+
+    def save(self, directory):
+        """
+        saves the index as .npy files in a directory (created if needed)
+
+        Parameters
+        ----------
+        directory : string
+            OUTPUT DIRECTORY.
+
+        Returns
+        -------
+        None.
+
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), np.asarray(getattr(self, name)))
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        loads an index saved with 'save', memory-mapped by default (near-zero loading time,
+        only the pages actually needed by the lookups are read from disk)
+
+        Parameters
+        ----------
+        directory : string
+            INDEX DIRECTORY.
+        mmap : boolean
+            MEMORY-MAP THE ARRAYS INSTEAD OF READING THEM.
+
+        Returns
+        -------
+        NodeCoordinateIndex
+
+        """
+        mmap_mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in INDEX_ARRAYS[:-1]]
+        timestamp_min = np.load(os.path.join(directory, 'timestamp_min.npy')) # scalar, never memory-mapped
+        return cls(*arrays, timestamp_min)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def lookup(self, node_id, timestamp):
+        """
+        returns the coordinates of a node at a given time, in O(log n + log v)
+
+        Parameters
+        ----------
+        node_id : int
+            NODE ID.
+        timestamp : int
+            TIME, IN SECONDS.
+
+        Returns
+        -------
+        (float, float) or None
+            (LAT, LON) OF THE NODE VERSION VALID AT THAT TIME (NaN IF DELETED),
+            None IF THE NODE IS UNKNOWN OR YOUNGER THAN THE TIMESTAMP.
+
+        """
+        rank = np.searchsorted(self.node_ids, node_id)
+        if rank == len(self.node_ids) or self.node_ids[rank] != node_id:
+            return None
+        start, end = self.offsets[rank], self.offsets[rank + 1]
+        key = rank * TIME_KEY_STRIDE + (int(timestamp) - self.timestamp_min)
+        position = start + np.searchsorted(self.keys[start:end], key, side='right') - 1
+        if position < start:
+            return None
+        return self.lat[position], self.lon[position]
+
+    def resolve(self, node_ids, timestamps, has_timestamp=None):
+        """
+        bulk lookup: returns the position of the node version valid at each (node, time) pair
+
+        Parameters
+        ----------
+        node_ids : numpy array
+            NODE IDS.
+        timestamps : numpy array
+            TIMES, IN SECONDS.
+        has_timestamp : numpy array, optional
+            FALSE WHERE THE TIME IS UNKNOWN (NOTHING CAN BE FOUND).
+
+        Returns
+        -------
+        numpy array
+            POSITIONS IN 'lat'/'lon', OR -1 IF THE NODE IS UNKNOWN OR YOUNGER THAN THE TIME.
+
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        if len(self.node_ids) == 0 or len(node_ids) == 0:
+            return np.full(len(node_ids), -1, dtype=np.int64)
+
+        rank = np.minimum(np.searchsorted(self.node_ids, node_ids), len(self.node_ids) - 1)
+        found = self.node_ids[rank] == node_ids
+        if has_timestamp is not None:
+            found &= has_timestamp
+
+        offset = np.clip(np.asarray(timestamps, dtype=np.int64) - self.timestamp_min, -1, TIME_KEY_STRIDE - 1)
+        position = np.searchsorted(self.keys, rank * TIME_KEY_STRIDE + offset, side='right') - 1
+
+        # the version found has to belong to the same node (and not to the previous one in the keys)
+        found &= position >= self.offsets[rank]
+        return np.where(found, position, -1)
+
+    def coordinates(self, node_ids, timestamps, has_timestamp=None):
+        """
+        bulk lookup: coordinates of the node versions valid at each (node, time) pair
+
+        Parameters
+        ----------
+        node_ids : numpy array
+            NODE IDS.
+        timestamps : numpy array
+            TIMES, IN SECONDS.
+        has_timestamp : numpy array, optional
+            FALSE WHERE THE TIME IS UNKNOWN.
+
+        Returns
+        -------
+        (numpy array, numpy array, numpy array)
+            FOUND (BOOLEAN), LAT, LON (NaN WHERE NOT FOUND).
+
+        """
+        position = self.resolve(node_ids, timestamps, has_timestamp)
+        found = position >= 0
+        safe = np.maximum(position, 0)
+        lat = np.where(found, self.lat[safe] if len(self.lat) > 0 else np.nan, np.nan)
+        lon = np.where(found, self.lon[safe] if len(self.lon) > 0 else np.nan, np.nan)
+        return found, lat, lon
+
+    def way_modification(self, t1_members_refs, t1_timestamp, t2_members_refs, t2_timestamp):
+        """
+        node-by-node comparison of two way versions with the same number of nodes, as in
+        'geometry_modification': None if no geometry modification, 1 if there has been one,
+        2 if a node is missing or younger than its way (the first node found different decides)
+
+        Parameters
+        ----------
+        t1_members_refs : int list
+            NODE REFERENCES OF THE PREVIOUS VERSION.
+        t1_timestamp : int
+            TIMESTAMP OF THE PREVIOUS VERSION, IN SECONDS.
+        t2_members_refs : int list
+            NODE REFERENCES OF THE CURRENT VERSION.
+        t2_timestamp : int
+            TIMESTAMP OF THE CURRENT VERSION, IN SECONDS.
+
+        Returns
+        -------
+        int or None
+
+        """
+        n = len(t1_members_refs)
+        found1, lat1, lon1 = self.coordinates(t1_members_refs, np.full(n, t1_timestamp, dtype=np.int64))
+        found2, lat2, lon2 = self.coordinates(t2_members_refs, np.full(n, t2_timestamp, dtype=np.int64))
+
+        unchanged = ((lat1 == lat2) & (lon1 == lon2)) | (np.isnan(lat2) & np.isnan(lon2))
+        status = np.where(~found1 | ~found2, 2, np.where(unchanged, 0, 1))
+        nonzero = np.nonzero(status)[0]
+        if len(nonzero) == 0:
+            return None
+        return int(status[nonzero[0]])
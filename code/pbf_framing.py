@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+                    PBF FILE FRAMING HELPERS
+
+
+------------------------------------------------------------------------------
+"""
+
+"""
+Locates the blocks of .osm.pbf/.osh.pbf files from their binary framing only (no decompression, no PyOsmium),
+so that they can be read block by block: checkpointed batches and parallel import of the history
+(see 'history_to_pgsql_enhanced.py'), parallel fast scan of the source files (see 'source_fetching.py').
+
+Each block is [4 bytes: BlobHeader size][BlobHeader][Blob], see https://wiki.openstreetmap.org/wiki/PBF_Format
+"""
+
+
+
+### Librairies import
+
+import struct    # for reading the binary framing of .osh.pbf files (block sizes)
+
+
+
+
+### Code
+
+
+def read_varint(buffer, position):
+    """
+    decodes a protobuf variable-length integer
+
+    Parameters
+    ----------
+    buffer : bytes
+        PROTOBUF MESSAGE.
+    position : int
+        POSITION OF THE FIRST BYTE OF THE VARINT.
+
+    Returns
+    -------
+    (int, int)
+        DECODED VALUE, POSITION RIGHT AFTER THE VARINT.
+
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+
+def pbf_blocks(osm_history_filename):
+    """
+    scans the framing of a .osh.pbf file (without decompressing anything) and locates its blocks:
+    each block is [4 bytes: BlobHeader size][BlobHeader][Blob], see https://wiki.openstreetmap.org/wiki/PBF_Format
+
+    Parameters
+    ----------
+    osm_history_filename : string
+        OSM history filename with its extension (.osh.pbf).
+
+    Returns
+    -------
+    header_block : bytes
+        RAW 'OSMHeader' BLOCK (NEEDED AT THE BEGINNING OF ANY BUFFER GIVEN TO PYOSMIUM).
+    data_blocks : list of (int, int)
+        (OFFSET, SIZE) IN BYTES OF EVERY 'OSMData' BLOCK, IN FILE ORDER.
+
+    """
+    header_block = b''
+    data_blocks = []
+    
+    with open(osm_history_filename, "rb") as f:
+        offset = 0
+        while True:
+            size_bytes = f.read(4)
+            if len(size_bytes) < 4:
+                break # end of file
+            blob_header_size = struct.unpack('>I', size_bytes)[0]
+            blob_header = f.read(blob_header_size)
+            
+            # BlobHeader message: 1 = type (string), 2 = indexdata (bytes), 3 = datasize (int32)
+            blob_type = None
+            blob_size = 0
+            position = 0
+            while position < blob_header_size:
+                key, position = read_varint(blob_header, position)
+                field, wire_type = key >> 3, key & 0x07
+                if wire_type == 0:
+                    value, position = read_varint(blob_header, position)
+                    if field == 3:
+                        blob_size = value
+                else: # wire_type == 2 (length-delimited)
+                    length, position = read_varint(blob_header, position)
+                    if field == 1:
+                        blob_type = blob_header[position:position + length].decode()
+                    position += length
+            
+            block_size = 4 + blob_header_size + blob_size
+            if blob_type == 'OSMHeader':
+                f.seek(offset)
+                header_block = f.read(block_size)
+            else:
+                data_blocks.append((offset, block_size))
+            
+            offset += block_size
+            f.seek(offset)
+    
+    return header_block, data_blocks
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+                    POSTGRESQL 'COPY FROM STDIN' BULK LOADING HELPERS
+
+
+------------------------------------------------------------------------------
+"""
+
+"""
+These helpers turn Python records into PostgreSQL COPY text format (tab-separated, '\\N' for NULL),
+so the importers can send thousands of rows per round-trip instead of one 'INSERT' per row.
+
+The encoders reproduce what the 'INSERT ... hstore(%s)' queries used to store:
+    - plain values are sent as text and cast by PostgreSQL to the column type,
+    - lists of member references become bigint[] literals ('{1,2,3}'),
+    - lists of strings become text[] literals ('{"node","way"}'),
+    - lists of [key, value] tags become hstore literals ('"key"=>"value"').
+"""
+
+
+
+### Librairies import
+
+import io    # in-memory text buffer fed to 'copy_expert'
+import time
+
+from psycopg2 import sql    # for generating dynamically SQL queries (for choosing dynamically a table name)
+
+from metrics import metrics    # stage timers: 'parse', 'encode', 'db_execute', 'commit' (see 'metrics.py')
+
+
+
+
+### Code
+
+
+# COPY text format: backslash, tab, newline and carriage return must be escaped
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+# hstore literal: backslash and double quote must be escaped inside quoted keys/values
+_HSTORE_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"'})
+
+COPY_NULL = '\\N'
+
+
+def copy_value(value):
+    """
+    encodes a plain value (string, number, boolean, timestamp) for COPY text format
+
+    Parameters
+    ----------
+    value : any
+        VALUE TO ENCODE (None for NULL).
+
+    Returns
+    -------
+    string
+        ENCODED VALUE.
+
+    """
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).translate(_COPY_ESCAPES)
+
+
+
+def copy_array(values):
+    """
+    encodes a list of integers (e.g. member references) as a bigint[] literal
+
+    Parameters
+    ----------
+    values : int list
+        ARRAY ELEMENTS (None for NULL).
+
+    Returns
+    -------
+    string
+        ENCODED VALUE.
+
+    """
+    if values is None:
+        return COPY_NULL
+    return '{' + ','.join([str(int(value)) for value in values]) + '}'
+
+
+
+def copy_text_array(values):
+    """
+    encodes a list of strings (e.g. member types) as a text[] literal
+
+    Parameters
+    ----------
+    values : string list
+        ARRAY ELEMENTS (None for NULL).
+
+    Returns
+    -------
+    string
+        ENCODED VALUE.
+
+    """
+    if values is None:
+        return COPY_NULL
+    literal = '{' + ','.join(['"' + str(value).translate(_HSTORE_ESCAPES) + '"' for value in values]) + '}'
+    return literal.translate(_COPY_ESCAPES)
+
+
+
+def copy_hstore(tags):
+    """
+    encodes a list of [key, value] pairs as an hstore literal,
+    equivalent to what 'hstore(%s)' builds from the same list in an 'INSERT' query
+
+    Parameters
+    ----------
+    tags : list of [key, value] lists
+        TAGS (None for NULL).
+
+    Returns
+    -------
+    string
+        ENCODED VALUE.
+
+    """
+    if tags is None:
+        return COPY_NULL
+    literal = ','.join(['"' + str(key).translate(_HSTORE_ESCAPES) + '"=>"' + str(value).translate(_HSTORE_ESCAPES) + '"'
+                        for key, value in tags])
+    return literal.translate(_COPY_ESCAPES)
+
+
+
+def copy_rows(cur, pgsql_tablename, rows, encoders):
+    """
+    sends a list of records to a PostgreSQL table in a single 'COPY FROM STDIN' statement
+
+    Parameters
+    ----------
+    cur : psycopg2 cursor
+        DATABASE CURSOR.
+    pgsql_tablename : string
+        TARGET TABLE NAME.
+    rows : list of lists/tuples
+        RECORDS, IN THE SAME COLUMN ORDER AS THE TABLE.
+    encoders : function list
+        ONE ENCODER PER COLUMN ('copy_value', 'copy_array', 'copy_text_array' or 'copy_hstore').
+
+    Returns
+    -------
+    None.
+
+    """
+    start = time.perf_counter()
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join([encode(value) for encode, value in zip(encoders, row)]))
+        buffer.write('\n')
+    buffer.seek(0)
+    encoded = time.perf_counter()
+    metrics.add_time('encode', encoded - start)
+    cur.copy_expert(sql.SQL("COPY {} FROM STDIN;").format(sql.Identifier(pgsql_tablename)), buffer)
+    metrics.add_time('db_execute', time.perf_counter() - encoded)
+    metrics.count('records', len(rows))
+    metrics.count('batches')
+
+
+
+def copy_in_batches(conn, pgsql_tablename, records, encoders, batch_size=50000, on_batch=None):
+    """
+    streams records into a PostgreSQL table with one 'COPY' and one commit per batch,
+    so that memory stays bounded by 'batch_size' whatever the number of records
+
+    Parameters
+    ----------
+    conn : psycopg2 connection
+        DATABASE CONNECTION.
+    pgsql_tablename : string
+        TARGET TABLE NAME.
+    records : iterable
+        RECORDS (lists/tuples), possibly a generator.
+    encoders : function list
+        ONE ENCODER PER COLUMN.
+    batch_size : int
+        NUMBER OF RECORDS SENT PER 'COPY' STATEMENT.
+    on_batch : function, optional
+        CALLED AS on_batch(cur, batch) BEFORE EACH COMMIT, INSIDE THE BATCH TRANSACTION.
+
+    Returns
+    -------
+    int
+        NUMBER OF RECORDS LOADED.
+
+    """
+    cur = conn.cursor()
+    nb_records = 0
+    batch = []
+
+    # time spent waiting for the next record, i.e. parsing the input file (see 'metrics.py')
+    for record in metrics.timed_iter(records, 'parse'):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            copy_rows(cur, pgsql_tablename, batch, encoders)
+            if on_batch is not None:
+                on_batch(cur, batch)
+            with metrics.timer('commit'):
+                conn.commit()
+            nb_records += len(batch)
+            batch = []
+
+    if batch:
+        # remaining records (last, incomplete batch)
+        copy_rows(cur, pgsql_tablename, batch, encoders)
+        if on_batch is not None:
+            on_batch(cur, batch)
+        with metrics.timer('commit'):
+            conn.commit()
+        nb_records += len(batch)
+
+    cur.close()
+    return nb_records
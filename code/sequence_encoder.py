@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+                    MODIFICATION SEQUENCE ENCODER
+
+
+------------------------------------------------------------------------------
+"""
+
+"""
+Batch version of 'sequence_modifications' (see 'typology_modif_encoding_copy.py'), with the semantic
+modifications included: the full encoded sequences of modifications of millions of features, for the
+clustering analysis the sequences were originally designed for.
+
+For every pair of consecutive versions of a feature, the codes are appended in this order:
+    - the geometry modification code (1, or 2 in case of error), as computed by the batch engine
+      (see 'geometry_batch_engine.py', same results as 'geometry_modification'),
+    - TAG_ENRICHMENT (3) if the current version has keys the previous one had not,
+    - TAG_SUPPRESSION (4) if keys of the previous version are missing from the current one,
+    - TAG_MODIFICATION (5) if a key of both versions has a different value.
+A feature missing from the history gets the sequence [2], as in 'sequence_modifications'.
+As for geometries, a deleted version (visible = false, no tags) is not a tag modification.
+
+The tags of all the versions of a chunk are read once ('other_tags' hstore text, or dicts from the history store),
+dictionary-encoded, then the (key, value) sets of all the version pairs are compared at once with numpy.
+
+The sequences are returned in a compact form: one int8 array of codes for all the features, and the offsets
+of each feature's sequence (sequence of feature j = codes[offsets[j]:offsets[j + 1]]).
+
+Example:
+    offsets, codes = batch_sequence_modifications(cur, osm_ids, osm_types)
+    sequences = np.split(codes, offsets[1:-1]) # one array per feature, if needed
+"""
+
+
+
+### Libraries import
+
+import re    # for reading hstore text
+from tqdm import tqdm   # for displaying a progress bar on loops
+
+import numpy as np
+
+from geometry_batch_engine import VersionStore, lookup_keys, load_references, chunk_pair_codes    # batch geometry codes (see 'geometry_batch_engine.py')
+from metrics import metrics    # 'batch_load' and 'batch_compute' stage timers (see 'metrics.py')
+
+
+
+
+### Code
+
+
+# Codes of the sequences of modifications (1 and 2: see 'geometry_modification')
+GEOMETRY_MODIFICATION = 1
+ERROR = 2
+TAG_ENRICHMENT = 3
+TAG_SUPPRESSION = 4
+TAG_MODIFICATION = 5
+
+# "key"=>"value" (or "key"=>NULL) pairs of the hstore text output, with backslash-escaped quotes and backslashes
+_HSTORE_PAIR = re.compile(r'"((?:[^"\\]|\\.)*)"\s*=>\s*(?:"((?:[^"\\]|\\.)*)"|(NULL))')
+_HSTORE_UNESCAPE = re.compile(r'\\(.)')
+
+
+def parse_hstore(other_tags):
+    """
+    reads the tags of a version, as returned by the history table (hstore text, psycopg2 having no hstore
+    adapter registered) or already as a dict
+
+    Parameters
+    ----------
+    other_tags : string, dict or None
+        TAGS OF THE VERSION (None, or NaN in a pandas column without any tags, if no tags).
+
+    Returns
+    -------
+    dict
+        KEY -> VALUE (EMPTY IF NO TAGS).
+
+    """
+    if isinstance(other_tags, dict):
+        return other_tags
+    if not isinstance(other_tags, str):
+        return {}
+    tags = {}
+    for key, value, null in _HSTORE_PAIR.findall(other_tags):
+        if '\\' in key:
+            key = _HSTORE_UNESCAPE.sub(r'\1', key)
+        if '\\' in value:
+            value = _HSTORE_UNESCAPE.sub(r'\1', value)
+        tags[key] = None if null else value
+    return tags
+
+
+
+def pair_tags(version_of_tag, k):
+    # tags of the versions k (one version per pair), as (pair, position of the tag in the encoded columns)
+    start = np.searchsorted(version_of_tag, k, side='left')
+    counts = np.searchsorted(version_of_tag, k, side='right') - start
+    pair = np.repeat(np.arange(len(k)), counts)
+    return pair, np.repeat(start, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+
+def tag_change_flags(store, k1, k2):
+    """
+    vectorized 'tag_enrichment', 'tag_suppression' and 'tag_modification' for pairs of versions
+
+    Parameters
+    ----------
+    store : VersionStore
+        LOADED VERSIONS, WITH THEIR TAGS (SEE 'VersionStore.load_tags').
+    k1 : numpy array
+        INDEXES OF THE PREVIOUS VERSIONS.
+    k2 : numpy array
+        INDEXES OF THE CURRENT VERSIONS.
+
+    Returns
+    -------
+    (numpy array, numpy array, numpy array)
+        ENRICHMENT, SUPPRESSION AND MODIFICATION FLAGS (bool), ONE PER VERSION PAIR.
+
+    """
+    k1 = np.asarray(k1, dtype=np.int64)
+    k2 = np.asarray(k2, dtype=np.int64)
+
+    # One pass over the tags of the versions involved: keys and values dictionary-encoded
+    key_codes, value_codes = {}, {}
+    version_of_tag, tag_key, tag_value = [], [], []
+    for k in np.unique(np.concatenate([k1, k2])):
+        for key, value in parse_hstore(store.tags[k]).items():
+            version_of_tag.append(k)
+            tag_key.append(key_codes.setdefault(key, len(key_codes)))
+            tag_value.append(value_codes.setdefault(value, len(value_codes)))
+    version_of_tag = np.array(version_of_tag, dtype=np.int64)
+    tag_key = np.array(tag_key, dtype=np.int64)
+    tag_value = np.array(tag_value, dtype=np.int64)
+
+    # (pair, key) sets of both sides of every pair
+    pair1, tags1 = pair_tags(version_of_tag, k1)
+    pair2, tags2 = pair_tags(version_of_tag, k2)
+    nb_keys = max(len(key_codes), 1)
+    composite1 = pair1 * nb_keys + tag_key[tags1]
+    composite2 = pair2 * nb_keys + tag_key[tags2]
+
+    order2 = np.argsort(composite2)
+    sorted2 = composite2[order2]
+    position = np.minimum(np.searchsorted(sorted2, composite1), max(len(sorted2) - 1, 0))
+    in_both = (sorted2[position] == composite1) if len(sorted2) > 0 else np.zeros(len(composite1), dtype=bool)
+
+    enrichment = np.zeros(len(k1), dtype=bool)
+    suppression = np.zeros(len(k1), dtype=bool)
+    modification = np.zeros(len(k1), dtype=bool)
+    enrichment[pair2[~np.isin(composite2, composite1)]] = True
+    suppression[pair1[~in_both]] = True
+    if len(sorted2) > 0:
+        modification[pair1[in_both & (tag_value[tags1] != tag_value[tags2[order2[position]]])]] = True
+
+    # deleted versions: not a tag modification (see module description)
+    deleted = ~store.visible[k2]
+    return enrichment & ~deleted, suppression & ~deleted, modification & ~deleted
+
+
+
+def chunk_sequence_modifications(store, keys, nodes=None, fingerprints=None):
+    """
+    'sequence_modifications' for a chunk of features whose versions (members and tags) are loaded
+
+    Parameters
+    ----------
+    store : VersionStore
+        LOADED VERSIONS.
+    keys : numpy array
+        LOOKUP KEYS OF THE FEATURES.
+    nodes : NodeCoordinateIndex, optional
+        WHERE THE NODES OF THE WAYS ARE RESOLVED (DEFAULT: THE STORE ITSELF).
+    fingerprints : GeometryFingerprints, optional
+        PRECOMPUTED WAY FINGERPRINTS (SEE 'geometry_fingerprint.py').
+
+    Returns
+    -------
+    (numpy array, numpy array)
+        LENGTH OF THE SEQUENCE OF EACH FEATURE, CODES OF ALL THE SEQUENCES (FEATURE AFTER FEATURE).
+
+    """
+    count, feature_of_pair, k1, k2, geometry_codes = chunk_pair_codes(store, keys, nodes, fingerprints)
+    enrichment, suppression, modification = tag_change_flags(store, k1, k2)
+
+    # One row of (up to) four codes per pair, in the order of 'sequence_modifications', 0 standing for no code
+    pair_codes = np.column_stack([geometry_codes,
+                                  np.where(enrichment, TAG_ENRICHMENT, 0),
+                                  np.where(suppression, TAG_SUPPRESSION, 0),
+                                  np.where(modification, TAG_MODIFICATION, 0)]).ravel()
+    feature_of_code = np.repeat(feature_of_pair, 4)
+    kept = pair_codes != 0
+
+    # features missing from the history: [2]
+    missing = np.nonzero(count < 1)[0]
+    feature_of_code = np.concatenate([feature_of_code[kept], missing])
+    codes = np.concatenate([pair_codes[kept], np.full(len(missing), ERROR)])
+    order = np.argsort(feature_of_code, kind='stable')
+    return np.bincount(feature_of_code, minlength=len(keys)), codes[order].astype(np.int8)
+
+
+
+def batch_sequence_modifications(cur, osm_ids, osm_types=None, pgsql_tablename='history', chunk_size=20000, node_index=None,
+                                 progress=True, fingerprints=None):
+    """
+    batch version of 'sequence_modifications' for a list of features, tag modifications included
+    (see module description)
+
+    Parameters
+    ----------
+    cur : psycopg2 cursor or HistoryStore
+        DATABASE CURSOR, OR LOCAL HISTORY STORE (SEE 'history_store.py').
+    osm_ids : int list
+        OSM FEATURE IDS.
+    osm_types : string list, optional
+        OSM TYPE OF EACH FEATURE (None: LOOKUP BY ID ONLY).
+    pgsql_tablename : string
+        HISTORY TABLE NAME.
+    chunk_size : int
+        NUMBER OF FEATURES PROCESSED AT ONCE (MEMORY BOUND).
+    node_index : NodeCoordinateIndex, optional
+        PREBUILT NODE INDEX (SEE 'node_index.py').
+    progress : boolean
+        DISPLAY A PROGRESS BAR OVER THE CHUNKS.
+    fingerprints : GeometryFingerprints, optional
+        PRECOMPUTED WAY FINGERPRINTS (SEE 'geometry_fingerprint.py').
+
+    Returns
+    -------
+    (numpy array, numpy array)
+        OFFSETS (int64, ONE MORE THAN THE NUMBER OF FEATURES) AND CODES (int8): THE SEQUENCE OF THE FEATURE j
+        IS codes[offsets[j]:offsets[j + 1]].
+
+    """
+    keys = lookup_keys(osm_ids, osm_types)
+    lengths, codes = [], []
+
+    for i in tqdm(range(0, len(keys), chunk_size), disable=not progress):
+        chunk = keys[i:i + chunk_size]
+
+        store = VersionStore(pgsql_tablename)
+        with metrics.timer('batch_load'):
+            load_references(cur, store, chunk, way_nodes=node_index is None)
+            store.load_tags(cur, chunk)
+        with metrics.timer('batch_compute'):
+            chunk_lengths, chunk_codes = chunk_sequence_modifications(store, chunk, node_index, fingerprints)
+        lengths.append(chunk_lengths)
+        codes.append(chunk_codes)
+
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    if len(keys) > 0:
+        offsets[1:] = np.cumsum(np.concatenate(lengths))
+    return offsets, np.concatenate(codes or [np.empty(0, dtype=np.int8)]).astype(np.int8)
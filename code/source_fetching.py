@@ -14,11 +14,27 @@ import time # to compute the elapsed time for each function to return something
 
 from tqdm import tqdm # make loops show a smart progress meter
 
-from osmcha import changeset # OpenStreetMap Changeset Analyzer
+import bz2 # to read .osm.bz2 changeset dumps on-the-fly
+from array import array # typed, growable buffers (int8/int64) for 'DataHandler'
+from multiprocessing import Pool # for the parallel fast scan of PBF files
+
+try:
+    from osmcha import changeset # OpenStreetMap Changeset Analyzer (online resolver only)
+except ImportError:
+    changeset = None # offline resolvers still available (see 'sources_from_changeset_file' and 'sources_from_pgsql')
 import osmium # PyOsmium
+from psycopg2 import sql # for generating dynamically SQL queries (for choosing dynamically a table name)
 
 import numpy as np # numpy
 import pandas as pd # pandas library
+try:
+    import pyarrow as pa # Apache Arrow (Parquet output only)
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None # CSV output still available
+
+from chgset_to_pgsql import parse_changesets # streamed changeset dump parser (see 'chgset_to_pgsql.py')
+from pbf_framing import pbf_blocks # PBF block locator (see 'pbf_framing.py')
 
 
 
@@ -26,42 +42,250 @@ import pandas as pd # pandas library
 
 current_directory_path = os.getcwd()
 
+# Maximum number of changeset ids sent in one 'WHERE id = ANY(%s)' query
+QUERY_CHUNK_SIZE = 100000
+
+# OSM types stored as int8 codes (position in the list)
+OSM_TYPES = ["node", "way", "relation"]
+
+ENTITY_BITS = {"node": osmium.osm.NODE, "way": osmium.osm.WAY, "relation": osmium.osm.RELATION}
+
 
 
 ### Functions
 
 
+def check_parquet_support(filename):
+    """
+    tells whether a file is a Parquet file (based on its extension), and makes sure pyarrow is installed if so
+    
+    Parameter:
+        filename (str): filename with its extension
+        
+    Return:
+        (bool): True for a .parquet file
+    """
+    if not filename.endswith(".parquet"):
+        return False
+    if pa is None:
+        raise ImportError("'pyarrow' is needed for reading/writing Parquet files: install it, or use a .csv file")
+    return True
+
+
+
 class DataHandler(osmium.SimpleHandler):
-    def __init__(self):
+    """
+    collects (type, id, changeset) of every OSM feature into typed buffers
+    (int8 type code, int64 id, int64 changeset): 17 bytes per feature instead of a Python list;
+    when a Parquet writer is given, the buffers are flushed to it every 'batch_size' features
+    """
+    def __init__(self, writer=None, batch_size=1000000):
         osmium.SimpleHandler.__init__(self)
-        self.elements = []
+        self.writer = writer
+        self.batch_size = batch_size
+        self.types = array('b')
+        self.ids = array('q')
+        self.changesets = array('q')
         
     def node(self, n):
-        self.elements.append(["node", n.id, n.changeset])
+        self.add(0, n.id, n.changeset)
         
     def way(self, w):
-        self.elements.append(["way", w.id, w.changeset])
+        self.add(1, w.id, w.changeset)
         
     def relation(self, r):
-        self.elements.append(["relation", r.id, r.changeset])
+        self.add(2, r.id, r.changeset)
+    
+    def add(self, type_code, osm_id, changeset_id):
+        self.types.append(type_code)
+        self.ids.append(osm_id)
+        self.changesets.append(changeset_id)
+        if self.writer is not None and len(self.ids) >= self.batch_size:
+            self.flush()
+    
+    def extend(self, types, ids, changesets):
+        # appends raw buffers (bytes), e.g. returned by a 'scan_blocks' worker
+        self.types.frombytes(types)
+        self.ids.frombytes(ids)
+        self.changesets.frombytes(changesets)
+        if self.writer is not None and len(self.ids) >= self.batch_size:
+            self.flush()
+    
+    def record_batch(self):
+        # Arrow view of the buffers (the type column is dictionary-encoded: int8 codes + type names)
+        return pa.RecordBatch.from_arrays([pa.DictionaryArray.from_arrays(pa.array(np.frombuffer(self.types, dtype=np.int8)), pa.array(OSM_TYPES)),
+                                           pa.array(np.frombuffer(self.ids, dtype=np.int64)),
+                                           pa.array(np.frombuffer(self.changesets, dtype=np.int64))],
+                                          names=["type", "id", "changesetId"])
+    
+    def flush(self):
+        # writes the buffered features to the Parquet file and empties the buffers
+        if len(self.ids) > 0:
+            self.writer.write_batch(self.record_batch())
+        self.types, self.ids, self.changesets = array('b'), array('q'), array('q')
+    
+    def dataframe(self):
+        # pandas view of the buffers ('type' as a categorical column)
+        return pd.DataFrame({"type": pd.Categorical.from_codes(np.frombuffer(self.types, dtype=np.int8), OSM_TYPES),
+                             "id": np.frombuffer(self.ids, dtype=np.int64),
+                             "changesetId": np.frombuffer(self.changesets, dtype=np.int64)})
         
         
+
+def entity_bits(types):
+    """
+    returns the osmium entity bits of a list of OSM types (all of them if None)
     
-def get_data(filepath):
+    Parameter:
+        types (str list): OSM types among "node", "way" and "relation"
+        
+    Return:
+        (osmium.osm.osm_entity_bits)
+    """
+    if types is None:
+        types = OSM_TYPES
+    bits = osmium.osm.NOTHING
+    for osm_type in types:
+        bits |= ENTITY_BITS[osm_type]
+    return bits
+
+
+
+def scan_file(dataHandler, filepath, types=None, nb_threads=0):
+    """
+    [FAST SCAN] reads an OSM data file with a dedicated reader: only the requested types are
+    decoded (the others are skipped directly at the source), no node location is stored,
+    and the blocks are decompressed by a pool of 'nb_threads' threads (0: one per core)
+    
+    Parameter:
+        dataHandler (DataHandler): handler to fill
+        filepath (str): path to OSM data file (or osmium.io.FileBuffer)
+        types (str list): OSM types to read (all of them by default)
+        nb_threads (int): number of decoding threads
+        
+    Return:
+        None
+    """
+    with osmium.io.Reader(filepath, entity_bits(types), thread_pool=osmium.io.ThreadPool(nb_threads)) as reader:
+        osmium.apply(reader, dataHandler)
+
+
+
+def scan_blocks(task):
+    """
+    [FAST SCAN] reads a range of PBF blocks (run by a worker process, see 'get_data')
+    
+    Parameter:
+        task (tuple): (path to the PBF file, file format, raw 'OSMHeader' block,
+            list of (offset, size) of the blocks, OSM types to read)
+        
+    Return:
+        (bytes, bytes, bytes): raw type codes (int8), ids (int64) and changesets (int64)
+    """
+    filepath, file_format, header_block, blocks, types = task
+    
+    data = [header_block]
+    with open(filepath, "rb") as f:
+        for offset, size in blocks:
+            f.seek(offset)
+            data.append(f.read(size))
+    
+    dataHandler = DataHandler()
+    scan_file(dataHandler, osmium.io.FileBuffer(b"".join(data), file_format), types, nb_threads=1)
+    return dataHandler.types.tobytes(), dataHandler.ids.tobytes(), dataHandler.changesets.tobytes()
+
+
+
+def fast_scan(dataHandler, filepath, types=None, nb_workers=None, blocks_per_task=64):
+    """
+    [FAST SCAN] fills the handler with the (type, id, changeset) of all the features of a file;
+    PBF files are split by blocks between 'nb_workers' processes (see 'pbf_blocks'), the results
+    being gathered in file order, so that the output is the same as with a single reader
+    
+    Parameter:
+        dataHandler (DataHandler): handler to fill
+        filepath (str): path to OSM data file
+        types (str list): OSM types to read (all of them by default)
+        nb_workers (int): number of worker processes (default: one per core)
+        blocks_per_task (int): number of PBF blocks read per task
+        
+    Return:
+        None
+    """
+    if not filepath.endswith(".pbf") or nb_workers == 1:
+        scan_file(dataHandler, filepath, types)
+        return
+    
+    file_format = "osh.pbf" if filepath.endswith(".osh.pbf") else "pbf"
+    header_block, data_blocks = pbf_blocks(filepath)
+    tasks = [(filepath, file_format, header_block, data_blocks[i:i + blocks_per_task], types)
+             for i in range(0, len(data_blocks), blocks_per_task)]
+    
+    with Pool(nb_workers) as pool:
+        for result in tqdm(pool.imap(scan_blocks, tasks), total=len(tasks), unit=" tasks"):
+            dataHandler.extend(*result)
+
+
+
+def get_data(filepath, out_filename=None, batch_size=1000000, fast=False, types=None, nb_workers=None):
     """
     imports data from an OSM data file and returns features id along its
     associated changeset id in a Panda Dataframe
     
     Parameter:
         filepath (str): path to OSM data file
+        out_filename (str): if given (.parquet), the features are streamed to this Parquet file
+            in record batches instead of being returned (bounded memory, see 'read_data')
+        batch_size (int): number of features per record batch
+        fast (bool): fast-scan mode (see 'fast_scan'): type filtering at the source,
+            multi-threaded decoding, and PBF blocks split between several processes
+        types (str list): [fast-scan mode] OSM types to read, e.g. ["way"] (all of them by default)
+        nb_workers (int): [fast-scan mode] number of worker processes (default: one per core)
         
     Return:
         (DataFrame): Panda DataFrame containing features id and associated changeset id
+            (None if 'out_filename' is given)
     """
-    dataHandler = DataHandler()
-    dataHandler.apply_file(filepath)
-    col_names = ["type", "id", "changesetId"]
-    return pd.DataFrame(dataHandler.elements, columns=col_names)
+    def scan(dataHandler):
+        if fast:
+            fast_scan(dataHandler, filepath, types, nb_workers)
+        else:
+            dataHandler.apply_file(filepath)
+    
+    if out_filename is None:
+        dataHandler = DataHandler()
+        scan(dataHandler)
+        return dataHandler.dataframe()
+    
+    if not check_parquet_support(out_filename):
+        raise ValueError("'out_filename' has to be a .parquet file")
+    
+    dataHandler = DataHandler(batch_size=batch_size)
+    with pq.ParquetWriter(out_filename, dataHandler.record_batch().schema) as writer:
+        dataHandler.writer = writer
+        scan(dataHandler)
+        dataHandler.flush()
+    return None
+
+
+
+def read_data(filename, batch_size=1000000, columns=None):
+    """
+    [GENERATOR]
+    reads a Parquet file written by 'get_data' (or 'apply_source') record batch by record batch,
+    e.g. to give it to 'apply_source' without loading it entirely in memory
+    
+    Parameter:
+        filename (str): Parquet filename
+        batch_size (int): maximum number of features per DataFrame
+        columns (str list): columns to read (all of them by default)
+        
+    Return:
+        (DataFrame generator)
+    """
+    check_parquet_support(filename)
+    for batch in pq.ParquetFile(filename).iter_batches(batch_size=batch_size, columns=columns):
+        yield batch.to_pandas()
         
 
 
@@ -75,58 +299,208 @@ def get_source(changeset_id):
     Return:
         (str): source key value 
     """
+    if changeset is None:
+        raise ImportError("'osmcha' is needed for fetching sources online: install it, or use an offline resolver "
+                          "('sources_from_changeset_file' or 'sources_from_pgsql')")
     ch = changeset.Analyse(changeset_id)
     return ch.source
 
 
 
+def sources_from_osmcha(changeset_ids):
+    """
+    [ONLINE RESOLVER]
+    retrieves the source key values of changesets from the OSM API (through osmcha),
+    one request per distinct changeset
+    
+    Parameter:
+        changeset_ids (int list): distinct changeset ids
+        
+    Return:
+        (dict): changeset id -> source key value ("" if not reported)
+    """
+    sources = {}
+    for changeset_id in tqdm(changeset_ids):
+        source = get_source(int(changeset_id))
+        sources[int(changeset_id)] = source if source != "Not reported" else ""
+    return sources
+
+
+
+def sources_from_changeset_file(changeset_ids, filepath):
+    """
+    [OFFLINE RESOLVER]
+    retrieves the source key values of changesets from a local changeset dump
+    (e.g. 'changesets-latest.osm.bz2' from planet.openstreetmap.org), parsed on-the-fly:
+    only the requested changesets are kept in memory
+    
+    Parameter:
+        changeset_ids (int list): distinct changeset ids
+        filepath (str): path to the changeset dump (.osm or .osm.bz2)
+        
+    Return:
+        (dict): changeset id -> source key value ("" if not reported or not in the dump)
+    """
+    wanted = {int(changeset_id) for changeset_id in changeset_ids}
+    sources = dict.fromkeys(wanted, "")
+    
+    if filepath.endswith('.bz2'):
+        f = bz2.open(filepath, 'rb') # decompressed on-the-fly while parsing
+    else:
+        f = open(filepath, 'rb')
+    
+    with f:
+        for record in tqdm(parse_changesets(f)):
+            changeset_id = int(record[0])
+            if changeset_id in wanted and record[-1] is not None:
+                sources[changeset_id] = dict(record[-1]).get('source', "")
+    return sources
+
 
 
-def apply_source(data, out_filename="data_with_source.csv"):
+def sources_from_pgsql(changeset_ids, conn, pgsql_tablename='changesets'):
+    """
+    [OFFLINE RESOLVER]
+    retrieves the source key values of changesets from the PostgreSQL table
+    filled by 'chgset_to_pgsql.py', in a few 'WHERE id = ANY(...)' queries
+    
+    Parameter:
+        changeset_ids (int list): distinct changeset ids
+        conn (psycopg2 connection): database connection
+        pgsql_tablename (str): changeset table name
+        
+    Return:
+        (dict): changeset id -> source key value ("" if not reported or not in the table)
+    """
+    changeset_ids = [int(changeset_id) for changeset_id in changeset_ids]
+    sources = dict.fromkeys(changeset_ids, "")
+    
+    cur = conn.cursor()
+    for i in range(0, len(changeset_ids), QUERY_CHUNK_SIZE):
+        cur.execute(sql.SQL("SELECT id, tags -> 'source' FROM {} WHERE id = ANY(%s);").format(sql.Identifier(pgsql_tablename)),
+                    (changeset_ids[i:i + QUERY_CHUNK_SIZE],))
+        for changeset_id, source in cur.fetchall():
+            sources[changeset_id] = source if source is not None else ""
+    cur.close()
+    return sources
+
+
+
+
+
+def data_chunks(data, chunk_size):
+    """
+    [GENERATOR]
+    yields the input features chunk by chunk (views on the DataFrame, nothing is copied)
+    
+    Parameter:
+        data (DataFrame or iterable of DataFrames): features, e.g. from 'get_data' or
+            from pd.read_csv(..., chunksize=...) (already chunked: yielded as it is)
+        chunk_size (int): number of features per chunk
+        
+    Return:
+        (DataFrame generator)
+    """
+    if not isinstance(data, pd.DataFrame):
+        yield from data
+        return
+    for i in range(0, data.shape[0], chunk_size):
+        yield data.iloc[i:i + chunk_size]
+
+
+
+def apply_source(data, out_filename="data_with_source.csv", resolver=sources_from_osmcha, chunk_size=1000000, return_data=True):
     """
     add the source key values column to the input that corresponds to each feature in
     the input data
     the result is also saved in a .csv file in root
     
+    N.B.: the features are processed chunk by chunk in linear time (distinct changesets of
+    the chunk -> sources -> joined back to the features), and each chunk is appended to the
+    output file as soon as it is ready; each distinct changeset is resolved only once overall
+    (thousands of features usually share the same changeset)
+    
     Parameter:
-        data (DataFrame): Panda DataFrame containing features id and associated changeset id
-        out_filename (str): filename for the output file (with its extension!)
+        data (DataFrame or iterable of DataFrames): features id and associated changeset id
+            (an iterable of chunks, e.g. pd.read_csv(..., chunksize=...), is never fully loaded in memory)
+        out_filename (str): filename for the output file (with its extension!): .csv, or .parquet
+            for a columnar output (typed columns, no text parsing when reading it back)
+        resolver (function): called as resolver(changeset_ids) with the distinct changeset ids, returns
+            a dict changeset id -> source key value; 'sources_from_osmcha' (online) by default, or
+            an offline one, e.g. functools.partial(sources_from_pgsql, conn=conn)
+        chunk_size (int): number of features processed and written at once
+        return_data (bool): if False, the result is only written to the output file (bounded memory)
         
     Return:
-        (DataFrame): Panda DataFrame with columns [type, id, changesetId, source] (in order)
+        (DataFrame): Panda DataFrame with columns [type, id, changesetId, source] (in order),
+            or None if 'return_data' is False
     """
     
     print("\n\n\n-------------- Applying source process started... -------------- \n\n")
     start_time = time.time()
     
+    sources = {} # changeset id -> source, for all the changesets resolved so far
+    resolving_time = 0
+    nb_features = 0
+    nb_chunks = 0
+    new_data = []
+    parquet = check_parquet_support(out_filename)
+    writer = None
     
-    # new_data = data[:50].copy()
-    new_data = data.copy()
-    source_column = np.array([])
-    
+    progress = tqdm(total=data.shape[0] if isinstance(data, pd.DataFrame) else None, unit=" features")
     
-    for i in tqdm(new_data.index):
+    for chunk in data_chunks(data, chunk_size):
         
-        changeset_id = int(new_data.loc[i, "changesetId"])
-        source = get_source(changeset_id)
+        # Resolving the changesets never met before
+        changeset_ids = pd.unique(chunk["changesetId"])
+        new_changeset_ids = [changeset_id for changeset_id in changeset_ids if changeset_id not in sources]
+        if len(new_changeset_ids) > 0:
+            resolving_start_time = time.time()
+            sources.update(resolver(new_changeset_ids))
+            resolving_time += time.time() - resolving_start_time
         
-        if source != "Not reported":
-            source_column = np.append(source_column, source)
+        # Joining the sources back to the features (changesets missing from the resolver: "")
+        chunk = chunk.assign(source=chunk["changesetId"].map(sources).fillna(""))
+        
+        # Appending the chunk to the output file (the first one creates it, with the header/schema)
+        if parquet:
+            if writer is None:
+                writer = pq.ParquetWriter(out_filename, pa.Schema.from_pandas(chunk, preserve_index=False))
+            writer.write_table(pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False))
         else:
-            source_column = np.append(source_column, "")
+            chunk.to_csv(out_filename, float_format="%.3f", index_label='index', sep=" ", mode='w' if nb_chunks == 0 else 'a', header=nb_chunks == 0)
         
-    new_data['source'] = source_column.tolist()
-
+        if return_data:
+            new_data.append(chunk)
+        nb_features += chunk.shape[0]
+        nb_chunks += 1
+        progress.update(chunk.shape[0])
+        progress.set_postfix(changesets=len(sources))
     
-
-    new_data.to_csv(out_filename, float_format="%.3f", index_label='index', sep=" ")
+    progress.close()
+    
+    if writer is not None:
+        writer.close()
+    
+    if nb_chunks == 0:
+        # no features at all: empty output file (header only)
+        new_data.append(pd.DataFrame(columns=["type", "id", "changesetId", "source"]))
+        if parquet:
+            pq.write_table(pa.Table.from_pandas(new_data[0], preserve_index=False), out_filename)
+        else:
+            new_data[0].to_csv(out_filename, index_label='index', sep=" ")
 
 
     end_time = time.time()
+    elapsed_time = end_time - start_time
     
-    print("\n\n\n-------------- Job's finished! --------------\nElapsed time: ", round(end_time - start_time, 2), "seconds\n\n\n")
+    print("\n\n\n-------------- Job's finished! --------------\nElapsed time: ", round(elapsed_time, 2), "seconds")
+    print("Features:", nb_features, "(", round(nb_features / elapsed_time) if elapsed_time > 0 else "-", "features/s )")
+    print("Distinct changesets:", len(sources), "(resolved in", round(resolving_time, 2), "seconds)\n\n\n")
     
-    return new_data
+    if not return_data:
+        return None
+    return pd.concat(new_data)
     
 
 
@@ -144,6 +518,20 @@ if __name__ == '__main__':
     
     roads_uusimaa = get_data(current_directory_path + "/" + roads_filename)
     
-    # Source values retrieval
+    # # (fast-scan mode: e.g. only the ways of the buildings, read in parallel)
+    # buildings_uusimaa = get_data(current_directory_path + "/" + buidlings_filename, fast=True, types=["way"])
+    
+    # # (for very large files: streamed to Parquet, then read back batch by batch)
+    # get_data(current_directory_path + "/" + roads_filename, "roads-uusimaa.parquet")
+    # roads_uusimaa = read_data("roads-uusimaa.parquet")
+    
+    # Source values retrieval (online, through osmcha)
+    
+    roads_uusimaa_source = apply_source(roads_uusimaa, "roads-uusimaa_source.csv")
     
-    roads_uusimaa_source = apply_source(roads_uusimaa, "roads-uusimaa_source.csv")
\ No newline at end of file
+    # # ... or offline, from a local changeset dump or from the table filled by 'chgset_to_pgsql.py'
+    # # (from functools import partial)
+    # roads_uusimaa_source = apply_source(roads_uusimaa, "roads-uusimaa_source.csv",
+    #                                     partial(sources_from_changeset_file, filepath="uusimaa-changesets.osm.bz2"))
+    # roads_uusimaa_source = apply_source(roads_uusimaa, "roads-uusimaa_source.csv",
+    #                                     partial(sources_from_pgsql, conn=psycopg2.connect(database="uusimaa", user="postgres", password="postgres", host="localhost", port="5432")))
\ No newline at end of file
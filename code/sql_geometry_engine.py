@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+                    SET-BASED SQL GEOMETRY MODIFICATION ENGINE
+
+
+------------------------------------------------------------------------------
+"""
+
+"""
+In-database version of 'nb_geometry_modification' (see 'typology_modif_encoding_copy.py'):
+the whole computation runs inside PostgreSQL, next to the history table, and the results are written to a table.
+
+    - the versions of the features are numbered with 'row_number() OVER (... ORDER BY version, id)'
+      and paired with their next version,
+    - the referenced nodes of both way versions are unnested side by side ('unnest(refs1, refs2) WITH ORDINALITY'),
+      and each of them is resolved to its version valid at the way timestamp with a 'LATERAL ... LIMIT 1' index lookup,
+    - the code of a way version pair is the status of its first node that is not unchanged,
+    - relations (a small share of the buildings) go through a recursive PL/pgSQL function, created for the session only
+      ('pg_temp' schema), with the same rules.
+
+The results are exactly the ones of 'nb_geometry_modification' (and of the batch engine, see 'geometry_batch_engine.py'):
+    - the feature type is the one of its first version,
+    - a referenced member is resolved to its latest version older than (or as old as) the
+      timestamp of the way/relation version, the first one in version order on ties,
+    - missing members (edge effect) or members younger than their way/relation give the error code 2,
+      and any error in the sequence of a feature (or a feature missing from the history) gives NULL.
+Cyclic relations get NULL, as in 'nb_geometry_modification' (code 3, propagated to the feature, instead of failing the
+whole statement). The only difference: relations nested deeper than 'MAX_RELATION_DEPTH' without any cycle are treated
+the same way.
+"""
+
+
+
+### Libraries import
+
+from psycopg2 import sql    # for generating dynamically SQL queries (for choosing dynamically a table name)
+
+
+
+### Code
+
+
+# Deepest relation nesting followed by 'geometry_modification_code' (beyond: cyclic relations, code 3)
+MAX_RELATION_DEPTH = 100
+
+FEATURES_TABLENAME = 'geometry_modification_features'
+
+# Same features as 'get_geometry_modification': relations ('osm_id') and closed ways ('osm_way_id') of the NLS buildings
+NLS_FEATURES_QUERY = """SELECT * FROM
+
+(SELECT CAST(osm_id AS bigint), 'relation' AS osm_type FROM nls_buildings_multipolygons
+UNION
+SELECT CAST(osm_way_id AS bigint), 'way' AS osm_type FROM nls_buildings_multipolygons) AS temp
+
+WHERE temp.osm_id IS NOT NULL"""
+
+
+# Version of a member valid at a timestamp (see 'geometry_references_resolver'), NULL if missing or younger
+RESOLVE_VERSION_FUNCTION = """CREATE OR REPLACE FUNCTION pg_temp.resolve_version(member_id bigint, member_type text, ts timestamp)
+RETURNS bigint AS $$
+    SELECT id FROM {history}
+    WHERE osm_id = member_id AND osm_type IN ('node', 'way', 'relation') AND (member_type IS NULL OR osm_type = member_type)
+    AND "timestamp" <= ts
+    ORDER BY "timestamp" DESC, version, id LIMIT 1;
+$$ LANGUAGE sql STABLE;"""
+
+# 'geometry_modification' for a pair of way versions with the same (non null) number of nodes
+WAY_CODE_FUNCTION = """CREATE OR REPLACE FUNCTION pg_temp.way_code(id1 bigint, id2 bigint)
+RETURNS integer AS $$
+    -- (same node status as 'way_nodes' below: a first node without coordinates is a modification, as NaN in Python)
+    SELECT COALESCE((SELECT s.status
+                     FROM {history} AS h1
+                     JOIN {history} AS h2 ON h2.id = id2
+                     CROSS JOIN LATERAL unnest(h1.members_refs, h2.members_refs) WITH ORDINALITY AS r(ref1, ref2, i)
+                     LEFT JOIN {history} AS n1 ON n1.id = pg_temp.resolve_version(r.ref1, 'node', h1."timestamp")
+                     LEFT JOIN {history} AS n2 ON n2.id = pg_temp.resolve_version(r.ref2, 'node', h2."timestamp")
+                     CROSS JOIN LATERAL (SELECT CASE WHEN n1.id IS NULL OR n2.id IS NULL THEN 2
+                                                     WHEN (n1.lat = n2.lat AND n1.lon = n2.lon) OR (n2.lat IS NULL AND n2.lon IS NULL) THEN 0
+                                                     ELSE 1 END AS status) AS s
+                     WHERE h1.id = id1 AND s.status <> 0
+                     ORDER BY r.i LIMIT 1), 0);
+$$ LANGUAGE sql STABLE;"""
+
+# [RECURSIVE FUNCTION] 'geometry_modification' for any pair of versions: 0 (None), 1 or 2 (3: cyclic relation)
+GEOMETRY_MODIFICATION_FUNCTION = """CREATE OR REPLACE FUNCTION pg_temp.geometry_modification_code(id1 bigint, id2 bigint, feature_type text, depth integer)
+RETURNS integer AS $$
+DECLARE
+    ts1 timestamp; ts2 timestamp;
+    lat1 double precision; lon1 double precision; lat2 double precision; lon2 double precision;
+    refs1 bigint[]; refs2 bigint[]; types1 text[]; types2 text[];
+    m1 bigint; m2 bigint; member_type1 text; member_type2 text; member_code integer;
+BEGIN
+    SELECT "timestamp", lat, lon, members_refs, {members_types} INTO ts1, lat1, lon1, refs1, types1 FROM {history} WHERE id = id1;
+    SELECT "timestamp", lat, lon, members_refs, {members_types} INTO ts2, lat2, lon2, refs2, types2 FROM {history} WHERE id = id2;
+
+    IF feature_type = 'node' THEN
+        IF (lat1 = lat2 AND lon1 = lon2) OR (lat2 IS NULL AND lon2 IS NULL) THEN
+            RETURN 0;
+        END IF;
+        RETURN 1;
+    END IF;
+
+    IF refs2 IS NULL THEN
+        RETURN 0; -- geometry erased
+    END IF;
+    IF refs1 IS NULL THEN
+        RETURN 2; -- no referenced members: DATA error
+    END IF;
+    IF cardinality(refs1) <> cardinality(refs2) THEN
+        RETURN 1;
+    END IF;
+
+    IF feature_type = 'way' THEN
+        RETURN pg_temp.way_code(id1, id2);
+    END IF;
+
+    IF depth >= {max_depth} THEN
+        RETURN 3; -- cyclic relation
+    END IF;
+
+    FOR i IN 1..cardinality(refs1) LOOP
+        m1 := pg_temp.resolve_version(refs1[i], types1[i], ts1);
+        m2 := pg_temp.resolve_version(refs2[i], types2[i], ts2);
+        IF m1 IS NULL OR m2 IS NULL THEN
+            RETURN 2; -- missing member (EDGE EFFECT) or member younger than the relation
+        END IF;
+        SELECT osm_type INTO member_type1 FROM {history} WHERE id = m1;
+        SELECT osm_type INTO member_type2 FROM {history} WHERE id = m2;
+        IF member_type1 <> member_type2 THEN
+            RETURN 1;
+        END IF;
+        member_code := pg_temp.geometry_modification_code(m1, m2, member_type1, depth + 1);
+        IF member_code = 3 THEN
+            RETURN 3;
+        END IF;
+        IF member_code <> 0 THEN
+            RETURN 1; -- N.B.: as in 'geometry_modification', an error in a member counts as a modification
+        END IF;
+    END LOOP;
+    RETURN 0;
+END;
+$$ LANGUAGE plpgsql STABLE;"""
+
+
+# All the features at once: version pairs, ways node by node (set-based), relations through the recursive function
+NB_GEOMETRY_MODIFICATION_QUERY = """INSERT INTO {results} (rank, osm_id, osm_type, nb_geometry_modification)
+
+WITH versions AS (
+    SELECT f.rank, h.id, h.osm_type, h.members_refs, h."timestamp", h.lat, h.lon,
+           row_number() OVER (PARTITION BY f.rank ORDER BY h.version, h.id) AS position
+    FROM {features} AS f
+    JOIN {history} AS h ON h.osm_id = f.osm_id AND h.osm_type = f.osm_type
+    UNION ALL
+    SELECT f.rank, h.id, h.osm_type, h.members_refs, h."timestamp", h.lat, h.lon,
+           row_number() OVER (PARTITION BY f.rank ORDER BY h.version, h.id) AS position
+    FROM {features} AS f
+    JOIN {history} AS h ON h.osm_id = f.osm_id AND h.osm_type IN ('node', 'way', 'relation')
+    WHERE f.osm_type IS NULL
+),
+
+pairs AS (
+    -- consecutive versions, with the type of the first version of the feature
+    SELECT v1.rank, v1.id AS id1, v2.id AS id2, first.osm_type AS feature_type,
+           v1.members_refs AS refs1, v2.members_refs AS refs2, v1."timestamp" AS ts1, v2."timestamp" AS ts2,
+           v1.lat AS lat1, v1.lon AS lon1, v2.lat AS lat2, v2.lon AS lon2
+    FROM versions AS v1
+    JOIN versions AS v2 ON v2.rank = v1.rank AND v2.position = v1.position + 1
+    JOIN versions AS first ON first.rank = v1.rank AND first.position = 1
+),
+
+way_nodes AS (
+    -- referenced nodes of both way versions side by side, each one resolved at its way version timestamp
+    SELECT p.id1, p.id2, r.i,
+           CASE WHEN n1.id IS NULL OR n2.id IS NULL THEN 2
+                WHEN (n1.lat = n2.lat AND n1.lon = n2.lon) OR (n2.lat IS NULL AND n2.lon IS NULL) THEN 0
+                ELSE 1 END AS status
+    FROM pairs AS p
+    CROSS JOIN LATERAL unnest(p.refs1, p.refs2) WITH ORDINALITY AS r(ref1, ref2, i)
+    LEFT JOIN LATERAL (SELECT id, lat, lon FROM {history}
+                       WHERE osm_type = 'node' AND osm_id = r.ref1 AND "timestamp" <= p.ts1
+                       ORDER BY "timestamp" DESC, version, id LIMIT 1) AS n1 ON true
+    LEFT JOIN LATERAL (SELECT id, lat, lon FROM {history}
+                       WHERE osm_type = 'node' AND osm_id = r.ref2 AND "timestamp" <= p.ts2
+                       ORDER BY "timestamp" DESC, version, id LIMIT 1) AS n2 ON true
+    WHERE p.feature_type = 'way' AND cardinality(p.refs1) = cardinality(p.refs2)
+),
+
+way_codes AS (
+    -- status of the first node that is not unchanged
+    SELECT DISTINCT ON (id1, id2) id1, id2, status FROM way_nodes WHERE status <> 0 ORDER BY id1, id2, i
+),
+
+codes AS (
+    SELECT p.rank,
+           CASE WHEN p.feature_type = 'node' THEN
+                    CASE WHEN (p.lat1 = p.lat2 AND p.lon1 = p.lon2) OR (p.lat2 IS NULL AND p.lon2 IS NULL) THEN 0 ELSE 1 END
+                WHEN p.feature_type = 'way' THEN
+                    CASE WHEN p.refs2 IS NULL THEN 0
+                         WHEN p.refs1 IS NULL THEN 2
+                         WHEN cardinality(p.refs1) <> cardinality(p.refs2) THEN 1
+                         ELSE COALESCE(w.status, 0) END
+                ELSE pg_temp.geometry_modification_code(p.id1, p.id2, p.feature_type, 0) END AS code
+    FROM pairs AS p
+    LEFT JOIN way_codes AS w ON w.id1 = p.id1 AND w.id2 = p.id2
+)
+
+SELECT f.rank, f.osm_id, f.osm_type,
+       CASE WHEN NOT EXISTS (SELECT 1 FROM versions AS v WHERE v.rank = f.rank) THEN NULL -- missing from the history
+            WHEN bool_or(c.code >= 2) THEN NULL                                             -- error in the sequence
+            ELSE count(c.code) FILTER (WHERE c.code = 1) END
+FROM {features} AS f
+LEFT JOIN codes AS c ON c.rank = f.rank
+GROUP BY f.rank, f.osm_id, f.osm_type;"""
+
+
+
+def create_sql_functions(cur, pgsql_tablename='history'):
+    """
+    creates the functions of the engine for the current session ('pg_temp' schema: nothing is left in the database)
+
+    Parameters
+    ----------
+    cur : psycopg2 cursor
+        DATABASE CURSOR.
+    pgsql_tablename : string
+        HISTORY TABLE NAME.
+
+    Returns
+    -------
+    None.
+
+    """
+    # History tables imported before the member types were recorded: lookup by id only
+    cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = 'members_types';", (pgsql_tablename,))
+    members_types = sql.SQL("members_types" if cur.fetchone() is not None else "NULL::text[]")
+
+    history = sql.Identifier(pgsql_tablename)
+    cur.execute(sql.SQL(RESOLVE_VERSION_FUNCTION).format(history=history))
+    cur.execute(sql.SQL(WAY_CODE_FUNCTION).format(history=history))
+    cur.execute(sql.SQL(GEOMETRY_MODIFICATION_FUNCTION).format(history=history, members_types=members_types,
+                                                               max_depth=sql.Literal(MAX_RELATION_DEPTH)))
+
+
+
+def recreated_nodes_relations(cur, pgsql_tablename='history'):
+    """
+    returns the relations whose member ways reference nodes deleted then recreated (a version without coordinates
+    followed by a version with coordinates): the corner case of 'way_code' where NULL coordinates must be a
+    modification, as NaN in 'geometry_modification' (see 'check_sql_engine' in 'typology_modif_encoding_copy.py')
+
+    Parameters
+    ----------
+    cur : psycopg2 cursor
+        DATABASE CURSOR.
+    pgsql_tablename : string
+        HISTORY TABLE NAME.
+
+    Returns
+    -------
+    list
+        OSM IDS OF THE RELATIONS.
+
+    """
+    cur.execute(sql.SQL("""WITH recreated AS (
+    SELECT DISTINCT d.osm_id FROM {0} AS d
+    WHERE d.osm_type = 'node' AND d.lat IS NULL AND d.lon IS NULL
+    AND EXISTS (SELECT 1 FROM {0} AS n WHERE n.osm_type = 'node' AND n.osm_id = d.osm_id AND n.version > d.version AND n.lat IS NOT NULL)
+),
+ways AS (
+    SELECT DISTINCT w.osm_id FROM {0} AS w WHERE w.osm_type = 'way' AND w.members_refs && ARRAY(SELECT osm_id FROM recreated)
+)
+SELECT DISTINCT r.osm_id FROM {0} AS r
+WHERE r.osm_type = 'relation' AND r.members_refs && ARRAY(SELECT osm_id FROM ways)
+ORDER BY r.osm_id;""").format(sql.Identifier(pgsql_tablename)))
+    return [row[0] for row in cur.fetchall()]
+
+
+
+def sql_nb_geometry_modification(cur, osm_ids=None, osm_types=None, pgsql_tablename='history',
+                                 results_tablename='nb_geometry_modification_sql'):
+    """
+    in-database version of 'nb_geometry_modification', for a list of features (or all the NLS buildings):
+    the results are written to 'results_tablename' (one line per feature: rank, osm_id, osm_type, nb_geometry_modification)
+    and returned in the input order. The transaction is committed by the caller.
+
+    Parameters
+    ----------
+    cur : psycopg2 cursor
+        DATABASE CURSOR.
+    osm_ids : int list, optional
+        OSM FEATURE IDS (None: ALL THE FEATURES OF 'nls_buildings_multipolygons', SEE 'NLS_FEATURES_QUERY').
+    osm_types : string list, optional
+        OSM TYPE OF EACH FEATURE (None: LOOKUP BY ID ONLY, AS 'nb_geometry_modification(osm_id)').
+    pgsql_tablename : string
+        HISTORY TABLE NAME.
+    results_tablename : string
+        RESULTS TABLE NAME (EMPTIED BEFORE EACH RUN).
+
+    Returns
+    -------
+    list
+        NUMBER OF GEOMETRY MODIFICATIONS PER FEATURE (int or None), IN THE INPUT ORDER.
+
+    """
+    create_sql_functions(cur, pgsql_tablename)
+
+    # Input features, numbered in the input order
+    features = sql.Identifier(FEATURES_TABLENAME)
+    cur.execute(sql.SQL("DROP TABLE IF EXISTS pg_temp.{};").format(features))
+    cur.execute(sql.SQL("CREATE TEMPORARY TABLE {} (rank bigint PRIMARY KEY, osm_id bigint, osm_type text);").format(features))
+    if osm_ids is None:
+        cur.execute(sql.SQL("INSERT INTO {} SELECT row_number() OVER (ORDER BY osm_type, osm_id), osm_id, osm_type FROM (" + NLS_FEATURES_QUERY + ") AS nls;").format(features))
+    else:
+        osm_ids = [int(osm_id) for osm_id in osm_ids]
+        osm_types = list(osm_types) if osm_types is not None else [None] * len(osm_ids)
+        cur.execute(sql.SQL("INSERT INTO {} SELECT rank, osm_id, osm_type FROM unnest(%s::bigint[], %s::text[]) WITH ORDINALITY AS f(osm_id, osm_type, rank);").format(features),
+                    (osm_ids, osm_types))
+    cur.execute(sql.SQL("ANALYZE {};").format(features))
+
+    results = sql.Identifier(results_tablename)
+    cur.execute(sql.SQL("""CREATE TABLE IF NOT EXISTS {}
+(
+    rank bigint,
+    osm_id bigint,
+    osm_type text,
+    nb_geometry_modification integer
+);""").format(results))
+    cur.execute(sql.SQL("TRUNCATE {};").format(results))
+
+    cur.execute(sql.SQL(NB_GEOMETRY_MODIFICATION_QUERY).format(results=results, features=features, history=sql.Identifier(pgsql_tablename)))
+
+    cur.execute(sql.SQL("SELECT nb_geometry_modification FROM {} ORDER BY rank;").format(results))
+    return [row[0] for row in cur.fetchall()]
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+                    SYNTHETIC OSM HISTORY GENERATOR
+
+
+------------------------------------------------------------------------------
+"""
+
+"""
+Deterministic generator of OSM history files (.osh XML and .osh.pbf, same content) and of the matching
+changeset file (.osm or .osm.bz2), of configurable size, for benchmarking the scripts of this project
+(see 'benchmark.py') without downloading any extract.
+
+The data imitates the buildings of our case study:
+    - nodes are the corners of the buildings, a few nodes being shared between neighbouring buildings,
+    - ways are closed rings of 4 to 8 nodes tagged 'building', relations are multipolygons of 1 to 3 ways,
+    - every feature gets 1 to 2*versions_per_feature-1 versions (versions_per_feature on average),
+      each new version being a geometry edit (moved node, node replaced/added in a way, member added to a relation)
+      with probability 'geometry_edit_share', or a tag edit otherwise,
+    - versions are dated so that the members of a way/relation always exist when it is created
+      (no edge effect, except the ones introduced by the geometry edits themselves).
+
+The same seed always gives the same files.
+"""
+
+
+
+### Librairies import
+
+import random
+import datetime
+import bz2    # for compressing the changeset file (.osm.bz2), as the dumps of planet.openstreetmap.org
+from xml.sax.saxutils import quoteattr    # for escaping the XML attributes of the changeset file
+from tqdm import tqdm   # for displaying a progress bar on loops
+
+import osmium    # PyOsmium, for writing .osh/.osh.pbf history files
+from osmium.osm.mutable import Node, Way, Relation
+
+
+
+
+### Code
+
+
+FIRST_TIMESTAMP = datetime.datetime(2008, 1, 1, tzinfo=datetime.timezone.utc)
+DAY = datetime.timedelta(days=1)
+
+# Periods (in days since FIRST_TIMESTAMP) in which the first versions are created, per feature type
+# (nodes, then the ways using them, then the relations using the ways), the later versions being spread until LAST_DAY
+FIRST_VERSION_DAYS = {'node': (0, 1000), 'way': (1000, 1400), 'relation': (1400, 1600)}
+LAST_DAY = 5800
+
+
+
+class SyntheticHistory:
+    """
+    Generates the versions of the synthetic features, feature after feature (see 'generate_history')
+    """
+    def __init__(self, nb_nodes, nb_ways, nb_relations, versions_per_feature=3, geometry_edit_share=0.5,
+                 nb_users=500, changeset_size=20, seed=0):
+        self.nb_nodes = nb_nodes
+        self.nb_ways = nb_ways
+        self.nb_relations = nb_relations
+        self.versions_per_feature = versions_per_feature
+        self.geometry_edit_share = geometry_edit_share
+        self.nb_users = nb_users
+        self.changeset_size = changeset_size # average number of feature versions per changeset
+        self.random = random.Random(seed)
+        self.changesets = {} # changeset id -> (first timestamp, last timestamp, uid, number of changes)
+
+    def version_timestamps(self, osm_type):
+        # timestamps of the successive versions of a feature
+        first_day, last_day = FIRST_VERSION_DAYS[osm_type]
+        nb_versions = self.random.randint(1, 2 * self.versions_per_feature - 1)
+        days = sorted([self.random.uniform(first_day, last_day)] +
+                      [self.random.uniform(last_day, LAST_DAY) for _ in range(nb_versions - 1)])
+        return [FIRST_TIMESTAMP + day * DAY for day in days]
+
+    def metadata(self, version, timestamp):
+        # changeset and user of a version (the changesets are recorded for 'write_changesets')
+        # (changesets are consecutive time slices, so that each one only spans a few days, as real ones)
+        nb_changesets = max(1, self.total_versions // self.changeset_size)
+        changeset_id = min(int((timestamp - FIRST_TIMESTAMP) / DAY * nb_changesets / LAST_DAY), nb_changesets - 1) + 1
+        uid = (changeset_id * 7919) % self.nb_users + 1 # one user per changeset
+        first, last, changeset_uid, nb_changes = self.changesets.get(changeset_id, (timestamp, timestamp, uid, 0))
+        self.changesets[changeset_id] = (min(first, timestamp), max(last, timestamp), uid, nb_changes + 1)
+        return dict(version=version, visible=True, changeset=changeset_id, timestamp=timestamp, uid=uid, user='user_' + str(uid))
+
+    @property
+    def total_versions(self):
+        # expected number of versions (for sizing the changesets)
+        return (self.nb_nodes + self.nb_ways + self.nb_relations) * self.versions_per_feature
+
+    def way_nodes(self, way_id):
+        # closed ring of 4 to 8 consecutive nodes (wrapping around the node ids), i.e. neighbouring buildings may share nodes
+        nb_corners = self.random.randint(4, 8)
+        first = (way_id * 5) % self.nb_nodes
+        ring = [(first + i) % self.nb_nodes + 1 for i in range(nb_corners)]
+        return ring + [ring[0]]
+
+    def nodes(self):
+        # [GENERATOR] versions of all the nodes
+        for node_id in range(1, self.nb_nodes + 1):
+            lat, lon = 59.9 + self.random.random() * 0.5, 24.5 + self.random.random() * 0.8
+            tags = {}
+            for version, timestamp in enumerate(self.version_timestamps('node'), 1):
+                if version > 1:
+                    if self.random.random() < self.geometry_edit_share:
+                        lat, lon = lat + self.random.uniform(-1e-4, 1e-4), lon + self.random.uniform(-1e-4, 1e-4)
+                    else:
+                        tags = {'entrance': self.random.choice(['yes', 'main', 'service'])}
+                yield Node(id=node_id, location=(round(lon, 7), round(lat, 7)), tags=tags, **self.metadata(version, timestamp))
+
+    def ways(self):
+        # [GENERATOR] versions of all the ways
+        for way_id in range(1, self.nb_ways + 1):
+            refs = self.way_nodes(way_id)
+            tags = {'building': 'yes'}
+            for version, timestamp in enumerate(self.version_timestamps('way'), 1):
+                if version > 1:
+                    if self.random.random() < self.geometry_edit_share:
+                        refs = list(refs)
+                        position = self.random.randrange(1, len(refs) - 1)
+                        new_node = self.random.randint(1, self.nb_nodes)
+                        if self.random.random() < 0.5:
+                            refs[position] = new_node # node replaced
+                        else:
+                            refs.insert(position, new_node) # node added
+                    else:
+                        tags = {'building': self.random.choice(['yes', 'house', 'residential', 'detached']),
+                                'building:levels': str(self.random.randint(1, 8))}
+                yield Way(id=way_id, nodes=refs, tags=tags, **self.metadata(version, timestamp))
+
+    def relations(self):
+        # [GENERATOR] versions of all the (multipolygon) relations
+        for relation_id in range(1, self.nb_relations + 1):
+            members = [('w', self.random.randint(1, self.nb_ways), 'outer') for _ in range(self.random.randint(1, 3))]
+            tags = {'type': 'multipolygon', 'building': 'yes'}
+            for version, timestamp in enumerate(self.version_timestamps('relation'), 1):
+                if version > 1:
+                    if self.random.random() < self.geometry_edit_share:
+                        members = members + [('w', self.random.randint(1, self.nb_ways), 'inner')]
+                    else:
+                        tags = dict(tags, name='Building ' + str(self.random.randint(1, 1000)))
+                yield Relation(id=relation_id, members=members, tags=tags, **self.metadata(version, timestamp))
+
+
+
+def write_changesets(changesets, changeset_filename):
+    """
+    writes the changesets of the generated versions as an OSM changeset file (same format as the changeset dumps)
+
+    Parameters
+    ----------
+    changesets : dict
+        CHANGESET ID -> (FIRST TIMESTAMP, LAST TIMESTAMP, UID, NUMBER OF CHANGES).
+    changeset_filename : string
+        OUTPUT FILENAME (.osm, OR .osm.bz2 FOR A COMPRESSED FILE).
+
+    Returns
+    -------
+    int
+        NUMBER OF CHANGESETS WRITTEN.
+
+    """
+    timestamp_format = lambda timestamp: timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')
+    f = bz2.open(changeset_filename, 'wt', encoding='utf-8') if changeset_filename.endswith('.bz2') else open(changeset_filename, 'w', encoding='utf-8')
+    with f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="synthetic_history.py">\n')
+        for changeset_id in sorted(changesets):
+            first, last, uid, nb_changes = changesets[changeset_id]
+            f.write(' <changeset id="%d" created_at="%s" closed_at="%s" open="false" user=%s uid="%d" '
+                    'min_lat="59.9" min_lon="24.5" max_lat="60.4" max_lon="25.3" num_changes="%d" comments_count="0">\n'
+                    % (changeset_id, timestamp_format(first), timestamp_format(last + datetime.timedelta(minutes=1)),
+                       quoteattr('user_' + str(uid)), uid, nb_changes))
+            f.write('  <tag k="created_by" v="synthetic_history.py"/>\n')
+            f.write('  <tag k="comment" v=%s/>\n' % quoteattr('Changeset ' + str(changeset_id)))
+            f.write(' </changeset>\n')
+        f.write('</osm>\n')
+    return len(changesets)
+
+
+
+def generate_history(history_filenames, changeset_filename=None, nb_nodes=100000, nb_ways=20000, nb_relations=1000,
+                     versions_per_feature=3, geometry_edit_share=0.5, seed=0, progress=True):
+    """
+    generates a synthetic OSM history, written to one or several history files at once
+    (e.g. ['synthetic.osh', 'synthetic.osh.pbf']: same content, XML and PBF), and its changeset file
+
+    Parameters
+    ----------
+    history_filenames : string list
+        OUTPUT HISTORY FILENAMES (FORMAT FROM THE EXTENSION: .osh, .osh.pbf...).
+    changeset_filename : string, optional
+        OUTPUT CHANGESET FILENAME (.osm OR .osm.bz2).
+    nb_nodes, nb_ways, nb_relations : int
+        NUMBER OF FEATURES OF EACH OSM TYPE.
+    versions_per_feature : int
+        AVERAGE NUMBER OF VERSIONS PER FEATURE.
+    geometry_edit_share : float
+        SHARE OF THE NEW VERSIONS BEING GEOMETRY EDITS (THE OTHERS ARE TAG EDITS).
+    seed : int
+        RANDOM SEED (SAME SEED, SAME FILES).
+    progress : boolean
+        DISPLAY A PROGRESS BAR.
+
+    Returns
+    -------
+    dict
+        NUMBER OF VERSIONS PER OSM TYPE, AND NUMBER OF CHANGESETS.
+
+    """
+    history = SyntheticHistory(nb_nodes, nb_ways, nb_relations, versions_per_feature, geometry_edit_share, seed=seed)
+
+    header = osmium.io.Header()
+    header.has_multiple_object_versions = True
+    writers = [osmium.SimpleWriter(osmium.io.File(filename), 4096 * 1024, header, overwrite=True) for filename in history_filenames]
+
+    counts = {'node': 0, 'way': 0, 'relation': 0}
+    progress_bar = tqdm(disable=not progress)
+    for osm_type, versions, add in [('node', history.nodes(), 'add_node'), ('way', history.ways(), 'add_way'),
+                                    ('relation', history.relations(), 'add_relation')]:
+        for version in versions:
+            for writer in writers:
+                getattr(writer, add)(version)
+            counts[osm_type] += 1
+            progress_bar.update()
+    progress_bar.close()
+    for writer in writers:
+        writer.close()
+
+    if changeset_filename is not None:
+        counts['changesets'] = write_changesets(history.changesets, changeset_filename)
+    return counts
+
+
+
+
+
+### Main
+
+if __name__ == '__main__':
+
+    # ~ 370,000 feature versions (about the size of a small town history extract)
+    print(generate_history(['synthetic.osh', 'synthetic.osh.pbf'], 'synthetic-changesets.osm.bz2',
+                           nb_nodes=100000, nb_ways=20000, nb_relations=1000, versions_per_feature=3, geometry_edit_share=0.5))
@@ -34,24 +34,131 @@ For more information, please see my 'internship_report'!
 
 from tqdm import tqdm   # for displaying a progress bar on loops
 import os
+from collections import OrderedDict   # for the LRU cache of 'osm_versions' (least recently used entries first)
+from multiprocessing import Pool    # for the parallel mode (one process and one database connection per worker)
 
 import psycopg2     # PostgreSQL driver for Python support
+from psycopg2 import sql    # for generating dynamically SQL queries (for choosing dynamically a table name)
 import pandas as pd
 import numpy as np
 
+from geometry_batch_engine import batch_nb_geometry_modification    # set-based engine (see 'geometry_batch_engine.py')
+from sql_geometry_engine import sql_nb_geometry_modification, recreated_nodes_relations    # in-database engine (see 'sql_geometry_engine.py')
+from sequence_encoder import batch_sequence_modifications, parse_hstore, TAG_ENRICHMENT, TAG_SUPPRESSION, TAG_MODIFICATION    # full sequences (see 'sequence_encoder.py')
+from node_index import NodeCoordinateIndex    # versioned node coordinates (see 'node_index.py')
+from geometry_fingerprint import GeometryFingerprints, build_geometry_fingerprints, UNDECIDED    # way fingerprints (see 'geometry_fingerprint.py')
+from geometry_magnitude import batch_modification_magnitudes    # how much the geometries changed (see 'geometry_magnitude.py')
+from history_store import HistoryStore    # memory-mapped alternative to the history table (see 'history_store.py')
+from metrics import metrics    # query counts and latencies, resolver time, recursion depth (see 'metrics.py')
+
+
+
+### Global variables
+
+# Optional in-memory index of the node versions: when set (see 'MAIN'), the referenced nodes of the ways
+# are resolved from it in 'geometry_modification' instead of being queried one by one
+node_index = None
+
+# Optional fingerprints of the way versions (see 'geometry_fingerprint.py' and 'MAIN'): when set, two way versions
+# are compared by their fingerprints in 'geometry_modification', their nodes being only resolved if undecided
+geometry_fingerprints = None
+
+# Optional cache of 'osm_versions' results (see 'VersionsCache' and 'MAIN'): nodes shared by several
+# buildings are then queried only once
+versions_cache = None
+
+# Optional local history store (see 'history_store.py' and 'MAIN'): when set, the versions are read from
+# its memory-mapped column files instead of the PostgreSQL history table
+history_store = None
+
+OSM_TYPES = ('node', 'way', 'relation')
+
+# Persistent store of the results of 'get_geometry_modification' (see 'incremental' mode)
+RESULTS_TABLENAME = 'nb_geometry_modification_results'
+# State of the history table at the last incremental run (see 'history_state'), and progress of its imports
+# (see 'history_to_pgsql_enhanced.py')
+HISTORY_STATE_TABLENAME = 'nb_geometry_modification_history_state'
+CHECKPOINT_TABLENAME = 'history_import_checkpoints'
+
+# Relation version pairs being compared by 'geometry_modification' (primary keys of both versions), for detecting cyclic relations
+relations_in_progress = set()
+
+# Memoized results of 'geometry_modification' for the way/relation members of relations (primary keys of both
+# member versions -> result): member ways shared by several relations are compared only once
+member_modifications = {}
+MAX_MEMBER_MODIFICATIONS = 1000000
+
 
 
 ### Functions
 
 
-def osm_versions(osm_id):
+class VersionsCache:
+    """
+    LRU cache of 'osm_versions' results, bounded by a memory budget (in bytes):
+    when the budget is exceeded, the least recently used features are evicted first
     """
-    Returns all the versions of a OSM feature based on its id
+    def __init__(self, max_bytes=256 * 1024 ** 2, prefetch=True):
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch # prefetching all the members of a way/relation in a single query
+        self.entries = OrderedDict() # (osm_type, osm_id) -> (DataFrame, size in bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetched = 0
+        self.queries = 0
+        
+    def get(self, key):
+        # returns the cached versions (None if not cached), and marks them as recently used
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+    
+    def put(self, key, versions):
+        size = int(versions.memory_usage(index=True, deep=True).sum())
+        if size > self.max_bytes:
+            return # too big to be cached at all
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        self.entries[key] = (versions, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            evicted_versions, evicted_size = self.entries.popitem(last=False)[1]
+            self.nbytes -= evicted_size
+            self.evictions += 1
+    
+    def stats(self):
+        # hit/miss/eviction counters, for tuning the memory budget
+        nb_lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / nb_lookups, 3) if nb_lookups > 0 else None,
+                'evictions': self.evictions,
+                'prefetched': self.prefetched,
+                'queries': self.queries,
+                'entries': len(self.entries),
+                'memory_mb': round(self.nbytes / 1024 ** 2, 1)}
+
+
+
+@metrics.timed('osm_versions_query')
+def query_versions(osm_id, osm_type=None):
+    """
+    Queries all the versions of a OSM feature based on its id and type (no cache);
+    both queries below are answered by the (osm_type, osm_id, version) index of the history table
+    (or read from the local history store, if any)
 
     Parameters
     ----------
     osm_id : int
         OSM FEATURE ID.
+    osm_type : string, optional
+        OSM FEATURE TYPE ('node', 'way' or 'relation'; None for all the features sharing the id).
 
     Returns
     -------
@@ -59,24 +166,123 @@ def osm_versions(osm_id):
         SQL QUERY RESULT.
 
     """
-    cur.execute("SELECT * FROM history WHERE osm_id = %s ORDER BY version;", (osm_id,))
-    return pd.DataFrame(cur.fetchall(), columns=['id',
-                                                 'osm_id',
-                                                 'osm_type',
-                                                 'version',
-                                                 'timestamp',
-                                                 'uid',
-                                                 'user',
-                                                 'changeset_id',
-                                                 'visible',
-                                                 'lat',
-                                                 'lon',
-                                                 'members_refs',
-                                                 'other_tags'])
+    if history_store is not None:
+        return history_store.versions(osm_id, osm_type)
+    
+    if osm_type is None:
+        # ties (same id and version for different OSM types) in import order
+        cur.execute("SELECT * FROM history WHERE osm_type IN ('node', 'way', 'relation') AND osm_id = %s ORDER BY version, id;", (osm_id,))
+    else:
+        cur.execute("SELECT * FROM history WHERE osm_type = %s AND osm_id = %s ORDER BY version, id;", (osm_type, osm_id))
+    return pd.DataFrame(cur.fetchall(), columns=[column.name for column in cur.description])
+
+
+
+def prefetch_versions(osm_ids, osm_types):
+    """
+    Loads into the cache, in a single query per OSM type, the versions of all the input features not cached yet
+    (e.g. all the nodes of a way)
 
+    Parameters
+    ----------
+    osm_ids : int list
+        OSM FEATURE IDS.
+    osm_types : string list
+        OSM FEATURE TYPES (None for a lookup by id only).
 
+    Returns
+    -------
+    None.
 
+    """
+    missing_keys = {(osm_type, int(osm_id)) for osm_id, osm_type in zip(osm_ids, osm_types)
+                    if (osm_type, osm_id) not in versions_cache.entries}
+    
+    if history_store is not None:
+        # no query to group: the versions are read from the memory-mapped store
+        for osm_type, osm_id in missing_keys:
+            versions_cache.put((osm_type, osm_id), history_store.versions(osm_id, osm_type))
+            versions_cache.prefetched += 1
+        return
+    
+    for osm_type in OSM_TYPES + (None,):
+        missing_ids = [osm_id for key_type, osm_id in missing_keys if key_type == osm_type]
+        if len(missing_ids) == 0:
+            continue
+        
+        if osm_type is None:
+            cur.execute("SELECT * FROM history WHERE osm_type IN ('node', 'way', 'relation') AND osm_id = ANY(%s) ORDER BY osm_id, version, id;", (missing_ids,))
+        else:
+            cur.execute("SELECT * FROM history WHERE osm_type = %s AND osm_id = ANY(%s) ORDER BY osm_id, version, id;", (osm_type, missing_ids))
+        versions_cache.queries += 1
+        columns = [column.name for column in cur.description]
+        
+        rows_per_id = {osm_id: [] for osm_id in missing_ids}
+        for row in cur.fetchall():
+            rows_per_id[row[1]].append(row)
+        
+        # one DataFrame per feature, built exactly as in 'query_versions' (features without versions included)
+        for osm_id, rows in rows_per_id.items():
+            versions_cache.put((osm_type, osm_id), pd.DataFrame(rows, columns=columns))
+            versions_cache.prefetched += 1
+
+
+
+def osm_versions(osm_id, osm_type=None):
+    """
+    Returns all the versions of a OSM feature based on its id and type
+    (from the cache when 'versions_cache' is set)
 
+    Parameters
+    ----------
+    osm_id : int
+        OSM FEATURE ID.
+    osm_type : string, optional
+        OSM FEATURE TYPE ('node', 'way' or 'relation'; None for all the features sharing the id).
+
+    Returns
+    -------
+    pandas DataFrame
+        SQL QUERY RESULT.
+
+    """
+    if versions_cache is None:
+        return query_versions(osm_id, osm_type)
+    
+    versions = versions_cache.get((osm_type, osm_id))
+    if versions is None:
+        versions = query_versions(osm_id, osm_type)
+        versions_cache.queries += 1
+        versions_cache.put((osm_type, osm_id), versions)
+    return versions
+
+
+
+def members_types(t):
+    """
+    returns the OSM types of the referenced members of a relation version
+    (None for each member when the history table does not record them, i.e. lookup by id only)
+
+    Parameters
+    ----------
+    t : pandas Series
+        RELATION VERSION.
+
+    Returns
+    -------
+    list
+        ONE OSM TYPE (OR None) PER REFERENCED MEMBER.
+
+    """
+    types = t.get('members_types')
+    if isinstance(types, list):
+        return types
+    return [None] * len(t['members_refs'])
+
+
+
+
+@metrics.timed('resolver')
 def geometry_references_resolver(member_versions, feature_timestamp):
     """
     When resolving references for accessing ways and relations geometries,
@@ -103,10 +309,12 @@ def geometry_references_resolver(member_versions, feature_timestamp):
     """
     
     # Calculating time difference
-    member_versions['time_difference'] = member_versions['timestamp'] - feature_timestamp
+    # (N.B.: not stored as a new column, 'member_versions' may be shared through the cache)
+    time_difference = member_versions['timestamp'] - feature_timestamp
 
     # Filtering versions older than 'feature_timestamp'
-    filtered_df = member_versions[member_versions['timestamp'] <= feature_timestamp]
+    older_versions = member_versions['timestamp'] <= feature_timestamp
+    filtered_df = member_versions[older_versions]
     
     n, m = filtered_df.shape
     if n == 0:
@@ -116,8 +324,8 @@ def geometry_references_resolver(member_versions, feature_timestamp):
         return filtered_df
     
     # Find the version with minimal time difference from the filtered DataFrame
-    min_time_difference_index = filtered_df['time_difference'].idxmax() # relative time!
-    return member_versions.iloc[min_time_difference_index]
+    min_time_difference_index = time_difference[older_versions].idxmax() # relative time!
+    return member_versions.loc[min_time_difference_index] # 'idxmax' returns an index label, not a position
 
 
 
@@ -128,6 +336,13 @@ def geometry_references_resolver(member_versions, feature_timestamp):
 
 # Geometry modification
 
+class RelationCycleError(Exception):
+    """
+    raised by 'geometry_modification' when a relation leads back to itself through its members
+    (the comparison would never end): the feature gets the error code 2 (see 'sequence_modifications')
+    """
+
+@metrics.track_depth('geometry_modification')
 def geometry_modification(t1,t2,osm_type):
     """
     [RECURSIVE FUNCTION]
@@ -181,12 +396,31 @@ def geometry_modification(t1,t2,osm_type):
     
 
     if osm_type == 'way':
+        if geometry_fingerprints is not None:
+            # One hash comparison, when both versions have a fingerprint
+            fingerprint_modification = geometry_fingerprints.way_modification(t1, t2)
+            if fingerprint_modification != UNDECIDED:
+                metrics.count('way_fingerprint_hits')
+                return fingerprint_modification
+        
+        if node_index is not None:
+            # A version without timestamp cannot be placed in the node histories: error, as in the loop below
+            if pd.isnull(t1_timestamp) or pd.isnull(t2_timestamp):
+                return 2
+            # All the referenced nodes resolved at once from the node index (same rules as below)
+            return node_index.way_modification(t1_members_refs, int(t1_timestamp.timestamp()),
+                                               t2_members_refs, int(t2_timestamp.timestamp()))
+        
+        if versions_cache is not None and versions_cache.prefetch:
+            # All the referenced nodes of both versions fetched at once
+            prefetch_versions(t1_members_refs + t2_members_refs, ['node'] * 2 * n)
+        
         # Iterating over referenced nodes
         for i in range(n):
             
             # Referenced nodes from ways may also have several versions needed to be taken into account
-            t1_i_node_versions = osm_versions(t1_members_refs[i])
-            t2_i_node_versions = osm_versions(t2_members_refs[i])
+            t1_i_node_versions = osm_versions(t1_members_refs[i], 'node')
+            t2_i_node_versions = osm_versions(t2_members_refs[i], 'node')
             
             # If the referenced node doesn't exist in our database
             #   -> cut during the geographical extraction of Otaniemi: EDGE EFFECT error
@@ -209,52 +443,120 @@ def geometry_modification(t1,t2,osm_type):
         return None
     
     else: # if osm_type == 'relation':
-        # Iterating over referenced nodes/ways/relations
-        for i in range(n):
-            
-            # Referenced members from relations may also have several versions needed to be taken into account
-            t1_i_member_versions = osm_versions(t1_members_refs[i])
-            t2_i_member_versions = osm_versions(t2_members_refs[i])
-            
-            # If the referenced member doesn't exist in our database
-            #   -> cut during the geographical extraction of Otaniemi: EDGE EFFECT error
-            if t1_i_member_versions.shape[0] == 0 or t2_i_member_versions.shape[0] == 0:
-                return 2
-            
-            # Selecting the right version of the referenced member based on timestamps
-            t1_i_member = geometry_references_resolver(t1_i_member_versions, t1_timestamp)
-            t2_i_member = geometry_references_resolver(t2_i_member_versions, t2_timestamp)
-            
-            
-            if t1_i_member.shape[0] == 0 or t2_i_member.shape[0] == 0:
-                # if there has been an error (see 'geometry_references_resolver' inline comments)
-                return 2
-            
-            
-            # Comparing ways or relations geometry
-            
-            t1_i_member_type = t1_i_member['osm_type']
-            t2_i_member_type = t2_i_member['osm_type']
-            
-                # if the feature types are different between the compared members, there has been a modification!
-            if t1_i_member_type != t2_i_member_type:
-                return 1
-            
-            if geometry_modification(t1_i_member, t2_i_member, t1_i_member_type) != None:
-                return 1
-        return None
+        t1_members_types = members_types(t1)
+        t2_members_types = members_types(t2)
+        
+        if versions_cache is not None and versions_cache.prefetch:
+            # All the referenced members of both versions fetched at once
+            prefetch_versions(t1_members_refs + t2_members_refs, t1_members_types + t2_members_types)
+        
+        # If this pair of relation versions is already being compared, the relation leads back to itself
+        relation_pair = (t1['id'], t2['id'])
+        if relation_pair in relations_in_progress:
+            raise RelationCycleError("relation " + str(t1['osm_id']) + " leads back to itself through its members")
+        relations_in_progress.add(relation_pair)
+        
+        try:
+            # Iterating over referenced nodes/ways/relations
+            for i in range(n):
+                
+                # Referenced members from relations may also have several versions needed to be taken into account
+                t1_i_member_versions = osm_versions(t1_members_refs[i], t1_members_types[i])
+                t2_i_member_versions = osm_versions(t2_members_refs[i], t2_members_types[i])
+                
+                # If the referenced member doesn't exist in our database
+                #   -> cut during the geographical extraction of Otaniemi: EDGE EFFECT error
+                if t1_i_member_versions.shape[0] == 0 or t2_i_member_versions.shape[0] == 0:
+                    return 2
+                
+                # Selecting the right version of the referenced member based on timestamps
+                t1_i_member = geometry_references_resolver(t1_i_member_versions, t1_timestamp)
+                t2_i_member = geometry_references_resolver(t2_i_member_versions, t2_timestamp)
+                
+                
+                if t1_i_member.shape[0] == 0 or t2_i_member.shape[0] == 0:
+                    # if there has been an error (see 'geometry_references_resolver' inline comments)
+                    return 2
+                
+                
+                # Comparing ways or relations geometry
+                
+                t1_i_member_type = t1_i_member['osm_type']
+                t2_i_member_type = t2_i_member['osm_type']
+                
+                    # if the feature types are different between the compared members, there has been a modification!
+                if t1_i_member_type != t2_i_member_type:
+                    return 1
+                
+                if t1_i_member_type == 'node':
+                    memberModification = geometry_modification(t1_i_member, t2_i_member, 'node')
+                else:
+                    # the result only depends on both member versions: memoized (see 'member_modifications')
+                    member_pair = (t1_i_member['id'], t2_i_member['id'])
+                    if member_pair in member_modifications:
+                        memberModification = member_modifications[member_pair]
+                    else:
+                        memberModification = geometry_modification(t1_i_member, t2_i_member, t1_i_member_type)
+                        if len(member_modifications) >= MAX_MEMBER_MODIFICATIONS:
+                            member_modifications.clear()
+                        member_modifications[member_pair] = memberModification
+                
+                if memberModification != None:
+                    return 1
+            return None
+        
+        finally:
+            relations_in_progress.discard(relation_pair)
     
 
 # Semantic modifications (not our case study, to be filled if needed!)
 
+# N.B.: the tags of a deleted version ('visible' = false) are not compared, as erased geometries in 'geometry_modification'
+
 def tag_enrichment(t1,t2):
-    # same etc.
+    """
+    returns TAG_ENRICHMENT (3) if keys have been added to the tags, None if not
+
+    Parameters
+    ----------
+    t1 : pandas Series
+        PREVIOUS VERSION.
+    t2 : pandas Series
+        CURRENT VERSION.
+
+    Returns
+    -------
+    int
+        see main description.
+
+    """
+    if t2.get('visible', True) == False:
+        return None
+    t1_tags, t2_tags = parse_hstore(t1['other_tags']), parse_hstore(t2['other_tags'])
+    if any(key not in t1_tags for key in t2_tags):
+        return TAG_ENRICHMENT
     return None
 
 def tag_suppression(t1,t2):
+    """
+    returns TAG_SUPPRESSION (4) if keys have been removed from the tags, None if not (see 'tag_enrichment')
+    """
+    if t2.get('visible', True) == False:
+        return None
+    t1_tags, t2_tags = parse_hstore(t1['other_tags']), parse_hstore(t2['other_tags'])
+    if any(key not in t2_tags for key in t1_tags):
+        return TAG_SUPPRESSION
     return None
 
 def tag_modification(t1,t2):
+    """
+    returns TAG_MODIFICATION (5) if the value of a key has changed, None if not (see 'tag_enrichment')
+    """
+    if t2.get('visible', True) == False:
+        return None
+    t1_tags, t2_tags = parse_hstore(t1['other_tags']), parse_hstore(t2['other_tags'])
+    if any(key in t2_tags and t2_tags[key] != value for key, value in t1_tags.items()):
+        return TAG_MODIFICATION
     return None
 
 
@@ -268,14 +570,20 @@ for geometry-focused studies, but can be developed further on to fit your needs.
 
 """
 
-def sequence_modifications(osm_id):
+def sequence_modifications(osm_id, osm_type=None, tags=True):
     """
     returns the encoded sequence of modifications for one OSM feature based on its id
+    (per version pair: geometry code, then TAG_ENRICHMENT, TAG_SUPPRESSION and TAG_MODIFICATION codes, if any;
+     see 'batch_sequence_modifications' in 'sequence_encoder.py' for many features at once)
 
     Parameters
     ----------
     osm_id : int
         OSM FEATURE ID.
+    osm_type : string, optional
+        OSM FEATURE TYPE (None for a lookup by id only).
+    tags : boolean
+        ALSO ENCODE THE TAG MODIFICATIONS (False: GEOMETRY MODIFICATIONS ONLY).
 
     Returns
     -------
@@ -285,7 +593,7 @@ def sequence_modifications(osm_id):
     """
     
     # Retrieving all the feature versions
-    versions = osm_versions(osm_id)
+    versions = osm_versions(osm_id, osm_type)
     n, m = versions.shape # n = number of versions, m = number of fields
     
     if n < 1:
@@ -301,17 +609,20 @@ def sequence_modifications(osm_id):
     
     # Iterating over versions (Pairwise similarity comparing)
     for i in range(n-1):
-        geometryModification = geometry_modification(versions.iloc[i], versions.iloc[i+1], feature_type)
+        t1, t2 = versions.iloc[i], versions.iloc[i+1]
+        try:
+            geometryModification = geometry_modification(t1, t2, feature_type)
+        except RelationCycleError:
+            # cyclic relations: error
+            geometryModification = 2
         if geometryModification != None:
             seq.append(geometryModification)
-            
-        # tag_enrichment =
-        # if tag_enrichment is not None:
-            # seq.append(tag_enrichment(versions.iloc[i],versions.iloc[i+1]))
-            
-        # tag_suppression =
-        # tag_modification =
-   
+        
+        if tags:
+            for tagModification in (tag_enrichment(t1, t2), tag_suppression(t1, t2), tag_modification(t1, t2)):
+                if tagModification != None:
+                    seq.append(tagModification)
+        
         # .
         # .
         # . and so on...
@@ -321,7 +632,7 @@ def sequence_modifications(osm_id):
 
 
 
-def nb_geometry_modification(osm_id):
+def nb_geometry_modification(osm_id, osm_type=None):
     """
     based on the current state of the 'sequence_modifications' function,
     nb_geometry_modification returns the number of geometry modifications
@@ -331,6 +642,8 @@ def nb_geometry_modification(osm_id):
     ----------
     osm_id : int
         OSM FEATURE ID.
+    osm_type : string, optional
+        OSM FEATURE TYPE (None for a lookup by id only).
 
     Returns
     -------
@@ -338,43 +651,623 @@ def nb_geometry_modification(osm_id):
         NUMBER OF GEOMETRY MODIFICATIONS FOR THE INPUT FEATURE.
 
     """
-    seq = sequence_modifications(osm_id)
+    seq = sequence_modifications(osm_id, osm_type, tags=False)
     if 2 in seq:
         return None
     return len(seq)
 
 
 
-def get_geometry_modification():
+def compute_nb_geometry_modification(osm_ids, osm_types, batch=False, chunk_size=20000, progress=True):
+    """
+    returns the number of geometry modifications of each input feature (None in case of error)
+
+    Parameters
+    ----------
+    osm_ids : int list
+        OSM FEATURE IDS.
+    osm_types : string list
+        OSM FEATURE TYPES.
+    batch : boolean
+        USE THE BATCH ENGINE (SEE 'get_geometry_modification').
+    chunk_size : int
+        NUMBER OF FEATURES PROCESSED AT ONCE BY THE BATCH ENGINE.
+    progress : boolean
+        DISPLAY A PROGRESS BAR.
+
+    Returns
+    -------
+    list
+        NUMBER OF GEOMETRY MODIFICATIONS PER FEATURE (int or None), IN THE INPUT ORDER.
+
+    """
+    # (the history may have changed since the last call, e.g. in incremental mode)
+    member_modifications.clear()
+    
+    if batch:
+        source = history_store if history_store is not None else cur
+        return batch_nb_geometry_modification(source, osm_ids, 'history', chunk_size, node_index, osm_types, progress, geometry_fingerprints)
+    
+    nbGeometryModification = []
+    for osm_id, osm_type in tqdm(zip(osm_ids, osm_types), total=len(osm_ids), disable=not progress):
+        nbGeometryModification.append(nb_geometry_modification(osm_id, osm_type))
+    return nbGeometryModification
+
+
+
+def check_sql_engine(osm_ids=None, osm_types=None, progress=True):
+    """
+    compares the in-database engine ('sql_geometry_engine.py') with 'nb_geometry_modification', by default on the
+    relations whose member ways reference deleted then recreated nodes (see 'recreated_nodes_relations')
+
+    Parameters
+    ----------
+    osm_ids : int list, optional
+        OSM FEATURE IDS (None: THE RELATIONS OF 'recreated_nodes_relations').
+    osm_types : string list, optional
+        OSM FEATURE TYPES.
+    progress : boolean
+        DISPLAY A PROGRESS BAR.
+
+    Returns
+    -------
+    df : pandas DataFrame
+        osm_id, osm_type, sql, loop: THE FEATURES WHOSE RESULTS DIFFER (EMPTY IF BOTH ENGINES AGREE).
+
+    """
+    if osm_ids is None:
+        osm_ids = recreated_nodes_relations(cur)
+        osm_types = ['relation'] * len(osm_ids)
+    
+    df = pd.DataFrame({'osm_id': list(osm_ids), 'osm_type': list(osm_types)})
+    df['sql'] = sql_nb_geometry_modification(cur, df.osm_id, df.osm_type)
+    conn.commit()
+    df['loop'] = compute_nb_geometry_modification(df.osm_id, df.osm_type, progress=progress)
+    
+    # (None on both sides: same error)
+    different = df.apply(lambda row: row['sql'] != row['loop'] and not (pd.isnull(row['sql']) and pd.isnull(row['loop'])), axis=1)
+    return df[different].reset_index(drop=True)
+
+
+
+def compute_sequence_modifications(osm_ids, osm_types, chunk_size=20000, progress=True):
+    """
+    returns the full encoded sequences of modifications (tag modifications included) of the input features,
+    computed by chunks with the batch engine (see 'sequence_encoder.py')
+
+    Parameters
+    ----------
+    osm_ids : int list
+        OSM FEATURE IDS.
+    osm_types : string list
+        OSM FEATURE TYPES.
+    chunk_size : int
+        NUMBER OF FEATURES PROCESSED AT ONCE.
+    progress : boolean
+        DISPLAY A PROGRESS BAR.
+
+    Returns
+    -------
+    (numpy array, numpy array)
+        OFFSETS AND CODES: THE SEQUENCE OF THE FEATURE j IS codes[offsets[j]:offsets[j + 1]]
+        (SAME CODES AS 'sequence_modifications').
+
+    """
+    source = history_store if history_store is not None else cur
+    return batch_sequence_modifications(source, osm_ids, osm_types, 'history', chunk_size, node_index, progress, geometry_fingerprints)
+
+
+
+def compute_modification_magnitudes(osm_ids, osm_types, thresholds=None, modified_only=True, chunk_size=20000, progress=True):
+    """
+    returns the magnitudes of the geometry modifications of the input features (Hausdorff distance, area delta,
+    centroid shift, significance), computed by chunks with vectorized Shapely functions (see 'geometry_magnitude.py')
+
+    Parameters
+    ----------
+    osm_ids : int list
+        OSM FEATURE IDS.
+    osm_types : string list
+        OSM FEATURE TYPES.
+    thresholds : dict, optional
+        TOLERANCE THRESHOLDS, IN METRES AND SQUARE METRES (DEFAULT: 'DEFAULT_THRESHOLDS' OF 'geometry_magnitude.py').
+    modified_only : boolean
+        ONLY THE VERSION PAIRS WITH A GEOMETRY MODIFICATION.
+    chunk_size : int
+        NUMBER OF FEATURES PROCESSED AT ONCE.
+    progress : boolean
+        DISPLAY A PROGRESS BAR.
+
+    Returns
+    -------
+    pandas DataFrame
+        ONE LINE PER VERSION PAIR: osm_id, osm_type, version1, version2, geometry_modification,
+        hausdorff_distance, area_delta, centroid_shift, significant.
+
+    """
+    source = history_store if history_store is not None else cur
+    return batch_modification_magnitudes(source, osm_ids, osm_types, 'history', chunk_size, node_index, thresholds, modified_only,
+                                         progress, geometry_fingerprints)
+
+
+
+def init_worker(connection_parameters, cache_parameters=None, node_index_directory=None, fingerprints_directory=None):
+    """
+    [PARALLEL MODE] initialises a worker process with its own PostgreSQL connection
+    (module-level 'conn' and 'cur', as in the 'MAIN'), its own 'osm_versions' cache, node index and way fingerprints
+
+    Parameters
+    ----------
+    connection_parameters : dict
+        psycopg2.connect KEYWORD ARGUMENTS.
+    cache_parameters : dict, optional
+        VersionsCache KEYWORD ARGUMENTS (None: NO CACHE).
+    node_index_directory : string, optional
+        DIRECTORY OF A SAVED NODE INDEX, LOADED MEMORY-MAPPED (SHARED BY THE WORKERS THROUGH THE PAGE CACHE).
+    fingerprints_directory : string, optional
+        DIRECTORY OF SAVED WAY FINGERPRINTS, LOADED MEMORY-MAPPED AS WELL.
+
+    Returns
+    -------
+    None.
+
+    """
+    global conn, cur, versions_cache, node_index, geometry_fingerprints
+    conn = psycopg2.connect(**connection_parameters)
+    cur = conn.cursor()
+    versions_cache = VersionsCache(**cache_parameters) if cache_parameters is not None else None
+    if node_index_directory is not None:
+        node_index = NodeCoordinateIndex.load(node_index_directory)
+    if fingerprints_directory is not None:
+        geometry_fingerprints = GeometryFingerprints.load(fingerprints_directory)
+
+
+
+def compute_task(task):
+    """
+    [PARALLEL MODE] computes the number of geometry modifications of a chunk of features, in a worker
+
+    Parameters
+    ----------
+    task : tuple
+        (POSITION OF THE CHUNK IN THE INPUT, OSM IDS, OSM TYPES, batch, chunk_size).
+
+    Returns
+    -------
+    tuple
+        (POSITION OF THE CHUNK IN THE INPUT, NUMBER OF GEOMETRY MODIFICATIONS PER FEATURE, METRICS OF THE TASK).
+
+    """
+    position, osm_ids, osm_types, batch, chunk_size = task
+    metrics.reset() # metrics of this task only, merged by the main process (see 'metrics.py')
+    return position, compute_nb_geometry_modification(osm_ids, osm_types, batch, chunk_size, progress=False), metrics.collect()
+
+
+
+def parallel_nb_geometry_modification(osm_ids, osm_types, connection_parameters, nb_workers=None, task_size=5000,
+                                      batch=False, chunk_size=20000, node_index_directory=None, fingerprints_directory=None):
+    """
+    parallel version of 'compute_nb_geometry_modification': the features are split into chunks of 'task_size'
+    features, processed by a pool of 'nb_workers' processes, each with its own database connection.
+    The chunks are completed in any order but merged back in the input order (same results as the sequential mode)
+
+    Parameters
+    ----------
+    osm_ids : int list
+        OSM FEATURE IDS.
+    osm_types : string list
+        OSM FEATURE TYPES.
+    connection_parameters : dict
+        psycopg2.connect KEYWORD ARGUMENTS, USED BY EVERY WORKER.
+    nb_workers : int, optional
+        NUMBER OF WORKER PROCESSES (None: NUMBER OF CPUS).
+    task_size : int
+        NUMBER OF FEATURES PER TASK.
+    batch : boolean
+        USE THE BATCH ENGINE IN THE WORKERS.
+    chunk_size : int
+        NUMBER OF FEATURES PROCESSED AT ONCE BY THE BATCH ENGINE (WITHIN A TASK).
+    node_index_directory : string, optional
+        DIRECTORY OF A SAVED NODE INDEX (SEE 'NodeCoordinateIndex.save'), LOADED BY EVERY WORKER.
+    fingerprints_directory : string, optional
+        DIRECTORY OF SAVED WAY FINGERPRINTS (SEE 'GeometryFingerprints.save'), LOADED BY EVERY WORKER.
+
+    Returns
+    -------
+    list
+        NUMBER OF GEOMETRY MODIFICATIONS PER FEATURE (int or None), IN THE INPUT ORDER.
+
+    """
+    if nb_workers is None:
+        nb_workers = os.cpu_count()
+    
+    osm_ids, osm_types = [int(osm_id) for osm_id in osm_ids], list(osm_types)
+    tasks = [(position, osm_ids[position:position + task_size], osm_types[position:position + task_size], batch, chunk_size)
+             for position in range(0, len(osm_ids), task_size)]
+    
+    # Each worker gets an empty cache with the same settings as the one of the main process, if any
+    cache_parameters = None
+    if versions_cache is not None:
+        cache_parameters = {'max_bytes': versions_cache.max_bytes, 'prefetch': versions_cache.prefetch}
+    
+    nbGeometryModification = [None] * len(osm_ids)
+    with Pool(nb_workers, initializer=init_worker, initargs=(connection_parameters, cache_parameters, node_index_directory, fingerprints_directory)) as pool:
+        for position, results, task_metrics in tqdm(pool.imap_unordered(compute_task, tasks), total=len(tasks)):
+            nbGeometryModification[position:position + len(results)] = results
+            metrics.merge(task_metrics)
+    return nbGeometryModification
+
+
+
+def create_results_table():
+    """
+    creates the persistent store of the results, if it does not exist yet: one line per feature, with the
+    highest version and timestamp of the feature in the history when its result was computed, and the
+    state of its referenced members (see 'members_summary'); and the table recording the state of the
+    history table at the last run (see 'history_state')
+
+    Returns
+    -------
+    None.
+
+    """
+    cur.execute(sql.SQL("""CREATE TABLE IF NOT EXISTS public.{}
+(
+    osm_type text,
+    osm_id bigint,
+    nb_geometry_modification integer,
+    max_version integer,
+    max_timestamp timestamp without time zone,
+    members_versions integer,
+    members_max_timestamp timestamp without time zone,
+    computed_at timestamp without time zone DEFAULT now(),
+    PRIMARY KEY (osm_type, osm_id)
+);""").format(sql.Identifier(RESULTS_TABLENAME)))
+    # (stores created before the members state: their features are computed again once)
+    cur.execute(sql.SQL("""ALTER TABLE public.{} ADD COLUMN IF NOT EXISTS members_versions integer,
+ADD COLUMN IF NOT EXISTS members_max_timestamp timestamp without time zone;""").format(sql.Identifier(RESULTS_TABLENAME)))
+    
+    cur.execute(sql.SQL("""CREATE TABLE IF NOT EXISTS public.{}
+(
+    tablename text,
+    history_oid bigint,
+    history_filenode bigint,
+    last_import timestamp without time zone,
+    updated_at timestamp without time zone DEFAULT now(),
+    PRIMARY KEY (tablename)
+);""").format(sql.Identifier(HISTORY_STATE_TABLENAME)))
+    conn.commit()
+
+
+
+def history_state(pgsql_tablename='history'):
+    """
+    returns the state of the history table: its oid and file node (both changed when the table is dropped and
+    imported again, or truncated, but not by the diff updates), and the date of its last import checkpoint
+    (see 'history_import_checkpoints' in 'history_to_pgsql_enhanced.py')
+
+    Parameters
+    ----------
+    pgsql_tablename : string
+        HISTORY TABLE NAME.
+
+    Returns
+    -------
+    tuple
+        (history_oid, history_filenode, last_import).
+
+    """
+    cur.execute("""SELECT c.oid::bigint, c.relfilenode::bigint FROM pg_class AS c JOIN pg_namespace AS n ON n.oid = c.relnamespace
+WHERE n.nspname = 'public' AND c.relname = %s;""", (pgsql_tablename,))
+    table = cur.fetchone() or (None, None)
+    
+    last_import = None
+    cur.execute("SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_schema = 'public' AND table_name = %s);",
+                (CHECKPOINT_TABLENAME,))
+    if cur.fetchone()[0]:
+        cur.execute(sql.SQL("SELECT MAX(updated_at) FROM public.{} WHERE tablename = %s;").format(sql.Identifier(CHECKPOINT_TABLENAME)),
+                    (pgsql_tablename,))
+        last_import = cur.fetchone()[0]
+    return tuple(table) + (last_import,)
+
+
+
+def history_summary(osm_ids, osm_types, pgsql_tablename='history'):
+    """
+    returns the highest version and timestamp of each input feature in the history table
+
+    Parameters
+    ----------
+    osm_ids : int list
+        OSM FEATURE IDS.
+    osm_types : string list
+        OSM FEATURE TYPES.
+    pgsql_tablename : string
+        HISTORY TABLE NAME.
+
+    Returns
+    -------
+    dict
+        (osm_type, osm_id) -> (max_version, max_timestamp), FOR THE FEATURES FOUND IN THE HISTORY.
+
+    """
+    cur.execute(sql.SQL("""SELECT h.osm_type, h.osm_id, MAX(h.version), MAX(h."timestamp") FROM {} AS h
+JOIN unnest(%s::text[], %s::bigint[]) AS f(osm_type, osm_id) ON h.osm_type = f.osm_type AND h.osm_id = f.osm_id
+GROUP BY h.osm_type, h.osm_id;""").format(sql.Identifier(pgsql_tablename)), (list(osm_types), [int(osm_id) for osm_id in osm_ids]))
+    return {(osm_type, osm_id): (max_version, max_timestamp) for osm_type, osm_id, max_version, max_timestamp in cur.fetchall()}
+
+
+
+def members_summary(osm_ids, osm_types, pgsql_tablename='history'):
+    """
+    returns the state of the referenced members of each input feature: number of versions and highest timestamp
+    of the members reached through 'members_refs' (nodes of the ways, members of the relations at any depth),
+    so that a feature whose nodes changed (e.g. after a full re-import of a newer extract) is not taken as up to date
+
+    Parameters
+    ----------
+    osm_ids : int list
+        OSM FEATURE IDS.
+    osm_types : string list
+        OSM FEATURE TYPES.
+    pgsql_tablename : string
+        HISTORY TABLE NAME.
+
+    Returns
+    -------
+    dict
+        (osm_type, osm_id) -> (members_versions, members_max_timestamp), FOR ALL THE INPUT FEATURES
+        ((0, None) WITHOUT ANY MEMBER).
+
+    """
+    osm_types, osm_ids = list(osm_types), [int(osm_id) for osm_id in osm_ids]
+    if not osm_ids:
+        return {}
+    history = sql.Identifier(pgsql_tablename)
+    
+    # Members reached from every feature, all versions included (type NULL: unknown, 'members_types' being missing
+    # from older history tables); UNION keeps each (feature, member) once, so that cyclic relations terminate
+    cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = 'members_types';", (pgsql_tablename,))
+    relation_members_types = sql.SQL("h.members_types") if cur.fetchone() else sql.SQL("NULL::text[]")
+    cur.execute(sql.SQL("""WITH RECURSIVE reached(root_type, root_id, osm_type, osm_id) AS (
+    SELECT f.osm_type, f.osm_id, f.osm_type, f.osm_id FROM unnest(%s::text[], %s::bigint[]) AS f(osm_type, osm_id)
+    UNION
+    SELECT r.root_type, r.root_id, m.member_type, m.member_id
+    FROM reached AS r
+    JOIN {history} AS h ON h.osm_id = r.osm_id AND h.osm_type <> 'node' AND (r.osm_type IS NULL OR h.osm_type = r.osm_type)
+    CROSS JOIN LATERAL unnest(h.members_refs, CASE WHEN h.osm_type = 'way' THEN array_fill('node'::text, ARRAY[cardinality(h.members_refs)])
+                                                   ELSE {members_types} END) AS m(member_id, member_type)
+    WHERE h.members_refs IS NOT NULL
+)
+SELECT r.root_type, r.root_id, COUNT(h.id), MAX(h."timestamp")
+FROM reached AS r
+LEFT JOIN {history} AS h ON h.osm_id = r.osm_id AND (r.osm_type IS NULL OR h.osm_type = r.osm_type)
+WHERE r.osm_type IS DISTINCT FROM r.root_type OR r.osm_id <> r.root_id
+GROUP BY r.root_type, r.root_id;""").format(history=history, members_types=relation_members_types), (osm_types, osm_ids))
+    members = {(osm_type, osm_id): (members_versions, members_max_timestamp)
+               for osm_type, osm_id, members_versions, members_max_timestamp in cur.fetchall()}
+    
+    # (features without members: no version reached)
+    return {key: members.get(key, (0, None)) for key in zip(osm_types, osm_ids)}
+
+
+
+def touched_dependents(osm_ids, osm_types, pgsql_tablename='history'):
+    """
+    returns the input features depending on features touched by the incremental updates of the history
+    ('<history table>_touched' table, see 'history_diff_updater' in 'history_to_pgsql_enhanced.py'):
+    ways referencing touched nodes, relations with touched (or depending) members, at any depth
+
+    Parameters
+    ----------
+    osm_ids : int list
+        OSM FEATURE IDS.
+    osm_types : string list
+        OSM FEATURE TYPES.
+    pgsql_tablename : string
+        HISTORY TABLE NAME.
+
+    Returns
+    -------
+    touched : set of (osm_type, osm_id)
+        TOUCHED FEATURES AND THEIR DEPENDENTS (INPUT FEATURES AND THEIR MEMBERS).
+    max_sequence : int or None
+        HIGHEST SEQUENCE NUMBER OF THE TOUCHED FEATURES (None IF NO UPDATE TO CONSIDER).
+
+    """
+    history, touched_table = sql.Identifier(pgsql_tablename), sql.Identifier(pgsql_tablename + '_touched')
+    cur.execute("SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_schema = 'public' AND table_name = %s);",
+                (pgsql_tablename + '_touched',))
+    if not cur.fetchone()[0]:
+        return set(), None
+    cur.execute(sql.SQL("SELECT osm_type, osm_id, sequence FROM public.{};").format(touched_table))
+    rows = cur.fetchall()
+    if not rows:
+        return set(), None
+    touched = {(osm_type, osm_id) for osm_type, osm_id, sequence in rows}
+    max_sequence = max(sequence for osm_type, osm_id, sequence in rows)
+    touched_nodes = [osm_id for osm_type, osm_id in touched if osm_type == 'node']
+    
+    # Members (at any depth) of the input relations, which may depend on touched features themselves
+    ways = {int(osm_id) for osm_id, osm_type in zip(osm_ids, osm_types) if osm_type == 'way'}
+    relation_members = {} # relation id -> set of (member type, member id), all versions included
+    to_expand = {int(osm_id) for osm_id, osm_type in zip(osm_ids, osm_types) if osm_type == 'relation'}
+    while to_expand:
+        cur.execute(sql.SQL("SELECT * FROM {} WHERE osm_type = 'relation' AND osm_id = ANY(%s);").format(history), (list(to_expand),))
+        columns = [column[0] for column in cur.description] # 'members_types' is missing from older history tables
+        for osm_id in to_expand:
+            relation_members[osm_id] = set()
+        for row in cur.fetchall():
+            version = dict(zip(columns, row))
+            osm_id, members_refs, members_types = version['osm_id'], version['members_refs'], version.get('members_types')
+            for i, member_id in enumerate(members_refs or []):
+                member_type = members_types[i] if members_types is not None else None
+                relation_members[osm_id].add((member_type, member_id))
+                if member_type in ('way', None):
+                    ways.add(member_id)
+        to_expand = {member_id for members in relation_members.values() for member_type, member_id in members
+                     if member_type in ('relation', None) and member_id not in relation_members}
+    
+    # Ways referencing touched nodes (in any of their versions)
+    if touched_nodes and ways:
+        cur.execute(sql.SQL("""SELECT DISTINCT osm_id FROM {} WHERE osm_type = 'way' AND osm_id = ANY(%s)
+AND members_refs && %s::bigint[];""").format(history), (list(ways), touched_nodes))
+        touched |= {('way', osm_id) for (osm_id,) in cur.fetchall()}
+    
+    # Relations with touched members, until no more relation is added (nested relations)
+    changed = True
+    while changed:
+        changed = False
+        touched_ids = {osm_id for osm_type, osm_id in touched} # for members of unknown type
+        for osm_id, members in relation_members.items():
+            if ('relation', osm_id) in touched:
+                continue
+            if any((member_type, member_id) in touched if member_type is not None else member_id in touched_ids
+                   for member_type, member_id in members):
+                touched.add(('relation', osm_id))
+                changed = True
+    
+    return touched, max_sequence
+
+
+
+def get_geometry_modification(batch=False, chunk_size=20000, out_filename="nls_buildings_multipolygons_nb_geometry_modification.csv",
+                              incremental=False, connection_parameters=None, nb_workers=None, task_size=5000, node_index_directory=None,
+                              in_database=False, fingerprints_directory=None, pgsql_tablename='history'):
     """
     saves locally and returns a pandas DataFrame containing one line per feature with its
     associated number of geometry modifications. 
 
+    Parameters
+    ----------
+    batch : boolean
+        If True, uses the batch engine ('geometry_batch_engine.py'): the versions of the features
+        and of their referenced nodes are loaded in a few set-based queries per chunk of features,
+        instead of two queries per referenced node (same results, much faster).
+    chunk_size : int
+        Number of features processed at once by the batch engine.
+    out_filename : string
+        Output filename: .csv, or .parquet for a columnar output (see 'get_geom_modif_ids.py').
+    incremental : boolean
+        If True, the results are also kept in the 'nb_geometry_modification_results' table, and only
+        the features that are new, whose history changed (highest version/timestamp, see 'history_summary'),
+        or which depend on features touched by the updates of the history (see 'touched_dependents') are
+        computed again. After a new import of the history table (see 'history_state'), the features whose
+        referenced members changed (see 'members_summary') are computed again too.
+    connection_parameters : dict, optional
+        If given (psycopg2.connect keyword arguments), the features are computed in parallel by a pool of
+        processes, each with its own database connection (see 'parallel_nb_geometry_modification').
+    nb_workers : int, optional
+        [PARALLEL MODE] Number of worker processes (None: number of CPUs).
+    task_size : int
+        [PARALLEL MODE] Number of features sent to a worker at once.
+    node_index_directory : string, optional
+        [PARALLEL MODE] Directory of a saved node index, loaded by every worker (see 'NodeCoordinateIndex.save').
+    in_database : boolean
+        If True, the whole computation runs inside PostgreSQL ('sql_geometry_engine.py'), the results
+        being also written to the 'nb_geometry_modification_sql' table.
+    fingerprints_directory : string, optional
+        [PARALLEL MODE] Directory of saved way fingerprints, loaded by every worker (see 'GeometryFingerprints.save').
+    pgsql_tablename : string
+        History table name, for the incremental mode and the in-database engine (the other engines
+        read the 'history' table, see 'osm_versions').
+
     Returns
     -------
     df : pandas DataFrame
         see main description.
 
     """
-    # Retrieving OSM feature ids from 'nls_buildings_multipolygons'
+    # Retrieving OSM feature ids from 'nls_buildings_multipolygons', with their types
+    # (ogr2ogr multipolygons: 'osm_id' comes from relations, 'osm_way_id' from closed ways)
     cur.execute("""SELECT * FROM
 
-(SELECT CAST(osm_id AS bigint) FROM nls_buildings_multipolygons
+(SELECT CAST(osm_id AS bigint), 'relation' AS osm_type FROM nls_buildings_multipolygons
 UNION
-SELECT CAST(osm_way_id AS bigint) FROM nls_buildings_multipolygons) AS temp
+SELECT CAST(osm_way_id AS bigint), 'way' AS osm_type FROM nls_buildings_multipolygons) AS temp
 
 WHERE temp.osm_id IS NOT NULL;""")
     
-    df = pd.DataFrame(cur.fetchall(), columns=['osm_id'])
+    df = pd.DataFrame(cur.fetchall(), columns=['osm_id', 'osm_type'])
     
-    nbGeometryModification = []
+    def compute(osm_ids, osm_types):
+        # in-database, sequential (module-level 'cur') or parallel mode (one connection per worker)
+        if in_database:
+            nbGeometryModification = sql_nb_geometry_modification(cur, osm_ids, osm_types, pgsql_tablename)
+            conn.commit()
+            return nbGeometryModification
+        if connection_parameters is None:
+            return compute_nb_geometry_modification(osm_ids, osm_types, batch, chunk_size)
+        return parallel_nb_geometry_modification(osm_ids, osm_types, connection_parameters, nb_workers, task_size,
+                                                 batch, chunk_size, node_index_directory, fingerprints_directory)
+    
+    if not incremental:
+        df['nb_geometry_modification'] = compute(df.osm_id, df.osm_type)
     
-    for osm_id in tqdm(df.osm_id):
-        nbGeometryModification.append(nb_geometry_modification(osm_id))
+    else:
+        create_results_table()
+        keys = list(zip(df.osm_type, df.osm_id.astype(int)))
+        
+        results_table = sql.Identifier(RESULTS_TABLENAME)
+        
+        # Features to compute: new ones, or whose history or referenced members changed since their last computation
+        summary = history_summary(df.osm_id, df.osm_type, pgsql_tablename)
+        cur.execute(sql.SQL("""SELECT r.osm_type, r.osm_id, r.max_version, r.max_timestamp, r.members_versions, r.members_max_timestamp
+FROM public.{} AS r
+JOIN unnest(%s::text[], %s::bigint[]) AS f(osm_type, osm_id) ON r.osm_type = f.osm_type AND r.osm_id = f.osm_id;""").format(results_table),
+                    (list(df.osm_type), [int(osm_id) for osm_id in df.osm_id]))
+        stored = {(row[0], row[1]): tuple(row[2:]) for row in cur.fetchall()}
+        touched, max_sequence = touched_dependents(df.osm_id, df.osm_type, pgsql_tablename)
+        
+        # Members state: of all the features after a new import of the history table (not seen by the '_touched' table),
+        # otherwise only of the new features and of the ones reached from the touched features (the others keep theirs)
+        state = history_state(pgsql_tablename)
+        cur.execute(sql.SQL("SELECT history_oid, history_filenode, last_import FROM public.{} WHERE tablename = %s;")
+                    .format(sql.Identifier(HISTORY_STATE_TABLENAME)), (pgsql_tablename,))
+        imported = cur.fetchone() != state
+        checked = keys if imported else [key for key in keys if key not in stored or key in touched]
+        members = members_summary([osm_id for osm_type, osm_id in checked], [osm_type for osm_type, osm_id in checked], pgsql_tablename)
+        summary = {key: value + (members[key] if key in members else stored[key][2:]) for key, value in summary.items()}
+        
+        to_compute = [key for key in keys if key not in stored or stored[key] != summary.get(key, (None,) * 4) or key in touched]
+        print("\n", len(to_compute), "features to compute out of", len(keys), "(the other results are up to date)\n")
+        
+        results = compute([osm_id for osm_type, osm_id in to_compute], [osm_type for osm_type, osm_id in to_compute])
+        
+        # Saving the new results, with the history state they were computed from
+        states = [summary.get(key, (None,) * 4) for key in to_compute]
+        cur.execute(sql.SQL("""INSERT INTO public.{} (osm_type, osm_id, nb_geometry_modification, max_version, max_timestamp,
+members_versions, members_max_timestamp, computed_at)
+SELECT *, now() FROM unnest(%s::text[], %s::bigint[], %s::integer[], %s::integer[], %s::timestamp[], %s::integer[], %s::timestamp[])
+ON CONFLICT (osm_type, osm_id) DO UPDATE SET nb_geometry_modification = EXCLUDED.nb_geometry_modification,
+max_version = EXCLUDED.max_version, max_timestamp = EXCLUDED.max_timestamp, members_versions = EXCLUDED.members_versions,
+members_max_timestamp = EXCLUDED.members_max_timestamp, computed_at = EXCLUDED.computed_at;""").format(results_table),
+                    ([osm_type for osm_type, osm_id in to_compute], [osm_id for osm_type, osm_id in to_compute], results,
+                     [state[0] for state in states], [state[1] for state in states], [state[2] for state in states], [state[3] for state in states]))
+        
+        # The updates of the history taken into account are consumed, and the state of the history table recorded
+        if max_sequence is not None:
+            cur.execute(sql.SQL("DELETE FROM public.{} WHERE sequence <= %s;").format(sql.Identifier(pgsql_tablename + '_touched')), (max_sequence,))
+        cur.execute(sql.SQL("""INSERT INTO public.{} (tablename, history_oid, history_filenode, last_import, updated_at)
+VALUES (%s, %s, %s, %s, now())
+ON CONFLICT (tablename) DO UPDATE SET history_oid = EXCLUDED.history_oid, history_filenode = EXCLUDED.history_filenode,
+last_import = EXCLUDED.last_import, updated_at = EXCLUDED.updated_at;""").format(sql.Identifier(HISTORY_STATE_TABLENAME)),
+                    (pgsql_tablename,) + state)
+        conn.commit()
+        
+        # All the results, from the store
+        cur.execute(sql.SQL("""SELECT r.nb_geometry_modification FROM unnest(%s::text[], %s::bigint[]) WITH ORDINALITY AS f(osm_type, osm_id, rank)
+JOIN public.{} AS r ON r.osm_type = f.osm_type AND r.osm_id = f.osm_id ORDER BY f.rank;""").format(results_table),
+                    (list(df.osm_type), [int(osm_id) for osm_id in df.osm_id]))
+        df['nb_geometry_modification'] = [row[0] for row in cur.fetchall()]
     
-    df['nb_geometry_modification'] = nbGeometryModification
+    if out_filename.endswith(".parquet"):
+        df.to_parquet(out_filename, index=False)
+    else:
+        df.to_csv(out_filename, float_format="%.3f", index_label="index", sep=" ")
     
-    df.to_csv("nls_buildings_multipolygons_nb_geometry_modification.csv", float_format="%.3f", index_label="index", sep=" ")
+    if versions_cache is not None:
+        print("\n 'osm_versions' cache statistics:", versions_cache.stats())
     return df
         
         
@@ -391,6 +1284,8 @@ def massive_contributions_extract(filename):
                     (let's say you want to display the statistics again later...).
                     
                     Indeed, 'get_geometry_modification' is the most time consuming in the whole process! (the whole history is scanned!) """
+    if filename.endswith(".parquet"):
+        return pd.read_parquet(os.path.join(os.getcwd(), filename))
     df = pd.read_csv(os.path.join(os.getcwd(), filename), delimiter=" ")
     return df
 
@@ -459,8 +1354,62 @@ if __name__ == '__main__':
               as I should have asked the user for a tablename input in this 'MAIN' directly to make this easier
     """
 
+    # # Reading the versions from a local, memory-mapped history store instead of PostgreSQL (built once from the history file)
+    # history_store = HistoryStore.build('finland.osh.pbf', 'history_store')
+    # # history_store = HistoryStore.load('history_store')
+    # # node_index = history_store.node_index()
+    # nb = compute_nb_geometry_modification(osm_ids, osm_types, batch=True)
+
+    # # Caching 'osm_versions' results (512 MB budget), with prefetching of the members of each way/relation
+    # versions_cache = VersionsCache(max_bytes=512 * 1024 ** 2, prefetch=True)
+
+    # # Building the node index once (or loading it, memory-mapped, if it has been saved before)
+    # node_index = NodeCoordinateIndex.from_history(conn, 'history')
+    # node_index.save('node_index')
+    # # node_index = NodeCoordinateIndex.load('node_index')
+
+    # # Fingerprinting the way versions once ('geometry_fingerprints' side table, only the new versions when run again),
+    # # then comparing the way versions by their fingerprints
+    # build_geometry_fingerprints(conn, 'history')
+    # geometry_fingerprints = GeometryFingerprints.from_table(conn)
+    # geometry_fingerprints.save('geometry_fingerprints')
+    # # geometry_fingerprints = GeometryFingerprints.load('geometry_fingerprints')
+    # # (repeated and reverted geometries of the history)
+    # from geometry_fingerprint import reverted_geometries, repeated_geometries
+    # reverted, repeated = reverted_geometries(cur), repeated_geometries(cur)
+
     # # Saving the number of geometry modifications for each feature belonging to 'nls_buildings_multipolygons' table on our computer
+    # # (batch=True: set-based engine, same results in a fraction of the time)
+    # # (incremental=True: only the features whose history changed since the last run are computed again)
+    # get_geometry_modification(batch=True, incremental=True)
+    # # (in_database=True: computed inside PostgreSQL, also saved in the 'nb_geometry_modification_sql' table)
+    # get_geometry_modification(in_database=True)
+    # # (same results as the loop, checked on the relations with deleted then recreated nodes: empty DataFrame expected)
+    # print(check_sql_engine())
+    # # (parallel mode: one process and one database connection per CPU, 5,000 features per task)
+    # get_geometry_modification(batch=True, connection_parameters={'database': "uusimaa", 'user': "postgres", 'password': "postgres",
+    #                                                              'host': "localhost", 'port': "5432"},
+    #                           nb_workers=None, task_size=5000, node_index_directory='node_index')
+    # # (asynchronous lookups, see 'async_geometry_modification.py': the nodes of a way are queried concurrently)
+    # from async_geometry_modification import async_nb_geometry_modification
+    # nb = async_nb_geometry_modification(osm_ids, osm_types, {'database': "uusimaa", 'user': "postgres", 'password': "postgres",
+    #                                                          'host': "localhost", 'port': 5432}, nb_connections=16, max_concurrency=256)
+
+    # # Full sequences of modifications (geometry and tags) of all the buildings, for the clustering analysis
+    # offsets, codes = compute_sequence_modifications(osm_ids, osm_types)
+    # np.savez_compressed('nls_buildings_multipolygons_sequences.npz', offsets=offsets, codes=codes)
+
+    # # How much the buildings changed (risk assessment of the imports): magnitudes of the geometry modifications,
+    # # flagged as significant above 1 m of Hausdorff distance, 5 m² of area delta or 0.5 m of centroid shift
+    # magnitudes = compute_modification_magnitudes(osm_ids, osm_types)
+    # magnitudes.to_csv('nls_buildings_multipolygons_magnitudes.csv', index=False)
+    # print(magnitudes[magnitudes.significant].groupby('osm_type').size())
+
+    # # Profiling the lookups ('osm_versions_query' count and latency, 'resolver' time, 'geometry_modification_max_depth'),
+    # # written every minute during the run, then once more at the end (JSON, or Prometheus text for .prom files)
+    # metrics.start_periodic_report('geometry_modification_metrics.json', interval=60)
     # get_geometry_modification()
+    # metrics.stop_periodic_report()
 
     # Importing the saved file (from 'get_geometry_modification')
     nls_buildings_multipolygons = massive_contributions_extract("nls_buildings_multipolygons_nb_geometry_modification.csv")